@@ -20,11 +20,8 @@ http_filter_layer_instance = tcp_layer.TCPFilterLayer(80, 8000, 8080)
 http_filter_layer_instance.name = "http_port_filter"
 tcp_layer_instance.register_child(http_filter_layer_instance)
 
-http_lbf_layer_instance = util.LineBufferLayer()
-http_filter_layer_instance.register_child(http_lbf_layer_instance)
-
 http_layer_instance = http_layer.HTTPLayer()
-http_lbf_layer_instance.register_child(http_layer_instance)
+http_filter_layer_instance.register_child(http_layer_instance)
 
 byte_replace_layer_instance = util.ByteReplaceLayer(b"Man",b"Ether-Weasel",1)
 http_layer_instance.register_child(byte_replace_layer_instance)
@@ -27,11 +27,8 @@ rtsp_filter_layer_instance = tcp_layer.TCPFilterLayer(554)
 rtsp_filter_layer_instance.name = "rtsp_port_filter"
 tcp_layer_instance.register_child(rtsp_filter_layer_instance)
 
-rtsp_lbf_layer_instance = util.LineBufferLayer()
-rtsp_filter_layer_instance.register_child(rtsp_lbf_layer_instance)
-
 rtsp_layer_instance = rtp_layer.RTSPLayer(debug=True)
-rtsp_lbf_layer_instance.register_child(rtsp_layer_instance)
+rtsp_filter_layer_instance.register_child(rtsp_layer_instance)
 
 video_filter_layer_instance = udp_layer.UDPFilterLayer(51234)
 video_filter_layer_instance.name = "video_port_filter"
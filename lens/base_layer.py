@@ -1,7 +1,35 @@
-import tornado.gen as gen
-from tornado.ioloop import IOLoop
+import asyncio
+import sys
 import traceback
 
+import dispatch
+import stats
+import timer_wheel
+
+def install_event_loop(use_uvloop=False):
+    # Create the event loop everything runs on, and make it current
+    # uvloop is a faster drop-in asyncio loop, if installed
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            print("uvloop is not installed, falling back to asyncio")
+        else:
+            loop = uvloop.new_event_loop()
+            asyncio.set_event_loop(loop)
+            return loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+# Tasks can start eagerly: run right away, up to where they first have to wait
+EAGER_TASKS = sys.version_info >= (3, 12)
+
+def _report(task):
+    if not task.cancelled() and task.exception() is not None:
+        exc = task.exception()
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+
 class LayerMeta(type):
     layer_classes = {}
     instance_callback = None
@@ -25,6 +53,20 @@ class NetLayer(object):
         0: 1
     }
 
+    # True if anything this layer can't hand to a child is written back out
+    # unchanged; lets the kernel-side filter skip it (see bpf.py)
+    TRANSPARENT = False
+
+    # True if `on_read` & `write` can take a message body in pieces, as it
+    # arrives, rather than all at once (see HTTPLayer.stream_piece)
+    STREAMING = False
+
+    # stats.LayerStats while instrumentation is enabled
+    layer_stats = None
+
+    # dispatch.DispatchIndex over `children`, built on first use
+    dispatch_index = None
+
     def __init__(self, **kwargs):
         self.children = []
         self.debug = kwargs.pop("debug", False)
@@ -38,25 +80,52 @@ class NetLayer(object):
     def register_child(self, child):
         self.children.append(child)
         child.parent = self
+        self.dispatch_index = None
 
     def unregister_child(self, child):
         self.children.remove(child)
+        self.dispatch_index = None
         child.cleanup()
 
     def resolve_child(self, src, header):
-        for child in self.children:
-            if child.match(src, header):
-                return child
+        # First child which matches; see dispatch.py
+        if self.dispatch_index is None:
+            self.dispatch_index = dispatch.DispatchIndex(self.children)
+        return self.dispatch_index.resolve(src, header)
 
     def match(self, src, header):
         # Override me 
         return True # match everything
 
+    def match_keys(self):
+        # Override me  -- alongside `match`, if the predicate can be expressed
+        # as header keys. Returns {key: set(values)}, where every key has to
+        # match (see bpf.py for the known keys), or None for a custom predicate.
+        # Also used to index the parent's children (see dispatch.py); if they
+        # change once registered, reset the parent's `dispatch_index`. Only
+        # used if it's defined in the same class as `match`.
+        if type(self).match is NetLayer.match:
+            return {}
+        return None
+
     # coroutine
     def on_read(self, src, header, payload):
         # Override me 
         return self.bubble(src, header, payload)
 
+    async def on_read_batch(self, src, payloads):
+        # Override me  -- if this layer can process several frames at once
+        # Hands a batch of payloads from the same `src` to the tree as a
+        # single unit: every frame is started in order, then waited on together
+        # (a bad frame only takes itself down, see `dispatch`)
+        tasks = []
+        for payload in payloads:
+            task = self.dispatch(self.on_read(src, {}, payload))
+            if task is not None:
+                tasks.append(task)
+        if tasks:
+            await asyncio.wait(tasks)
+
     # coroutine
     def on_close(self, src, header):
         # Override me  -- if additional things need to be called on close
@@ -69,11 +138,19 @@ class NetLayer(object):
         # How does this layer handle messages?
         return self.write_back(dst, header, payload)
 
-    @gen.coroutine
-    def close_bubble(self, src, header):
+    def on_evict(self, header):
+        # Override me  -- if this layer keeps per-connection state
+        # Called when the "connection" in `header` was dropped by a layer
+        # below (e.g. it went idle, see flowtable.py), without being closed:
+        # forget about it, nothing can be sent on it any more. Passed on to
+        # every child.
+        for child in self.children:
+            child.on_evict(header)
+
+    async def close_bubble(self, src, header):
         child = self.resolve_child(src, header)
         if child is not None:
-            child.on_close(src, header)
+            await child.on_close(src, header)
 
     # coroutine
     def bubble(self, src, header, payload):
@@ -88,11 +165,11 @@ class NetLayer(object):
             #print self.NAME, "loop"
             return self.write(self.route(src, header), header, payload)
 
-    @gen.coroutine
+    # coroutine
     def write_back(self, dst, header, payload):
         if self.parent is None:
             raise Exception("Unable to write_back, no parent on %s" % self)
-        yield self.parent.write(dst, header, payload)
+        return self.parent.write(dst, header, payload)
 
     # coroutine
     def passthru(self, src, header, payload):
@@ -140,16 +217,49 @@ class NetLayer(object):
         setattr(self, name, default)
         return default
 
+    def enable_stats(self):
+        # Start recording calls, bytes & latency of on_read / write / bubble /
+        # write_back. Costs nothing until enabled.
+        if self.layer_stats is None:
+            self.layer_stats = stats.LayerStats(self)
+        return self.layer_stats
+
+    def disable_stats(self):
+        if self.layer_stats is not None:
+            stats.LayerStats.remove(self)
+            self.layer_stats = None
+
     def do_debug(self, *args):
         """Toggle debugging on this layer."""
         # Shell command handler for 'debug' to toggle self.debug
         self.debug = not self.debug
         return "Debug: {}".format("on" if self.debug else "off")
 
-    def add_future(self, future):
-        if future is not None:
-            def result(f):
-                if f.exception():
-                    exc_type, exc_value, exc_traceback = f.result()
-                    traceback.print_exception(exc_type, exc_value, exc_traceback)
-            IOLoop.instance().add_future(future, result)
+    def dispatch(self, coro):
+        # Start a layer coroutine nobody is going to await, e.g. from a socket
+        # callback, as a Task. On Python 3.12+ the Task starts eagerly: it runs
+        # right away, synchronously, up to the point where it first has to
+        # wait. Most frames never wait, and so never wait for a loop
+        # iteration either. Before 3.12 it's an ordinary Task, run from the
+        # next loop iteration.
+        # Errors are printed rather than raised.
+        # Returns the Task, or None if the coroutine already finished
+        loop = asyncio.get_event_loop()
+        if EAGER_TASKS:
+            task = asyncio.Task(coro, loop=loop, eager_start=True)
+        else:
+            task = loop.create_task(coro)
+        if task.done():
+            _report(task)
+            return None
+        task.add_done_callback(_report)
+        return task
+
+    def call_later(self, delay, callback, *args):
+        # Run `callback(*args)` in `delay` seconds (rounded up to a tick), on
+        # the timer wheel shared by every layer (see timer_wheel.py).
+        # Scheduling & cancelling are O(1), cheap enough for a timer per
+        # connection. `callback` is a plain function; use `dispatch` from it
+        # to start a coroutine.
+        # Returns a timer_wheel.Timer, which can be cancel()'ed
+        return timer_wheel.get_wheel().call_later(delay, callback, *args)
@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+
+# Offline throughput benchmark for layer graphs
+#
+# Replays frames through each graph with a PcapLinkLayer root, and reports
+# packets/sec, bytes/sec & per-layer latency. Needs no root or real NICs.
+#
+# Ex: Benchmark every graph in tests/ and attacks/ with synthetic traffic
+#        python3 bench.py
+# Ex: Benchmark one graph against a capture, and save the results as a baseline
+#        python3 bench.py --alice alice.pcap --bob bob.pcap --save base.json tests/layer7.py
+# Ex: Fail (exit code 1) if any graph got more than 10% slower than the baseline
+#        python3 bench.py --compare base.json --tolerance 0.1
+# Ex: Compare against the same graphs running on uvloop
+#        python3 bench.py --uvloop --compare base.json
+# Ex: Time checksum computation on MSS-sized segments (full vs. incremental)
+#        python3 bench.py --checksum
+# Ex: Time TCP timestamp estimation over a long-lived connection
+#        python3 bench.py --timestamps
+# Ex: Time ByteReplace rule sets (hundreds of rules) on multi-MB bodies
+#        python3 bench.py --replace
+
+import argparse
+import asyncio
+import contextlib
+import glob
+import json
+import os
+import random
+import re
+import struct
+import sys
+import time
+
+import dpkt
+
+import base_layer
+import checksum
+import link_layer
+import packet
+import replace_rules
+import stats
+import tcp_layer
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+DEFAULT_GRAPHS = sorted(glob.glob(os.path.join(HERE, "tests", "*.py")) + glob.glob(os.path.join(HERE, "attacks", "*.py")))
+
+ALICE = link_layer.PcapLinkLayer.ALICE
+BOB = link_layer.PcapLinkLayer.BOB
+
+def frame(src_mac, dst_mac, ip_src, ip_dst, proto, transport):
+    pkt = dpkt.ip.IP(src=bytes(ip_src), dst=bytes(ip_dst), p=proto)
+    pkt.data = transport
+    pkt.len += len(transport)
+    return bytes(dpkt.ethernet.Ethernet(src=src_mac, dst=dst_mac, type=dpkt.ethernet.ETH_TYPE_IP, data=pkt))
+
+def synth_http_flow(n, body_size=4000, mss=536):
+    # A full HTTP/1.1 exchange over TCP: handshake, request, response, teardown
+    a_mac, b_mac = b"\x02\x00\x00\x00\x00\x01", b"\x02\x00\x00\x00\x00\x02"
+    a_ip, b_ip = [10, 0, 0, 1], [10, 0, 1, n % 250 + 1]
+    a_port, b_port = 10000 + n, 80
+    a_seq, b_seq = 1000 * n, 5000000 + 1000 * n
+
+    def seg(src, flags, seq, ack, data=b""):
+        if src == ALICE:
+            tcp = dpkt.tcp.TCP(sport=a_port, dport=b_port, seq=seq, ack=ack, flags=flags, data=data)
+            return (src, frame(a_mac, b_mac, a_ip, b_ip, dpkt.ip.IP_PROTO_TCP, tcp))
+        tcp = dpkt.tcp.TCP(sport=b_port, dport=a_port, seq=seq, ack=ack, flags=flags, data=data)
+        return (src, frame(b_mac, a_mac, b_ip, a_ip, dpkt.ip.IP_PROTO_TCP, tcp))
+
+    SYN, ACK, PSH, FIN = dpkt.tcp.TH_SYN, dpkt.tcp.TH_ACK, dpkt.tcp.TH_PUSH, dpkt.tcp.TH_FIN
+    request = b"GET /page/" + str(n).encode() + b" HTTP/1.1\r\nHost: bench\r\nAccept: */*\r\n\r\n"
+    body = (b"lorem ipsum dolor sit amet, consectetur adipiscing elit\n" * (body_size // 56 + 1))[:body_size]
+    response = b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+
+    frames = [
+        seg(ALICE, SYN, a_seq, 0),
+        seg(BOB, SYN | ACK, b_seq, a_seq + 1),
+        seg(ALICE, ACK, a_seq + 1, b_seq + 1),
+        seg(ALICE, PSH | ACK, a_seq + 1, b_seq + 1, request),
+    ]
+    a_seq += 1 + len(request)
+    b_seq += 1
+    frames.append(seg(BOB, ACK, b_seq, a_seq))
+    for i in range(0, len(response), mss):
+        chunk = response[i:i + mss]
+        frames.append(seg(BOB, PSH | ACK, b_seq, a_seq, chunk))
+        b_seq += len(chunk)
+        frames.append(seg(ALICE, ACK, a_seq, b_seq))
+    frames += [
+        seg(BOB, FIN | ACK, b_seq, a_seq),
+        seg(ALICE, FIN | ACK, a_seq, b_seq + 1),
+        seg(BOB, ACK, b_seq + 1, a_seq + 1),
+    ]
+    return frames
+
+def synth_rtp_flow(n, count=40, port=51234):
+    # An H.264 RTP stream: an SPS followed by coded slices
+    a_mac, b_mac = b"\x02\x00\x00\x00\x01\x01", b"\x02\x00\x00\x00\x01\x02"
+    a_ip, b_ip = [10, 0, 2, 1], [10, 0, 3, n % 250 + 1]
+    frames = []
+    for i in range(count):
+        nal = bytes([0x67 if i == 0 else 0x41]) + bytes(1000)
+        rtp = struct.pack("!BBHII", 0x80, 96 | 0x80, i, i * 3600, n) + nal
+        udp = dpkt.udp.UDP(sport=port, dport=port, data=rtp)
+        udp.ulen = len(udp)
+        frames.append((BOB, frame(b_mac, a_mac, b_ip, a_ip, dpkt.ip.IP_PROTO_UDP, udp)))
+    return frames
+
+def synth_frames(flows):
+    # Interleave several concurrent HTTP & RTP flows, round-robin
+    streams = []
+    for n in range(flows):
+        streams.append(synth_http_flow(n))
+        streams.append(synth_rtp_flow(n, port=(51234, 8000)[n % 2]))
+    frames = []
+    while streams:
+        for stream in list(streams):
+            frames.append(stream.pop(0))
+            if not stream:
+                streams.remove(stream)
+    return frames
+
+def walk(layer):
+    yield layer
+    for child in layer.children:
+        for l in walk(child):
+            yield l
+
+def instrument(root):
+    # Per-layer stats, named like the shell does (see NetLayer.enable_stats)
+    layers = {}
+    for layer in walk(root):
+        name = layer.name
+        i = 2
+        while name in layers:
+            name = "{}_{}".format(layer.name, i)
+            i += 1
+        layers[name] = layer.enable_stats()
+    return layers
+
+def run_graph(path, frames, alice_pcap=None, bob_pcap=None, out_dir=None):
+    kwargs = {"frames": frames}
+    if out_dir is not None:
+        name = os.path.splitext(os.path.basename(path))[0]
+        kwargs["alice_out"] = os.path.join(out_dir, name + "_alice.pcap")
+        kwargs["bob_out"] = os.path.join(out_dir, name + "_bob.pcap")
+    root = link_layer.PcapLinkLayer(alice_pcap, bob_pcap, **kwargs)
+    # Layers log to stdout; keep that out of the report (and the timings)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        # Graphs refer to helper scripts next to them
+        source = open(path).read()
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(os.path.abspath(path)))
+        try:
+            exec(source, {"root": root})
+        finally:
+            os.chdir(cwd)
+        layers = instrument(root)
+
+        start = time.perf_counter()
+        asyncio.get_event_loop().run_until_complete(root.replay())
+        elapsed = time.perf_counter() - start
+        root.cleanup()
+
+    return {
+        "frames": root.stats["read_frames"],
+        "written": root.stats["written_frames"],
+        "seconds": elapsed,
+        "pps": root.stats["read_frames"] / elapsed,
+        "bps": root.stats["read_bytes"] / elapsed,
+        "layers": {name: s.to_dict() for name, s in layers.items()},
+        "table": stats.format_table(layers),
+    }
+
+def bench_checksum(mss=1460, count=10000, repeat=5):
+    # Re-sending a forwarded segment with new seq/ack numbers, three ways:
+    # - dpkt: build & serialize dpkt objects, checksums computed from scratch
+    # - full: packet.build_tcp + build_ipv4, checksum over the whole segment
+    # - incremental: packet view `rewrite`, checksum updated for the header
+    src, dst = bytes([10, 0, 0, 1]), bytes([10, 0, 1, 1])
+    data = os.urandom(mss)
+    tcp = dpkt.tcp.TCP(sport=10000, dport=80, seq=1000, ack=2000, flags=dpkt.tcp.TH_ACK, data=data)
+    ip = packet.IPv4(bytes(dpkt.ip.IP(src=src, dst=dst, p=dpkt.ip.IP_PROTO_TCP, data=tcp, len=20 + len(tcp))))
+    view = ip.data
+
+    def with_dpkt(seq, ack):
+        tcp = dpkt.tcp.TCP(sport=10000, dport=80, seq=seq, ack=ack, flags=dpkt.tcp.TH_ACK, data=data)
+        return bytes(dpkt.ip.IP(src=src, dst=dst, p=dpkt.ip.IP_PROTO_TCP, data=tcp))
+
+    def full(seq, ack):
+        tcp = packet.build_tcp(10000, 80, seq, ack, dpkt.tcp.TH_ACK, dpkt.tcp.TCP_WIN_MAX, data=data)
+        return packet.build_ipv4(0, src, dst, dpkt.ip.IP_PROTO_TCP, tcp)
+
+    def incremental(seq, ack):
+        return packet.build_ipv4(0, src, dst, dpkt.ip.IP_PROTO_TCP, view.rewrite(seq=seq, ack=ack))
+
+    results = {}
+    for name, f in (("dpkt", with_dpkt), ("full", full), ("incremental", incremental)):
+        # Best of `repeat` runs, to keep other load on the machine out of it
+        for r in range(repeat):
+            start = time.perf_counter()
+            for i in range(count):
+                out = f(3000 + i, 4000 + i)
+            seconds = (time.perf_counter() - start) / count
+            results[name] = min(seconds, results.get(name, seconds))
+        # Every way has to come up with a valid TCP checksum
+        segment = bytes(out[20:])
+        if checksum.checksum(segment, checksum.pseudo_header_sum(src, dst, dpkt.ip.IP_PROTO_TCP, len(segment))) != 0:
+            raise Exception("{}: bad checksum".format(name))
+
+    print("Checksums on {}-byte segments:".format(mss))
+    for name, seconds in results.items():
+        print(" {:<12} {:7.2f} us/segment ({:.1f}x dpkt)".format(name, seconds * 1e6, results["dpkt"] / seconds))
+
+def bench_timestamps(count=100000, block=10000):
+    # One host's TSvals, 1000Hz with some jitter, fed to a TimestampEstimator
+    # as if from a connection that runs for `count` segments. Per-sample cost,
+    # for each `block` of samples, should stay flat however many came before.
+    estimator = tcp_layer.TimestampEstimator()
+    ts_val = 1000
+    local_time = 0.0
+    print("TCP timestamp estimation, window of {} samples:".format(estimator.WINDOW))
+    for first in range(0, count, block):
+        samples = []
+        for i in range(block):
+            local_time += 0.001 + (i % 7) * 0.0001
+            ts_val += 1 + i % 3
+            samples.append((ts_val, local_time))
+        start = time.perf_counter()
+        for sample, at in samples:
+            estimator.put_sample(sample, at)
+            estimator.get_time(at)
+        seconds = (time.perf_counter() - start) / block
+        print(" samples {:>7}-{:<7} {:7.2f} us/sample".format(first, first + block, seconds * 1e6))
+
+def bench_replace(rules=(1, 10, 100, 500), size=4 << 20, piece=1460):
+    # Rule sets of made-up words on a body of `size` bytes of those words:
+    # in one go, & streamed in `piece`-sized pieces. A rule set replaces each
+    # of its words wherever it occurs. For comparison, "stacked" is one
+    # bytes.replace per rule, as a layer per rule would do: faster for a few
+    # rules, but every rule adds a pass over the body.
+    rand = random.Random(0)
+    words = [bytes(rand.choice(b"abcdefghijklmnopqrstuvwxyz") for i in range(rand.randint(4, 10))) for j in range(2000)]
+    body = b" ".join(rand.choice(words) for i in range(size // 8))[:size]
+    regexes = [(re.compile(b"q[a-z]*z"), b"<\\g<0>>", -1), (re.compile(b"x(y+)x"), b"X\\1X", -1)]
+
+    print("Byte replacement on a {:.1f} MB body:".format(len(body) / 1e6))
+    tables = [("{} rules".format(count), [(word, word.upper(), -1) for word in words[:count]]) for count in rules]
+    tables.append(("{} + 2 regex".format(rules[-1]), tables[-1][1] + regexes))
+    for name, table in tables:
+        rule_set = replace_rules.RuleSet(table)
+
+        start = time.perf_counter()
+        whole, rest = rule_set.replace(body, rule_set.counts())
+        one_go = time.perf_counter() - start
+
+        start = time.perf_counter()
+        remaining = rule_set.counts()
+        pieces = []
+        tail = b""
+        for i in range(0, len(body), piece):
+            output, tail = rule_set.replace(tail + body[i:i + piece], remaining, i + piece >= len(body))
+            pieces.append(output)
+        streamed = time.perf_counter() - start
+        if b"".join(pieces) != whole:
+            raise Exception("Streamed replacement differs")
+
+        stacked = "-"
+        if all(isinstance(old, bytes) for old, new, count in table):
+            start = time.perf_counter()
+            data = body
+            for old, new, count in table:
+                data = data.replace(old, new)
+            stacked = "{:7.1f} MB/s".format(len(body) / (time.perf_counter() - start) / 1e6)
+
+        print(" {:<14} {:7.1f} MB/s in one go, {:7.1f} MB/s streamed, stacked: {}".format(
+            name, len(body) / one_go / 1e6, len(body) / streamed / 1e6, stacked))
+
+def report(name, result):
+    print("{}: {frames} frames in, {written} out, {seconds:.3f}s - {pps:.0f} pkt/s, {mbps:.2f} Mbit/s".format(
+        name, mbps=result["bps"] * 8 / 1e6, **result))
+    for line in result["table"].splitlines():
+        print("    " + line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lens layer graphs offline")
+    parser.add_argument("graphs", nargs="*", default=DEFAULT_GRAPHS)
+    parser.add_argument("--alice", help="pcap of frames arriving from alice")
+    parser.add_argument("--bob", help="pcap of frames arriving from bob")
+    parser.add_argument("--synth", type=int, default=50, help="synthetic flows to generate if no pcap is given")
+    parser.add_argument("--out", help="directory to write each graph's output pcaps to")
+    parser.add_argument("--save", help="save results as a JSON baseline")
+    parser.add_argument("--compare", help="compare against a JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed pkt/s drop vs. the baseline")
+    parser.add_argument("--uvloop", action="store_true", help="run on uvloop instead of the default asyncio loop")
+    parser.add_argument("--checksum", action="store_true", help="only time checksum computation on MSS-sized segments")
+    parser.add_argument("--timestamps", action="store_true", help="only time TCP timestamp estimation over a long connection")
+    parser.add_argument("--replace", action="store_true", help="only time ByteReplace rule sets on multi-MB bodies")
+    args = parser.parse_args()
+
+    if args.checksum:
+        bench_checksum()
+        return
+    if args.timestamps:
+        bench_timestamps()
+        return
+    if args.replace:
+        bench_replace()
+        return
+
+    base_layer.install_event_loop(args.uvloop)
+
+    frames = None
+    if args.alice is None and args.bob is None:
+        frames = synth_frames(args.synth)
+
+    results = {}
+    for path in args.graphs:
+        name = os.path.relpath(path, HERE)
+        try:
+            results[name] = run_graph(path, frames, args.alice, args.bob, args.out)
+        except Exception as e:
+            print("{}: failed - {!r}".format(name, e))
+            continue
+        report(name, results[name])
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = []
+        for name, result in sorted(results.items()):
+            if name in baseline:
+                change = result["pps"] / baseline[name]["pps"] - 1
+                print("{}: {:+.1%} pkt/s vs. baseline".format(name, change))
+                if change < -args.tolerance:
+                    regressions.append(name)
+        if regressions:
+            print("Regressed: {}".format(" ".join(regressions)))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import ctypes
+import socket
+import struct
+
+import dispatch
+
+# Classic BPF compiler for the layer tree.
+#
+# Layers describe what they match with `match_keys()` (if it goes with their
+# `match()`, see dispatch.match_keys); walking the tree gives a list of
+# conjunctions ("eth_type in {..} and ip_p in {..} and ...") that together
+# cover every frame some non-transparent layer wants to see.
+# Anything else would just be bridged back out unchanged, so it can be dropped
+# from our sockets and forwarded by the kernel instead.
+
+SO_ATTACH_FILTER = 26
+SO_DETACH_FILTER = 27
+
+# Opcodes (linux/filter.h)
+LD_W_ABS = 0x20
+LD_H_ABS = 0x28
+LD_B_ABS = 0x30
+LD_H_IND = 0x48
+LDX_B_MSH = 0xb1
+JA = 0x05
+JEQ_K = 0x15
+JSET_K = 0x45
+RET_K = 0x06
+
+# Most instructions the kernel takes in a program (BPF_MAXINSNS)
+MAX_INSNS = 4096
+
+ETH_TYPE_IP = 0x0800
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+
+ACCEPT = 0xFFFF
+REJECT = 0
+
+# Sets bigger than this are dropped from the filter (making it looser, never
+# stricter), to keep the program well under MAX_INSNS. (Jumps too far for a
+# conditional jump's 8-bit offsets go through a JA, see Assembler.assemble)
+MAX_SET = 64
+
+# Keys that only make sense on IPv4 frames, and what they imply
+IMPLIED = {
+    "ip_p": {"eth_type": {ETH_TYPE_IP}},
+    "ip_addr": {"eth_type": {ETH_TYPE_IP}},
+    "tcp_port": {"eth_type": {ETH_TYPE_IP}, "ip_p": {IP_PROTO_TCP}},
+    "udp_port": {"eth_type": {ETH_TYPE_IP}, "ip_p": {IP_PROTO_UDP}},
+}
+
+def merge_keys(a, b):
+    # AND two key dicts together; returns None if they can never both match
+    out = dict(a)
+    for key, values in b.items():
+        values = set(values)
+        if key in out:
+            values = out[key] & values
+        if not values:
+            return None
+        out[key] = values
+    return out
+
+def tree_terms(layer, keys=None):
+    # List of key dicts (OR'd together) describing frames that reach a layer
+    # which does more than pass them back out
+    terms = []
+    for child in layer.children:
+        child_keys = dispatch.match_keys(child)
+        term = merge_keys(keys or {}, child_keys or {})
+        if term is None:
+            continue
+        if child.TRANSPARENT:
+            terms += tree_terms(child, term)
+        else:
+            terms.append(term)
+    return terms
+
+class Assembler(object):
+    def __init__(self):
+        self.insns = []
+        self.labels = {}
+        self.next_label = 0
+
+    def label(self):
+        self.next_label += 1
+        return self.next_label
+
+    def place(self, label):
+        self.labels[label] = len(self.insns)
+
+    def emit(self, code, k=0, jt=0, jf=0):
+        self.insns.append([code, jt, jf, k])
+
+    def emit_in(self, values, on_match, on_fail):
+        # A in `values` ? goto on_match : goto on_fail
+        values = sorted(values)
+        for i, value in enumerate(values):
+            last = i == len(values) - 1
+            self.emit(JEQ_K, value, jt=on_match, jf=on_fail if last else None)
+
+    def insert(self, index, insn):
+        self.insns.insert(index, insn)
+        for label, position in self.labels.items():
+            if position >= index:
+                self.labels[label] = position + 1
+
+    def trampoline(self, index, branch):
+        # Send branch `branch` (1: jt, 2: jf) of the conditional jump at
+        # `index` through a JA, placed right after it; falling through (None)
+        # now has to jump over that
+        insn = self.insns[index]
+        via, after = self.label(), self.label()
+        self.insert(index + 1, [JA, insn[branch], None, 0])
+        self.labels[via] = index + 1
+        self.labels[after] = index + 2
+        insn[branch] = via
+        if insn[3 - branch] is None:
+            insn[3 - branch] = after
+
+    def assemble(self):
+        # Conditional jumps only reach 0xFF instructions ahead. A longer one
+        # goes through a trampoline (an unconditional JA, which takes a 32-bit
+        # offset). Each one moves what follows it on, which can put other
+        # jumps out of reach -- so go over them again until none are.
+        moved = True
+        while moved:
+            moved = False
+            for i, (code, jt, jf, k) in enumerate(self.insns):
+                if code not in (JEQ_K, JSET_K):
+                    continue
+                for branch in (1, 2):
+                    target = self.insns[i][branch]
+                    if target is not None and self.labels[target] - i - 1 > 0xFF:
+                        self.trampoline(i, branch)
+                        moved = True
+                if moved:
+                    break
+
+        program = []
+        for i, (code, jt, jf, k) in enumerate(self.insns):
+            if code == JA:
+                program.append((code, 0, 0, self.labels[jt] - i - 1))
+                continue
+            offsets = []
+            for target in (jt, jf):
+                if code not in (JEQ_K, JSET_K) or target is None:
+                    offsets.append(0)
+                    continue
+                offset = self.labels[target] - i - 1
+                if not 0 <= offset <= 0xFF:
+                    raise Exception("BPF jump out of range")
+                offsets.append(offset)
+            program.append((code, offsets[0], offsets[1], k))
+        if len(program) > MAX_INSNS:
+            raise Exception("BPF program too long ({} instructions)".format(len(program)))
+        return program
+
+def compile_term(asm, term, fail):
+    accept = asm.label()
+    for key, implied in IMPLIED.items():
+        if key in term:
+            term = merge_keys(term, implied)
+    term = {k: v for k, v in term.items() if len(v) <= MAX_SET}
+
+    if "eth_type" in term:
+        ok = asm.label()
+        asm.emit(LD_H_ABS, 12)
+        asm.emit_in(term["eth_type"], ok, fail)
+        asm.place(ok)
+
+    if "ip_p" in term:
+        ok = asm.label()
+        asm.emit(LD_B_ABS, 23)
+        asm.emit_in(term["ip_p"], ok, fail)
+        asm.place(ok)
+
+    if "ip_addr" in term:
+        addrs = {struct.unpack("!I", socket.inet_aton(ip))[0] for ip in term["ip_addr"]}
+        ok, try_dst = asm.label(), asm.label()
+        asm.emit(LD_W_ABS, 26)
+        asm.emit_in(addrs, ok, try_dst)
+        asm.place(try_dst)
+        asm.emit(LD_W_ABS, 30)
+        asm.emit_in(addrs, ok, fail)
+        asm.place(ok)
+
+    ports = term.get("tcp_port", term.get("udp_port"))
+    if ports is not None:
+        ok, try_dst = asm.label(), asm.label()
+        # Non-first fragments carry no ports; let them through
+        asm.emit(LD_H_ABS, 20)
+        asm.emit(JSET_K, 0x1FFF, jt=accept, jf=None)
+        asm.emit(LDX_B_MSH, 14)
+        asm.emit(LD_H_IND, 14)
+        asm.emit_in(ports, ok, try_dst)
+        asm.place(try_dst)
+        asm.emit(LD_H_IND, 16)
+        asm.emit_in(ports, ok, fail)
+        asm.place(ok)
+
+    asm.place(accept)
+    asm.emit(RET_K, ACCEPT)
+
+def compile_tree(root):
+    # Build a filter accepting only frames the tree under `root` is interested in
+    asm = Assembler()
+    for term in tree_terms(root):
+        fail = asm.label()
+        compile_term(asm, term, fail)
+        asm.place(fail)
+    asm.emit(RET_K, REJECT)
+    return asm.assemble()
+
+def invert(program):
+    # Swap accept & reject: matches exactly the frames `program` drops
+    return [(code, jt, jf, (REJECT if k else ACCEPT) if code == RET_K else k)
+            for (code, jt, jf, k) in program]
+
+def to_bytecode(program):
+    # `tcpdump -ddd` style string, as understood by `tc ... bpf bytecode`
+    return ",".join([str(len(program))] + ["{} {} {} {}".format(*insn) for insn in program])
+
+def dump(program):
+    return "\n".join("({:03d}) code={:#06x} jt={:<3} jf={:<3} k={:#x}".format(i, *insn)
+                     for i, insn in enumerate(program))
+
+def attach(sock, program):
+    # SO_ATTACH_FILTER copies the program into the kernel
+    insns = b"".join(struct.pack("HBBI", *insn) for insn in program)
+    buf = ctypes.create_string_buffer(insns, len(insns))
+    fprog = struct.pack("HL", len(program), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+def detach(sock):
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_DETACH_FILTER, 0)
+    except OSError:
+        pass # No filter attached
@@ -0,0 +1,39 @@
+import struct
+
+# Internet checksum (RFC 1071), and incremental updates to it (RFC 1624)
+#
+# Checksums are ints, as packed with "!H".
+#
+# The ones' complement sum of 16-bit words is the same as the sum modulo
+# 0xFFFF (2**16 = 1 mod 0xFFFF), so a whole buffer can be summed by reading
+# it as one big-endian integer -- a single C-level pass, instead of a Python
+# loop (or struct.unpack) over every word. A sum of 0 stands for 0xFFFF here
+# ("negative zero"), which is right for any buffer that isn't all zeros.
+
+PSEUDO_HEADER = struct.Struct("!4s4sxBH")
+
+def ones_sum(data, s=0):
+    # Ones' complement sum of `data`, padded to an even length, plus `s`
+    if len(data) & 1:
+        return (s + (int.from_bytes(data, "big") << 8)) % 0xFFFF
+    return (s + int.from_bytes(data, "big")) % 0xFFFF
+
+def finish(s):
+    # Checksum of a sum from `ones_sum`
+    return 0xFFFF - (s or 0xFFFF)
+
+def checksum(data, s=0):
+    return finish(ones_sum(data, s))
+
+def pseudo_header_sum(src, dst, p, length):
+    # Sum of the TCP/UDP pseudo header, for `s` in `checksum`
+    return ones_sum(PSEUDO_HEADER.pack(src, dst, p, length))
+
+def update(cksum, old, new):
+    # Checksum `cksum` after the covered bytes `old` were replaced by `new`,
+    # without going over the rest of the data again (RFC 1624, eqn. 3):
+    #   HC' = ~(~HC + ~m + m')
+    # `old` & `new` are the same length, made of whole 16-bit words of the
+    # covered data (several fields can be concatenated, e.g. ports + addresses)
+    s = (0xFFFF - cksum) + (0xFFFF - ones_sum(old)) + ones_sum(new)
+    return finish(s % 0xFFFF)
@@ -0,0 +1,132 @@
+from header import Header, wire, wire_ip
+
+# Hash-based child lookup for NetLayer.resolve_child
+#
+# Asking every child `match()` in turn is linear in the number of children,
+# for every frame, at every level. Children which describe their predicate
+# with `match_keys()` (see base_layer.py & bpf.py) are instead put in a table
+# per key, keyed by value: a frame only has to look up its own values to find
+# the children that want it. Children with a custom `match()` are still asked,
+# in order. Either way the first child (in registration order) that matches
+# wins, same as the scan.
+
+def _eth_type(header):
+    return (header.eth_type,)
+
+def _ip_p(header):
+    return (header.ip_p,)
+
+def _ip_addr(header):
+    # Raw addresses, so nothing has to be formatted (see header.py)
+    return (wire(header, "ip_src"), wire(header, "ip_dst"))
+
+def _tcp_port(header):
+    conn = header.tcp_conn
+    return (conn[0][1], conn[1][1])
+
+def _udp_port(header):
+    return (header.udp_sport, header.udp_dport)
+
+# Known keys: (header values the key is compared against, key value -> table value)
+# In order of preference when a child has several keys; the most selective first
+KEYS = (
+    ("tcp_port", _tcp_port, int),
+    ("udp_port", _udp_port, int),
+    ("ip_addr", _ip_addr, wire_ip),
+    ("ip_p", _ip_p, int),
+    ("eth_type", _eth_type, int),
+)
+KEY_FIELDS = {key: (fields, encode) for key, fields, encode in KEYS}
+
+def defined_in(cls, name):
+    # The class in `cls`'s MRO which defines attribute `name`
+    return next(c for c in cls.__mro__ if name in c.__dict__)
+
+def match_keys(layer):
+    # `layer.match_keys()`, if it can be trusted to describe `layer.match`:
+    # only if both come from the same class. A subclass which overrides
+    # `match` (say, to add a condition) but inherits `match_keys` gets None,
+    # so its own `match` is asked.
+    cls = type(layer)
+    if defined_in(cls, "match") is not defined_in(cls, "match_keys"):
+        return None
+    return layer.match_keys()
+
+def header_values(key, header):
+    # Values of `key` in `header` (a Header); none if it doesn't have the field
+    try:
+        return KEY_FIELDS[key][0](header)
+    except (AttributeError, KeyError, TypeError):
+        return ()
+
+class DispatchIndex(object):
+    def __init__(self, children):
+        # Per position in `children`: (child, test), where `test` is None if
+        # finding the child in the tables is enough, or else a function of
+        # (src, header) still to be checked
+        self.entries = []
+        # {key: {value: [position, ...]}}
+        self.tables = {}
+        # Positions which aren't in a table, and have to be tried every time
+        self.always = []
+
+        for position, child in enumerate(children):
+            keys = match_keys(child)
+            if keys is not None and not set(keys) <= set(KEY_FIELDS):
+                # Keys we don't know how to look up
+                keys = None
+
+            if keys is None:
+                self.entries.append((child, child.match))
+                self.always.append(position)
+            elif not keys:
+                # Matches everything
+                self.entries.append((child, None))
+                self.always.append(position)
+            else:
+                primary = next(key for key, _f, _e in KEYS if key in keys)
+                encode = KEY_FIELDS[primary][1]
+                table = self.tables.setdefault(primary, {})
+                for value in keys[primary]:
+                    table.setdefault(encode(value), []).append(position)
+                rest = {key: values for key, values in keys.items() if key != primary}
+                self.entries.append((child, self.make_test(rest) if rest else None))
+
+        if not self.tables and self.always and self.entries[self.always[0]][1] is None:
+            # The first child matches everything -- nothing else is ever tried
+            self.first = self.entries[self.always[0]][0]
+        else:
+            self.first = None
+
+    @staticmethod
+    def make_test(keys):
+        # Check the keys that aren't in the tables
+        keys = {key: {KEY_FIELDS[key][1](v) for v in values} for key, values in keys.items()}
+        def _test(src, header):
+            for key, values in keys.items():
+                if not any(v in values for v in header_values(key, header)):
+                    return False
+            return True
+        return _test
+
+    def resolve(self, src, header):
+        if self.first is not None:
+            return self.first
+
+        # Attack scripts may still pass a plain dict; its fields are looked
+        # up as a Header's are
+        fields = header if isinstance(header, Header) else Header(header)
+        candidates = self.always
+        for key, table in self.tables.items():
+            for value in header_values(key, fields):
+                positions = table.get(value)
+                if positions is not None:
+                    candidates = candidates + positions
+        if len(candidates) > 1:
+            candidates = sorted(candidates)
+
+        for position in candidates:
+            child, test = self.entries[position]
+            if test is None or test(src, header):
+                return child
+        return None
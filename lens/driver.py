@@ -1,6 +1,12 @@
 import subprocess
 
+import bpf
+
 class Tap:
+    # (in, out) pairs of veth inputs; frames arriving on `in` that lens
+    # doesn't care about are redirected straight out of `out` by tc
+    BYPASS = [("ethlens1", "ethlens2"), ("ethlens2", "ethlens1")]
+
     def passive(self):
         # Disconnect the tap adapters and the veth inputs
         subprocess.call(["ip","link","set","tap0","nomaster"])
@@ -24,3 +30,21 @@ class Tap:
         subprocess.call(["ip","link","set","dev","tap1","up"])
 
         print("Successfully to configure virtual tap to active mode")
+
+    def bypass(self, program):
+        # Bridge everything `program` rejects in-kernel, before it reaches lens
+        bytecode = bpf.to_bytecode(bpf.invert(program))
+        self.clear_bypass()
+        for nic_in, nic_out in self.BYPASS:
+            subprocess.call(["tc","qdisc","add","dev",nic_in,"clsact"])
+            result = subprocess.call(["tc","filter","add","dev",nic_in,"ingress",
+                "bpf","bytecode",bytecode,
+                "action","mirred","egress","redirect","dev",nic_out])
+            if result:
+                raise Exception("tc filter on {0} returned exit code {1}".format(nic_in, result))
+
+        print("Successfully configured in-kernel bypass")
+
+    def clear_bypass(self):
+        for nic_in, nic_out in self.BYPASS:
+            subprocess.call(["tc","qdisc","del","dev",nic_in,"clsact"], stderr=subprocess.DEVNULL)
@@ -1,47 +1,43 @@
-import dpkt
-import tornado.gen as gen
+import packet
 from base_layer import NetLayer
+from header import Header, pretty_mac, wire, wire_mac
 
 class EthernetLayer(NetLayer):
     NAME = "eth"
+    TRANSPARENT = True
 
     def __init__(self, *args, **kwargs):
         super(EthernetLayer, self).__init__(*args, **kwargs)
         self.seen_macs = {k: set() for k in self.routing.keys()}
 
-    @staticmethod
-    def pretty_mac(mac):
-        return ":".join(["{:02x}".format(x) for x in mac])
-    @staticmethod
-    def wire_mac(mac):
-        return bytes([int(x,16) for x in mac.split(":")])
+    pretty_mac = staticmethod(pretty_mac)
+    wire_mac = staticmethod(wire_mac)
 
-    @gen.coroutine
+    # coroutine
     def on_read(self, src, header, data):
         try:
-            pkt = dpkt.ethernet.Ethernet(data)
-        except dpkt.NeedData:
-            yield self.passthru(src, header, data)
-            return
-        header = {
-            "eth_dst": self.pretty_mac(pkt.dst),
-            "eth_src": self.pretty_mac(pkt.src),
-            "eth_type": pkt.type,
-        }
-        self.seen_macs[src].add(header["eth_src"])
-
-        #print("Ethernet frame data:" + str([hex(x) for x in bytes(pkt.data)]))
-
-        yield self.bubble(src, header, pkt.data)
-
-    @gen.coroutine
+            eth_dst, eth_src, eth_type, payload = packet.parse_ethernet(data)
+        except packet.NeedData:
+            return self.passthru(src, header, data)
+        # MACs are only formatted if someone asks (see header.py)
+        header = Header()
+        header.eth_type = eth_type
+        header.eth_dst_raw = eth_dst
+        header.eth_src_raw = eth_src
+        self.seen_macs[src].add(eth_src)
+
+        #print("Ethernet frame data:" + str([hex(x) for x in bytes(payload)]))
+
+        return self.bubble(src, header, payload)
+
+    # coroutine
     def write(self, dst, header, payload):
-        pkt = dpkt.ethernet.Ethernet(
-                dst=self.wire_mac(header["eth_dst"]),
-                src=self.wire_mac(header["eth_src"]),
-                type=header["eth_type"],
-                data=payload)
-        yield self.write_back(dst, None, bytes(pkt))
+        frame = packet.build_ethernet(
+                wire(header, "eth_dst"),
+                wire(header, "eth_src"),
+                header["eth_type"],
+                payload)
+        return self.write_back(dst, None, frame)
 
     def do_list(self):
         """List MAC addresses that have sent data to attached NICs."""
@@ -49,6 +45,6 @@ class EthernetLayer(NetLayer):
         for src, macs in self.seen_macs.items():
             output += "Source %d:\n" % src
             for mac in macs:
-                output += " - %s\n" % mac
+                output += " - %s\n" % self.pretty_mac(mac)
         return output
 
@@ -0,0 +1,146 @@
+import collections
+import collections.abc
+import time
+
+import timer_wheel
+
+# Per-flow state table, which can't grow without bound
+#
+# A dict of flow id -> state, kept in least-recently-used order: looking up
+# (`table[key]`) or storing an entry makes it the most recent one.
+#
+# - `capacity`: once full, adding a flow evicts the least recently used one
+# - `idle_timeout`: flows not used for this many seconds are evicted. The
+#   LRU order is also idle order, so a single timer (on the timer wheel, see
+#   timer_wheel.py), set for when the oldest entry goes idle, covers them all
+# - `expire(key, delay)`: evict one flow after `delay` seconds whatever
+#   happens to it, e.g. once it's closed. `unexpire(key)` takes that back,
+#   e.g. when the flow is opened again; so does storing a new value for it
+#
+# Evicted flows are passed to `on_evict(key, value)`, so their owner can
+# clean up after them (and tell its children, see NetLayer.on_evict).
+# Deleting an entry yourself doesn't call it.
+#
+# `factory` makes it a defaultdict: a missing key gets `factory()`.
+
+class FlowTable(collections.abc.MutableMapping):
+    def __init__(self, capacity=None, idle_timeout=None, on_evict=None, factory=None):
+        self.capacity = capacity
+        self.idle_timeout = idle_timeout
+        self.on_evict = on_evict
+        self.factory = factory
+        # key -> [value, last used], least recently used first
+        self.entries = collections.OrderedDict()
+        # key -> Timer, for `expire`
+        self.deadlines = {}
+        self.idle_timer = None
+        self.evictions = 0
+
+    def __getitem__(self, key):
+        try:
+            entry = self.entries[key]
+        except KeyError:
+            if self.factory is None:
+                raise
+            value = self[key] = self.factory()
+            return value
+        self.entries.move_to_end(key)
+        entry[1] = time.monotonic()
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        entries = self.entries
+        if key in entries:
+            entries.move_to_end(key)
+            self.unexpire(key)
+        entries[key] = [value, time.monotonic()]
+        if self.capacity is not None and len(entries) > self.capacity:
+            self.evict(next(iter(entries)))
+        if self.idle_timeout is not None and self.idle_timer is None:
+            self.schedule_idle()
+
+    def __delitem__(self, key):
+        del self.entries[key]
+        self.unexpire(key)
+
+    def __contains__(self, key):
+        # Doesn't count as a use
+        return key in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        return self[key]
+
+    def items(self):
+        # None of these count as a use
+        return [(key, entry[0]) for key, entry in self.entries.items()]
+
+    def values(self):
+        return [entry[0] for entry in self.entries.values()]
+
+    def peek(self, key, default=None):
+        # Like `get`, but doesn't count as a use
+        entry = self.entries.get(key)
+        return default if entry is None else entry[0]
+
+    def evict(self, key):
+        value = self.entries[key][0]
+        del self[key]
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def expire(self, key, delay):
+        # Evict `key` in `delay` seconds (replacing any earlier `expire`)
+        if key not in self.entries:
+            return
+        timer = self.deadlines.get(key)
+        if timer is not None:
+            timer.cancel()
+        self.deadlines[key] = timer_wheel.get_wheel().call_later(delay, self.expired, key)
+
+    def unexpire(self, key):
+        # Cancel an `expire`, if there is one
+        timer = self.deadlines.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+    def expired(self, key):
+        del self.deadlines[key]
+        if key in self.entries:
+            self.evict(key)
+
+    def schedule_idle(self):
+        # One timer, for when the least recently used entry goes idle
+        oldest = next(iter(self.entries.values()))
+        delay = oldest[1] + self.idle_timeout - time.monotonic()
+        self.idle_timer = timer_wheel.get_wheel().call_later(delay, self.sweep)
+
+    def sweep(self):
+        # Evict every idle entry, from the least recently used on
+        self.idle_timer = None
+        cutoff = time.monotonic() - self.idle_timeout
+        while self.entries:
+            key, (value, last_used) = next(iter(self.entries.items()))
+            if last_used > cutoff:
+                break
+            self.evict(key)
+        if self.entries and self.idle_timer is None:
+            self.schedule_idle()
+
+    def clear(self):
+        # Drop everything, without calling `on_evict`
+        for timer in self.deadlines.values():
+            timer.cancel()
+        self.deadlines.clear()
+        self.entries.clear()
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
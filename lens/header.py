@@ -0,0 +1,188 @@
+import collections.abc
+
+# Header passed between layers
+#
+# The L2-L4 fields every frame carries live in slots, so a header costs one
+# small object instead of a dict that grows key by key; anything else (HTTP
+# headers, per-protocol extras...) goes in an overflow dict, created only
+# when first needed. Layers & attack scripts can keep using it like a dict.
+#
+# Addresses are kept the way they came off the wire (bytes), and only turned
+# into strings ("02:00:00:00:00:01", "10.0.0.1") the first time a layer reads
+# them. Most frames are passed through without anyone looking, so most never
+# pay for the formatting. On the way out, `wire()` hands back the original
+# bytes unless a layer has changed the field.
+
+def pretty_mac(mac):
+    return ":".join(["{:02x}".format(x) for x in mac])
+
+def wire_mac(mac):
+    return bytes([int(x,16) for x in mac.split(":")])
+
+def pretty_ip(ip):
+    return ".".join([str(x) for x in ip])
+
+def wire_ip(ip):
+    return bytes([int(x) for x in ip.split(".")])
+
+class LazyField(object):
+    # Address field `name`: wire bytes in slot `<name>_raw` until read, the
+    # formatted string is cached in slot `_<name>`
+    def __init__(self, name, pretty, encode):
+        self.raw_name = name + "_raw"
+        self.cache_name = "_" + name
+        self.pretty = pretty
+        self.encode = encode
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.cache_name)
+        except AttributeError:
+            value = self.pretty(getattr(obj, self.raw_name))
+            setattr(obj, self.cache_name, value)
+            return value
+
+    def __set__(self, obj, value):
+        # Changed by a layer, so the wire bytes are stale
+        setattr(obj, self.cache_name, value)
+        try:
+            delattr(obj, self.raw_name)
+        except AttributeError:
+            pass
+
+    def __delete__(self, obj):
+        if not self.present(obj):
+            raise AttributeError(self.cache_name[1:])
+        for name in (self.raw_name, self.cache_name):
+            try:
+                delattr(obj, name)
+            except AttributeError:
+                pass
+
+    def present(self, obj):
+        return hasattr(obj, self.raw_name) or hasattr(obj, self.cache_name)
+
+    def wire(self, obj):
+        try:
+            return getattr(obj, self.raw_name)
+        except AttributeError:
+            return self.encode(getattr(obj, self.cache_name))
+
+LAZY_FIELDS = {
+    "eth_src": LazyField("eth_src", pretty_mac, wire_mac),
+    "eth_dst": LazyField("eth_dst", pretty_mac, wire_mac),
+    "ip_src": LazyField("ip_src", pretty_ip, wire_ip),
+    "ip_dst": LazyField("ip_dst", pretty_ip, wire_ip),
+}
+
+FIELDS = ("eth_type", "ip_id", "ip_p", "udp_sport", "udp_dport", "udp_conn", "tcp_conn")
+
+class Header(collections.abc.MutableMapping):
+    # `transport` is the packet.TCP/UDP view the frame came in as, if a layer
+    # kept it; it isn't one of the keys
+    __slots__ = FIELDS + tuple(f.raw_name for f in LAZY_FIELDS.values()) \
+                       + tuple(f.cache_name for f in LAZY_FIELDS.values()) + ("extra", "transport")
+
+    # Keys stored as attributes, in iteration order
+    KEYS = ("eth_src", "eth_dst", "eth_type", "ip_id", "ip_src", "ip_dst", "ip_p",
+            "udp_sport", "udp_dport", "udp_conn", "tcp_conn")
+    KEY_SET = frozenset(KEYS)
+
+    eth_src = LAZY_FIELDS["eth_src"]
+    eth_dst = LAZY_FIELDS["eth_dst"]
+    ip_src = LAZY_FIELDS["ip_src"]
+    ip_dst = LAZY_FIELDS["ip_dst"]
+
+    def __init__(self, *args, **kwargs):
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in self.KEY_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        try:
+            return self.extra[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.KEY_SET:
+            setattr(self, key, value)
+            return
+        try:
+            self.extra[key] = value
+        except AttributeError:
+            self.extra = {key: value}
+
+    def __delitem__(self, key):
+        try:
+            if key in self.KEY_SET:
+                delattr(self, key)
+            else:
+                del self.extra[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in LAZY_FIELDS:
+            # Without formatting it
+            return LAZY_FIELDS[key].present(self)
+        if key in self.KEY_SET:
+            return hasattr(self, key)
+        try:
+            return key in self.extra
+        except AttributeError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        for key in self.KEYS:
+            if key in self:
+                yield key
+        for key in getattr(self, "extra", ()):
+            yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return "Header({!r})".format(dict(self.items()))
+
+    def copy(self):
+        other = Header()
+        for name in self.__slots__:
+            try:
+                setattr(other, name, getattr(self, name))
+            except AttributeError:
+                pass
+        if hasattr(self, "extra"):
+            other.extra = dict(self.extra)
+        return other
+
+    def set_raw(self, key, value):
+        # Set address field `key` from its wire format
+        field = LAZY_FIELDS[key]
+        setattr(self, field.raw_name, value)
+        try:
+            delattr(self, field.cache_name)
+        except AttributeError:
+            pass
+
+    def wire(self, key):
+        return LAZY_FIELDS[key].wire(self)
+
+def wire(header, key):
+    # Wire format of address field `key` -- `header` may also be a plain dict
+    if isinstance(header, Header):
+        return LAZY_FIELDS[key].wire(header)
+    return LAZY_FIELDS[key].encode(header[key])
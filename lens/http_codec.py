@@ -0,0 +1,183 @@
+import asyncio
+import concurrent.futures
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Incremental Content-Encoding codecs, for HTTPLayer
+#
+# Each message gets its own decoder / encoder object, which is fed the body a
+# piece at a time as it arrives (`decode` / `encode`) and finished with
+# `flush`. So a streamed body never has to be collected first, and a buffered
+# one is compressed once, at the level asked for -- level 9 on a whole page
+# was the slowest thing in the HTTP rewrite path.
+#
+# gzip, deflate & zlib are always there; br & zstd only if the brotli /
+# zstandard modules are installed. `decoder` / `encoder` return None for any
+# other encoding.
+#
+# Large buffered bodies can be (de)compressed on a thread (see `run`): zlib,
+# brotli & zstandard all let go of the GIL while they work, so the loop keeps
+# forwarding other flows meanwhile.
+
+# Compression levels, (fast, best) per encoding
+LEVELS = {
+    "gzip": (1, 9),
+    "deflate": (1, 9),
+    "zlib": (1, 9),
+    "br": (4, 11),
+    "zstd": (3, 19),
+}
+
+# wbits for each zlib container ("deflate" is raw, as most servers send it)
+WBITS = {
+    "gzip": 16 | zlib.MAX_WBITS,
+    "deflate": -zlib.MAX_WBITS,
+    "zlib": zlib.MAX_WBITS,
+}
+
+# Bodies at least this big are worth a trip to the thread pool
+OFFLOAD_SIZE = 256 * 1024
+
+class ZlibDecoder(object):
+    def __init__(self, encoding):
+        self.obj = zlib.decompressobj(WBITS[encoding])
+
+    def decode(self, data):
+        return self.obj.decompress(data)
+
+    def flush(self):
+        data = self.obj.flush()
+        if not self.obj.eof:
+            raise Exception("Truncated compressed data")
+        return data
+
+class ZlibEncoder(object):
+    def __init__(self, encoding, level):
+        self.obj = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+
+    def encode(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+class BrotliDecoder(object):
+    def __init__(self, encoding):
+        self.obj = brotli.Decompressor()
+
+    def decode(self, data):
+        return self.obj.process(data)
+
+    def flush(self):
+        if not self.obj.is_finished():
+            raise Exception("Truncated compressed data")
+        return b""
+
+class BrotliEncoder(object):
+    def __init__(self, encoding, level):
+        self.obj = brotli.Compressor(quality=level)
+
+    def encode(self, data):
+        return self.obj.process(data)
+
+    def flush(self):
+        return self.obj.finish()
+
+class ZstdDecoder(object):
+    def __init__(self, encoding):
+        self.obj = zstandard.ZstdDecompressor().decompressobj()
+
+    def decode(self, data):
+        return self.obj.decompress(data)
+
+    def flush(self):
+        if not self.obj.eof:
+            raise Exception("Truncated compressed data")
+        return b""
+
+class ZstdEncoder(object):
+    def __init__(self, encoding, level):
+        self.obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def encode(self, data):
+        return self.obj.compress(data)
+
+    def flush(self):
+        return self.obj.flush()
+
+class IdentityCodec(object):
+    def __init__(self, encoding, level=None):
+        pass
+
+    def decode(self, data):
+        return data
+
+    encode = decode
+
+    def flush(self):
+        return b""
+
+# encoding -> (decoder class, encoder class)
+CODECS = {
+    "gzip": (ZlibDecoder, ZlibEncoder),
+    "deflate": (ZlibDecoder, ZlibEncoder),
+    "zlib": (ZlibDecoder, ZlibEncoder),
+    "identity": (IdentityCodec, IdentityCodec),
+}
+if brotli is not None:
+    CODECS["br"] = (BrotliDecoder, BrotliEncoder)
+if zstandard is not None:
+    CODECS["zstd"] = (ZstdDecoder, ZstdEncoder)
+
+def normalize(encoding):
+    return encoding.strip().lower()
+
+def supported(encoding):
+    return normalize(encoding) in CODECS
+
+def decoder(encoding):
+    codec = CODECS.get(normalize(encoding))
+    return codec[0](normalize(encoding)) if codec is not None else None
+
+def encoder(encoding, best=False):
+    # `best`: smallest output, rather than fastest
+    codec = CODECS.get(normalize(encoding))
+    if codec is None:
+        return None
+    level = LEVELS.get(normalize(encoding), (None, None))[best]
+    return codec[1](normalize(encoding), level)
+
+def decode(encoding, data):
+    # Whole body at once
+    obj = decoder(encoding)
+    return obj.decode(data) + obj.flush()
+
+def encode(encoding, data, best=False):
+    obj = encoder(encoding, best)
+    return obj.encode(data) + obj.flush()
+
+# Created on first use, so each shard worker gets its own (threads don't
+# survive a fork)
+_executor = None
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="http_codec")
+    return _executor
+
+async def run(func, *args):
+    # `func(encoding, data, ...)`, on the thread pool if the data is big
+    # enough to hold up the loop
+    if len(args[1]) < OFFLOAD_SIZE:
+        return func(*args)
+    return await asyncio.get_event_loop().run_in_executor(get_executor(), func, *args)
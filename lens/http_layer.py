@@ -1,213 +1,331 @@
-import zlib
-from tornado import gen, httputil
-
+import http_codec
 from base_layer import NetLayer
-from util import MultiOrderedDict, PipeLayer
+from http_parser import MessageLayer
+from util import PipeLayer
+
+class StreamTee(object):
+    # The start of a streamed body, held back by HTTPLayer: the pieces as
+    # they came in, & decoded as they went up to the children. While what the
+    # children write back is the same as what went up (`echo`), nothing has
+    # changed, and at the end the message can go out as it came in.
+    def __init__(self, message, headers):
+        self.head = message.raw
+        self.headers = list(headers)
+        self.chunked = message.chunked
+        self.raw = []
+        self.size = 0
+        self.decoded = bytearray()
+        # Bytes of `decoded` written back so far
+        self.matched = 0
+
+    def add(self, raw, decoded):
+        self.raw.append(raw)
+        self.decoded += decoded
+        self.size += len(raw) + len(decoded)
+
+    def echo(self, data):
+        # Is `data` what went up next? If so, it's matched
+        end = self.matched + len(data)
+        if self.decoded[self.matched:end] != data:
+            return False
+        self.matched = end
+        return True
 
-def zlib_compress(data, wbits):
-    cobj = zlib.compressobj(9, zlib.DEFLATED, wbits)
-    return cobj.compress(data) + cobj.flush()
+    def written(self):
+        # What was written back so far
+        return bytes(self.decoded[:self.matched])
 
-class HTTPLayer(NetLayer):
+class HTTPLayer(MessageLayer):
     NAME = "http"
 
-    ENCODERS = {
-        "gzip": lambda x: zlib_compress(x, 16 | zlib.MAX_WBITS),
-        "deflate": lambda x: zlib_compress(x, -zlib.MAX_WBITS),
-        "zlib": lambda x: zlib_compress(x, zlib.MAX_WBITS),
-        "identity": lambda x: x,
-    }
-
-    DECODERS = {
-        "gzip": lambda x: zlib.decompress(x, 16 | zlib.MAX_WBITS),
-        "deflate": lambda x: zlib.decompress(x, -zlib.MAX_WBITS),
-        "zlib": lambda x: zlib.decompress(x, zlib.MAX_WBITS),
-        "identity": lambda x: x,
-    }
+    # Headers taken out of every message written: caching headers, so the
+    # full body is sent, and Upgrade, to try to prevent an HTTPS upgrade
+    STRIPPED_HEADERS = ("if-none-match", "if-modified-since", "etag", "upgrade")
 
-    CONN_ID_KEY = "tcp_conn"
+    # Most of a streamed body (as it came in & decoded) held back, waiting to
+    # see if it comes back unchanged (see StreamTee); past this, it's
+    # streamed out as the children write it
+    HOLD_SIZE = 256 * 1024
 
     def __init__(self, *args, **kwargs):
         self.ports = kwargs.pop("ports", {})
-        self.connections = {}
 
         super(HTTPLayer, self).__init__(*args, **kwargs)
-
-    @gen.coroutine
-    def on_read(self, src, conn, data):
-        conn_id = conn[self.CONN_ID_KEY]
-        if conn_id not in self.connections:
-            dst = self.route(src, conn)
-            req = self.request(conn, dst, src)
-            req.__next__()
-            resp = self.response(conn, src, dst)
-            resp.__next__()
-            self.connections[conn_id] = {src: req, dst: resp}
-
-        if src in {0, 1}:
-            self.connections[conn_id][src].send(data)
+        # Pass bodies on in pieces, where possible
+        self.make_toggle("streaming", True)
+        # Recompress bodies as small as possible (slow), not as fast as possible
+        self.make_toggle("best_compression", False)
+        # Messages written: as they came in, rebuilt, & streamed
+        self.unchanged_count = 0
+        self.rewritten_count = 0
+        self.streamed_count = 0
+
+    async def on_head(self, src, side, message):
+        conn = side.conn
+        conn["http_headers"] = message.headers
+        if side.parser.request:
+            conn["http_request"] = message.start
         else:
-            self.log("Unknown src: {}", src)
-            yield self.passthru(src, conn, data)
-        #yield self.bubble(src, data, conn)
-
-
-    def parse_header_line(self, hdict, line):
-        line = line.decode('iso8859-1')
-        if line[0].isspace():
-            # continuation of a multi-line header
-            new_part = ' ' + line.lstrip()
-            hdict.last_value_append(new_part)
+            conn["http_response"] = message.start
+        conn["http_decoded"] = True
+        side.chunked = message.chunked
+        conn["http_stream"] = message.has_body and self.streams(src, conn, message)
+        if conn["http_stream"]:
+            conn["http_last"] = False
+            side.decoder = http_codec.decoder(conn["http_codec"]) if conn["http_codec"] else None
+            side.failed = False
         else:
-            name, value = line.split(":", 1)
-            hdict.push(name, value.strip())
-
-    def request(self, conn, src, dst):
-        keep_alive = True
-        req = None
-        conn = conn.copy()
-
-        req_line = yield 
-        while keep_alive and req_line is not None:
-            body = b''
-            headers = MultiOrderedDict()
-            try:
-                req = httputil.parse_request_start_line(req_line.strip().decode('iso8859-1'))
-            except httputil.HTTPInputError:
-                if req_line != b'':
-                    self.log("HTTP Error: Malformed request start line: '{}'", req_line)
-                req_line = yield
-                continue
-            while True:
-                header_line = yield
-                if header_line is None:
-                    break
-                if not header_line.strip():
-                    break
-                self.parse_header_line(headers, header_line.strip())
-
-            if req.version == "HTTP/1.0":
-                keep_alive = headers.last("connection", "").lower().strip() == "keep-alive"
-            else:
-                keep_alive = headers.last("connection", "").lower().strip() != "close"
-
-            if "content-length" in headers:
+            side.body = bytearray()
+            # The head as it came in, see `write`; a chunked body goes out
+            # dechunked, so its head has to change
+            side.head = None if message.chunked else message.raw
+
+    async def on_body(self, src, side, data, last):
+        conn = side.conn
+        if conn["http_stream"]:
+            await self.stream_piece(src, side, data, last)
+            return
+
+        if not last:
+            side.body += data
+            return
+        if side.body:
+            side.body += data
+            body = bytes(side.body)
+        else:
+            body = bytes(data)
+        side.body = None
+        if side.chunked:
+            headers = conn["http_headers"]
+            headers.remove("transfer-encoding")
+            headers.push("Content-Length", str(len(body)))
+        await self.bubble_body(src, conn, body, side.head)
+
+    async def bubble_body(self, dst, conn, body, head=None):
+        # Pass on a whole body, decoded first (on a thread, if it's big)
+        # The message as it came in is kept, to be written out as-is if it
+        # comes back unchanged (see `write`)
+        headers = conn["http_headers"]
+        conn["http_wire"] = (head, body, list(headers))
+        conn["http_decoded"] = True
+        if "content-encoding" in headers:
+            encoding = headers.last("content-encoding")
+            self.log("encoding: {}", encoding)
+            if http_codec.supported(encoding):
                 try:
-                    content_length = int(headers.last("content-length"))
-                except ValueError:
-                    content_length = None
+                    body = await http_codec.run(http_codec.decode, encoding, body)
+                except Exception:
+                    conn["http_decoded"] = False
+                    self.log("Unable to decode content '{}' len={}", encoding, len(body))
             else:
-                content_length = None
-
-            if req.method != "POST":
-                content_length = content_length or 0
-
-            
-            if header_line is not None:
-                #body += conn["lbl_buffers"][dst]
-                #conn["lbl_buffers"][dst] = ""
-                conn["lbl_disable"](dst)
-                while len(body) < content_length or content_length is None:
-                    data = yield
-                    if data is None:
-                        break
-                    body += data
-
-            if "content-encoding" in headers:
                 conn["http_decoded"] = False
-                encoding = headers.last("content-encoding")
-                self.log("req encoding: {}", encoding)
-                if encoding in self.DECODERS:
-                    try:
-                        body = self.DECODERS[encoding](body)
-                        conn["http_decoded"] = True
-                    except:
-                        self.log("Unable to decode content '{}' len={}/{}", encoding, len(body), content_length)
-            else:
-                conn["http_decoded"] = True
-
-            conn["lbl_enable"](dst)
-            conn["http_headers"] = headers
-            conn["http_request"] = req
-            req_line = yield self.bubble(dst, conn, body)
-
-    def response(self, conn, src, dst):
-        keep_alive = True
-        resp = None
-        conn = conn.copy()
-
-        start_line = yield 
-        while keep_alive and start_line is not None:
-            body = b''
-            headers = MultiOrderedDict()
+        conn["http_body"] = body
+        await self.bubble(dst, conn, body)
+
+    def streams(self, dst, conn, message):
+        # Can the body of `message` (in `conn`) be passed on in pieces?
+        # - Whoever takes it has to be able to deal with pieces (STREAMING)
+        # - If that might change its length, the output has to be chunked,
+        #   which needs HTTP/1.1
+        # - It can't have a transfer coding other than chunked
+        # A compressed body is decoded piece by piece on the way in, and
+        # encoded again on the way out -- unless there's no child to look at
+        # it, in which case it's passed on as it is. A chunked one comes in
+        # dechunked, and is chunked again on the way out.
+        if not self.streaming or message.version != "HTTP/1.1":
+            return False
+        headers = conn["http_headers"]
+        if "transfer-encoding" in headers and not message.chunked:
+            return False
+        encoding = http_codec.normalize(headers.last("content-encoding", "identity"))
+        conn["http_decoded"] = http_codec.supported(encoding)
+        child = self.resolve_child(dst, conn)
+        if child is not None and not child.STREAMING:
+            return False
+        coded = child is not None and conn["http_decoded"] and encoding != "identity"
+        conn["http_codec"] = encoding if coded else None
+        conn["http_chunked"] = child is not None or message.chunked
+        conn["http_head_sent"] = False
+        conn["http_undecodable"] = False
+        # With no child, it goes out as it came in anyway
+        conn["http_tee"] = StreamTee(message, headers) if child is not None else None
+        return True
+
+    async def stream_piece(self, src, side, data, last):
+        # Bubble up a piece of the body as it's sent in, instead of
+        # collecting it all first. The last piece (maybe empty) has
+        # conn["http_last"] set.
+        # Up to HOLD_SIZE of it is also held back (see `write_stream`), so a
+        # body which comes back unchanged, or doesn't decode, can still go
+        # out just as it came in.
+        conn = side.conn
+        if side.failed:
+            # Couldn't be decoded (see `stop_decoding`)
+            await self.write_raw(self.route(src, conn), conn, data, last)
+            return
+        raw = data
+        if side.decoder is not None:
             try:
-                resp = httputil.parse_response_start_line(start_line.strip().decode('iso8859-1'))
-            except httputil.HTTPInputError:
-                if start_line != b'':
-                    self.log("HTTP Error: Malformed response start line: '{}'", start_line)
-                start_line = yield
-                continue
-            while True:
-                header_line = yield
-                if header_line is None:
-                    self.log("HTTP Warning: Terminated early?")
-                    return
-                if not header_line.strip():
-                    break
-                self.parse_header_line(headers, header_line.strip())
-
-            if resp.version == "HTTP/1.0":
-                keep_alive = headers.last("connection", "").lower().strip() == "keep-alive"
-            else:
-                keep_alive = headers.last("connection", "").lower().strip() != "close"
-
-            if "content-length" in headers:
-                try:
-                    content_length = int(headers.last("content-length"))
-                except ValueError:
-                    content_length = None
-            else:
-                content_length = None
+                data = side.decoder.decode(data)
+                if last:
+                    data += side.decoder.flush()
+            except Exception:
+                self.log("Unable to decode content '{}', passing it on as it is", conn["http_codec"])
+                await self.stop_decoding(src, side, raw, last)
+                return
+
+        tee = conn["http_tee"]
+        if tee is not None:
+            tee.add(raw, data)
+            if tee.size > self.HOLD_SIZE and not last:
+                # Too big to hold back: what the children wrote so far goes
+                # out, and from now on whatever they write
+                conn["http_tee"] = None
+                await self.send_stream(self.route(src, conn), conn, tee.written())
+
+        if last:
+            conn["http_last"] = True
+        if data or last:
+            await self.bubble(src, conn, data)
+
+    async def stop_decoding(self, src, side, raw, last):
+        # The body stops decoding partway: it goes on as it came in, from the
+        # piece which failed
+        conn = side.conn
+        dst = self.route(src, conn)
+        side.failed = True
+        conn["http_undecodable"] = True
+        # The children finish off what they have: re-encoded, as far as it
+        # goes, unless it's still held back
+        conn["http_last"] = True
+        await self.bubble(src, conn, b"")
+        tee = conn["http_tee"]
+        if tee is not None:
+            # Nothing went out yet, so none of it has to be: the whole message
+            # goes out as it came in
+            conn["http_tee"] = None
+            raw = b"".join(tee.raw) + raw
+            conn["http_chunked"] = side.chunked
+        conn["http_codec"] = None
+        conn["http_last"] = last
+        await self.write_raw(dst, conn, raw, last)
+
+    async def write(self, dst, conn, data):
+        if conn.get("http_stream"):
+            return await self.write_stream(dst, conn, data)
 
+        headers = conn["http_headers"]
+        wire = conn.get("http_wire")
+        if wire is not None and data is conn["http_body"]:
+            # The body came back as the very object that was bubbled up, so
+            # nothing changed it: write it as it came in, still encoded,
+            # and the head too unless something has to change there
+            head, body, original = wire
+            self.unchanged_count += 1
+            if head is None or headers != original or any(name in headers for name in self.STRIPPED_HEADERS):
+                head = self.write_head(conn)
+            return await self.write_back(dst, conn, bytes(head) + body)
+
+        self.rewritten_count += 1
+        if "content-encoding" in headers and conn["http_decoded"]:
+            encoding = headers.last("content-encoding")
+            if http_codec.supported(encoding):
+                data = await http_codec.run(http_codec.encode, encoding, data, self.best_compression)
 
-            if header_line is not None:
-                #body += conn["lbl_buffers"][dst]
-                #conn["lbl_buffers"][dst] = ""
-                conn["lbl_disable"](dst)
-                while len(body) < content_length or content_length is None:
-                    data = yield
-                    if data is None:
-                        break
-                    body += data
+        if "content-length" in headers:
+            headers.set("Content-Length", str(len(data)))
 
-            if "content-encoding" in headers:
-                conn["http_decoded"] = False
-                encoding = headers.last("content-encoding")
-                self.log("req encoding: {}", encoding)
-                if encoding in self.DECODERS:
-                    try:
-                        body = self.DECODERS[encoding](body)
-                        conn["http_decoded"] = True
-                    except:
-                        self.log("Unable to decode content '{}' len={}/{}", encoding, len(body), content_length)
-            else:
-                # Technically it was decoded with the 'identity' encoding...
-                conn["http_decoded"] = True
-
-            conn["lbl_enable"](dst)
-            conn["http_headers"] = headers
-            conn["http_response"] = resp
-            start_line = yield self.bubble(dst, conn, body)
-
-    @gen.coroutine
-    def on_close(self, src, conn):
-        conn_id = conn[self.CONN_ID_KEY]
-        if conn_id in self.connections and src in {0, 1}:
-            self.connections[conn_id][src].send(bytes())
-        yield self.close_bubble(src, conn)
-
-    @gen.coroutine
-    def write(self, dst, conn, data):
+        output = self.write_head(conn)
+        output += data
+        await self.write_back(dst, conn, output)
+        #await self.write_back(dst, conn, None)
+
+    async def write_stream(self, dst, conn, data):
+        # A piece of a streamed body (see `stream_piece`). While the body is
+        # held back, & what comes back is what went up, nothing goes out
+        # yet: if that lasts to the end, the message goes out as it came in.
+        # Otherwise what was held goes out as the children wrote it, and
+        # from then on each piece as it's written.
+        tee = conn["http_tee"]
+        if tee is not None:
+            if conn["http_undecodable"]:
+                # Going out as it came in (see `stop_decoding`)
+                return
+            if tee.echo(data):
+                if not conn["http_last"]:
+                    return
+                if tee.matched == len(tee.decoded):
+                    return await self.write_unchanged(dst, conn, tee)
+                data = b""
+            conn["http_tee"] = None
+            data = tee.written() + data
+        await self.send_stream(dst, conn, data)
+
+    async def write_unchanged(self, dst, conn, tee):
+        # A streamed message held back whole, which came back unchanged
+        conn["http_tee"] = None
+        conn["http_head_sent"] = True
+        self.unchanged_count += 1
+        headers = conn["http_headers"]
+        head = tee.head
+        if headers != tee.headers or any(name in headers for name in self.STRIPPED_HEADERS):
+            head = self.write_head(conn)
+        conn["http_chunked"] = tee.chunked
+        await self.write_back(dst, conn, bytes(head) + self.frame_piece(conn, b"".join(tee.raw), True))
+
+    async def send_stream(self, dst, conn, data):
+        # A piece of a streamed body, as the children wrote it; the head goes
+        # out with the first one
+        output = self.stream_head(conn)
+
+        if conn["http_codec"]:
+            encoder = conn["http_encoder"]
+            data = encoder.encode(data)
+            if conn["http_last"]:
+                data += encoder.flush()
+
+        # Past a piece which didn't decode, the rest of the body comes from
+        # `write_raw`
+        output += self.frame_piece(conn, data, conn["http_last"] and not conn["http_undecodable"])
+        if output:
+            await self.write_back(dst, conn, output)
+
+    async def write_raw(self, dst, conn, data, last):
+        # A piece of a streamed body as it came in, past the children
+        output = self.stream_head(conn) + self.frame_piece(conn, data, last)
+        if output:
+            await self.write_back(dst, conn, output)
+
+    def stream_head(self, conn):
+        # The head of a streamed message, if it hasn't gone out yet
+        if conn["http_head_sent"]:
+            return b""
+        conn["http_head_sent"] = True
+        self.streamed_count += 1
+        if conn["http_chunked"]:
+            # Its length may have changed by the time it's all through
+            headers = conn["http_headers"]
+            headers.remove("content-length")
+            if "transfer-encoding" not in headers:
+                headers.push("Transfer-Encoding", "chunked")
+        if conn["http_codec"]:
+            conn["http_encoder"] = http_codec.encoder(conn["http_codec"], self.best_compression)
+        return self.write_head(conn)
+
+    @staticmethod
+    def frame_piece(conn, data, last):
+        # A piece of a streamed body as it goes on the wire
+        if not conn["http_chunked"]:
+            return data
+        output = b""
+        if data:
+            output += "{:x}\r\n".format(len(data)).encode('iso8859-1') + data + b"\r\n"
+        if last:
+            output += b"0\r\n\r\n"
+        return output
+
+    def write_head(self, conn):
+        # Start line & headers of the message in `conn`, as bytes
         if "http_request" in conn:
             start_line = "{0.method} {0.path} {0.version}\r\n".format(conn["http_request"])
         elif "http_response" in conn:
@@ -216,40 +334,29 @@ class HTTPLayer(NetLayer):
             raise Exception("No start line for HTTP")
 
         output = start_line.encode('iso8859-1')
-        #yield self.write_back(dst, conn, start_line)
+        #await self.write_back(dst, conn, start_line)
 
         headers = conn["http_headers"]
-        if "content-encoding" in headers and conn["http_decoded"]:
-            encoding = headers.last("content-encoding")
-            if encoding in self.ENCODERS:
-                data = self.ENCODERS[encoding](data)
-
-        if "content-length" in headers:
-            headers.set("Content-Length", str(len(data)))
-
-        # Remove caching headers
-        headers.remove("if-none-match")
-        headers.remove("if-modified-since")
-        headers.remove("etag")
 
-        # Try to prevent HTTPS upgrade
-        headers.remove("upgrade")
+        for name in self.STRIPPED_HEADERS:
+            headers.remove(name)
 
         for key, value in headers:
             multiline_value = value.replace("\n", "\n ")
             line = "{}: {}\r\n".format(key, multiline_value)
             output += line.encode('iso8859-1')
-            #yield self.write_back(dst, conn, line)
+            #await self.write_back(dst, conn, line)
 
         self.log(">> {}", output)
 
-        #yield self.write_back(dst, conn, "\r\n")
-        #yield self.write_back(dst, conn, data)
+        #await self.write_back(dst, conn, "\r\n")
+        #await self.write_back(dst, conn, data)
 
-        output += b'\r\n'
-        output += data
-        yield self.write_back(dst, conn, output)
-        #yield self.write_back(dst, conn, None)
+        return output + b'\r\n'
+
+    def do_status(self):
+        """Count the messages written: unchanged (streamed ones included, if held back whole), rewritten & streamed."""
+        return "{0.unchanged_count} unchanged (as they came in), {0.rewritten_count} rewritten, {0.streamed_count} streamed".format(self)
 
 
 class ImageFlipLayer(PipeLayer):
@@ -268,7 +375,7 @@ class XSSInjectorLayer(NetLayer):
             return False
         return header["http_decoded"] and "javascript" in header["http_headers"].last("content-type", "")
 
-    @gen.coroutine
+    # coroutine
     def write(self, dst, header, payload):
         output = payload + "\nalert('Code succesfully injected!');\n"
-        yield self.write_back(dst, header, output)
+        return self.write_back(dst, header, output)
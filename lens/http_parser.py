@@ -0,0 +1,408 @@
+import collections
+import re
+
+from tornado import httputil
+
+from base_layer import NetLayer
+from flowtable import FlowTable
+from util import MultiOrderedDict
+
+# Incremental HTTP/1.x & RTSP/1.0 message parser
+#
+# A MessageParser is fed one side of a connection, in whatever pieces TCP
+# hands over, and turns it into events, appended to `parser.events`:
+#
+#   (HEAD, Message)  start line & headers of the next message
+#   (BODY, bytes)    a piece of its body (dechunked)
+#   (END, bytes)     the last piece of its body (maybe b""); the message is done
+#   (ERROR, str)     something which couldn't be parsed, & was skipped
+#   (CLOSE, None)    the side was closed (see `close`)
+#
+# A head is only parsed once all of it is in: it's found with one search for
+# the blank line, decoded & split in one go, rather than a line at a time.
+# Body bytes are passed on as slices of what was fed in -- the whole of it,
+# uncopied, when a piece is all body. Whatever follows a message is the start
+# of the next one, so pipelined messages just work.
+#
+# Bodies are delimited as in RFC 7230 3.3.3: chunked, by Content-Length, or
+# by the close; none for responses to HEAD, 1xx, 204 & 304. RTSP messages
+# without a Content-Length have no body.
+
+HEAD = "head"
+BODY = "body"
+END = "end"
+ERROR = "error"
+CLOSE = "close"
+
+# Most that's kept of a head (or chunk size / trailer line) which hasn't
+# ended yet. Past that, it's dropped -- or, in the middle of a body, the rest
+# of the side is passed on as it is
+MAX_HEAD = 64 * 1024
+
+# Parser states
+START = "start"
+LENGTH = "length"
+CHUNK_SIZE = "chunk_size"
+CHUNK_DATA = "chunk_data"
+CHUNK_END = "chunk_end"
+TRAILERS = "trailers"
+UNTIL_CLOSE = "until_close"
+CLOSED = "closed"
+
+def as_bytes(data, start, end):
+    # data[start:end] as bytes: `data` itself, if it's bytes & that's all of it
+    if isinstance(data, bytes):
+        return data if start == 0 and end == len(data) else data[start:end]
+    with memoryview(data) as view:
+        return bytes(view[start:end])
+
+class Message(object):
+    # The head of a message, as parsed
+    # - `start`: httputil.RequestStartLine or ResponseStartLine
+    # - `headers`: MultiOrderedDict
+    # - `raw`: the head as it came in, up to & including the blank line
+    # - `length`: body length, or None if it's chunked or runs to the close
+    __slots__ = ("start", "headers", "raw", "length", "chunked")
+
+    def __init__(self, start, headers, raw):
+        self.start = start
+        self.headers = headers
+        self.raw = raw
+        self.length = 0
+        self.chunked = False
+
+    @property
+    def version(self):
+        return self.start.version
+
+    @property
+    def has_body(self):
+        return self.length != 0
+
+class MessageParser(object):
+    def __init__(self, protocol="HTTP", request=True, methods=None):
+        # `request`: parse requests, not responses. `methods` is a deque
+        # shared by both sides of a connection: the request side adds each
+        # request's method, the response side takes them, to know which
+        # responses are to a HEAD.
+        self.protocol = protocol
+        self.request = request
+        self.methods = methods
+        self.version = re.compile(r"{}/\d\.\d$".format(protocol))
+        self.events = collections.deque()
+        self.state = START
+        # Unparsed end of what was fed in so far: b"", or a bytearray which
+        # pieces are added to, so a head coming in slowly isn't re-copied
+        self.rest = b""
+        # How far into `rest` there's no end of head (or line) to be found
+        self.scanned = 0
+        # Bytes left in the body or chunk
+        self.remaining = 0
+
+    def feed(self, data):
+        if self.state is CLOSED or not data:
+            return
+        if self.rest:
+            self.rest += data
+            data = self.rest
+            self.rest = b""
+        pos = 0
+        while pos < len(data):
+            state = self.state
+            if state is START:
+                end = self.parse_head(data, pos)
+            elif state is LENGTH or state is CHUNK_DATA:
+                end = min(pos + self.remaining, len(data))
+                piece = as_bytes(data, pos, end)
+                self.remaining -= end - pos
+                if self.remaining:
+                    self.events.append((BODY, piece))
+                elif state is LENGTH:
+                    self.events.append((END, piece))
+                    self.state = START
+                else:
+                    self.events.append((BODY, piece))
+                    self.state = CHUNK_END
+            elif state is CHUNK_SIZE:
+                end = self.parse_chunk_size(data, pos)
+            elif state is CHUNK_END:
+                if data.startswith(b"\n", pos):
+                    end = pos + 1
+                elif data.startswith(b"\r\n", pos):
+                    end = pos + 2
+                elif len(data) - pos < 2:
+                    end = None
+                else:
+                    # Lenient about it
+                    self.events.append((ERROR, "Missing CRLF after chunk"))
+                    end = pos
+                if end is not None:
+                    self.state = CHUNK_SIZE
+            elif state is TRAILERS:
+                end = self.line_end(data, pos)
+                if end is not None:
+                    # Trailers are dropped: the body goes out framed anew
+                    if not data[pos:end].strip():
+                        self.events.append((END, b""))
+                        self.state = START
+            else:
+                # UNTIL_CLOSE
+                self.events.append((BODY, as_bytes(data, pos, len(data))))
+                end = len(data)
+
+            if end is None:
+                # Needs more data
+                self.keep(data, pos)
+                return
+            pos = end
+            self.scanned = 0
+
+    def close(self):
+        # The side was closed: a body running to the close (or cut short) ends
+        if self.state is CLOSED:
+            return
+        if self.state is not START:
+            self.events.append((END, b""))
+        elif self.rest.strip():
+            self.events.append((ERROR, "Closed in the middle of a head: {!r}".format(self.rest[:80])))
+        self.rest = b""
+        self.state = CLOSED
+        self.events.append((CLOSE, None))
+
+    def keep(self, data, pos):
+        # Keep data[pos:] for the next piece
+        if isinstance(data, bytearray):
+            del data[:pos]
+            rest = data
+        else:
+            rest = bytearray(data[pos:])
+        if len(rest) > MAX_HEAD and self.state is not CHUNK_END:
+            if self.state is START:
+                self.events.append((ERROR, "Head longer than {} bytes, dropped".format(MAX_HEAD)))
+            else:
+                self.events.append((ERROR, "Chunk line longer than {} bytes, passing the rest on as it is".format(MAX_HEAD)))
+                self.state = UNTIL_CLOSE
+                self.events.append((BODY, bytes(rest)))
+            rest = b""
+            self.scanned = 0
+        self.rest = rest
+
+    def line_end(self, data, pos):
+        # Position after the end of the line at `pos`, or None
+        end = data.find(b"\n", pos + self.scanned)
+        if end < 0:
+            self.scanned = len(data) - pos
+            return None
+        return end + 1
+
+    def parse_head(self, data, pos):
+        # Position after the head at `pos`, or None if it's not all in yet
+        # Empty lines before a start line are skipped (RFC 7230 3.5)
+        if data.startswith(b"\n", pos):
+            return pos + 1
+        if data.startswith(b"\r\n", pos):
+            return pos + 2
+        line_end = data.find(b"\n", pos)
+        if line_end < 0:
+            return None
+        start = self.parse_start_line(data[pos:line_end].decode("iso8859-1").strip())
+        if start is None:
+            # Skip just that line, and try again from the next one
+            self.events.append((ERROR, "Malformed start line: {!r}".format(data[pos:line_end])))
+            return line_end + 1
+
+        # The head ends with the first empty line
+        search = max(line_end, pos + self.scanned - 2)
+        crlf = data.find(b"\n\r\n", search)
+        lf = data.find(b"\n\n", search)
+        if crlf < 0 and lf < 0:
+            self.scanned = len(data) - pos
+            return None
+        end = lf + 2 if crlf < 0 or 0 <= lf < crlf else crlf + 3
+
+        raw = as_bytes(data, pos, end)
+        fields = []
+        for line in raw.decode("iso8859-1").split("\n")[1:]:
+            line = line.rstrip("\r")
+            if not line:
+                continue
+            if line[0] in " \t" and fields:
+                # Continuation of a multi-line header
+                fields[-1][1] += " " + line.strip()
+            elif ":" in line:
+                name, value = line.split(":", 1)
+                fields.append([name.strip(), value.strip()])
+            else:
+                self.events.append((ERROR, "Malformed header line: {!r}".format(line)))
+        message = Message(start, MultiOrderedDict(fields), raw)
+        self.frame(message)
+        self.events.append((HEAD, message))
+        if not message.has_body:
+            self.events.append((END, b""))
+        return end
+
+    def parse_start_line(self, line):
+        parts = line.split()
+        if self.request:
+            if len(parts) != 3 or not self.version.match(parts[2]):
+                return None
+            return httputil.RequestStartLine(*parts)
+        parts = line.split(None, 2)
+        if len(parts) < 2 or not self.version.match(parts[0]) or not (len(parts[1]) == 3 and parts[1].isdigit()):
+            return None
+        return httputil.ResponseStartLine(parts[0], int(parts[1]), parts[2] if len(parts) > 2 else "")
+
+    def frame(self, message):
+        # How the body of `message` is delimited; sets the state to read it
+        headers = message.headers
+        if self.request:
+            if self.methods is not None:
+                self.methods.append(message.start.method)
+        else:
+            code = message.start.code
+            method = None
+            if code >= 200 and self.methods:
+                method = self.methods.popleft()
+            if method == "HEAD" or code < 200 or code in (204, 304):
+                message.length = 0
+                self.state = START
+                return
+
+        encoding = headers.last("transfer-encoding")
+        if encoding is not None:
+            if encoding.split(",")[-1].strip().lower() == "chunked":
+                message.chunked = True
+                message.length = None
+                self.state = CHUNK_SIZE
+            else:
+                message.length = None
+                self.state = UNTIL_CLOSE
+            return
+
+        if "content-length" in headers:
+            try:
+                message.length = int(headers.last("content-length"))
+            except ValueError:
+                self.events.append((ERROR, "Invalid Content-Length: {!r}".format(headers.last("content-length"))))
+                message.length = None
+                self.state = UNTIL_CLOSE
+                return
+            self.remaining = message.length
+            self.state = LENGTH if message.length else START
+        elif self.request or self.protocol != "HTTP":
+            message.length = 0
+            self.state = START
+        else:
+            message.length = None
+            self.state = UNTIL_CLOSE
+
+    def parse_chunk_size(self, data, pos):
+        end = self.line_end(data, pos)
+        if end is None:
+            return None
+        line = data[pos:end].split(b";", 1)[0].strip()
+        try:
+            size = int(line, 16)
+        except ValueError:
+            # Can't tell where the chunks are any more
+            self.events.append((ERROR, "Malformed chunk size: {!r}".format(line)))
+            self.state = UNTIL_CLOSE
+            return pos
+        if size:
+            self.remaining = size
+            self.state = CHUNK_DATA
+        else:
+            self.state = TRAILERS
+        return end
+
+class Side(object):
+    # One side of a connection in a MessageLayer: its parser, its copy of the
+    # connection's header, & whatever the layer keeps about the message in
+    # progress
+    def __init__(self, parser, conn):
+        self.parser = parser
+        self.conn = conn.copy()
+        # True while its events are being handled (see MessageLayer.drain)
+        self.busy = False
+
+class MessageLayer(NetLayer):
+    # Base for layers which speak an HTTP-like protocol over a TCP connection
+    #
+    # Each side's data goes through its own MessageParser, and the events
+    # come out, in order, as on_head / on_body; the side which sends first is
+    # taken to be the client. No LineBufferLayer needed in front.
+    PROTOCOL = "HTTP"
+    CONN_ID_KEY = "tcp_conn"
+    MAX_CONNECTIONS = 65536
+
+    def __init__(self, *args, **kwargs):
+        super(MessageLayer, self).__init__(*args, **kwargs)
+        # conn_id -> {src: Side}
+        self.connections = FlowTable(self.MAX_CONNECTIONS)
+
+    async def on_read(self, src, conn, data):
+        conn_id = conn[self.CONN_ID_KEY]
+        sides = self.connections.get(conn_id)
+        if sides is None:
+            dst = self.route(src, conn)
+            methods = collections.deque()
+            sides = self.connections[conn_id] = {
+                src: Side(MessageParser(self.PROTOCOL, True, methods), conn),
+                dst: Side(MessageParser(self.PROTOCOL, False, methods), conn),
+            }
+
+        if src in sides:
+            side = sides[src]
+            side.parser.feed(data)
+            await self.drain(src, side)
+        else:
+            self.log("Unknown src: {}", src)
+            await self.passthru(src, conn, data)
+
+    async def on_close(self, src, conn):
+        sides = self.connections.peek(conn[self.CONN_ID_KEY])
+        if sides is None or src not in sides:
+            await self.close_bubble(src, conn)
+            return
+        # The close goes on after what's before it (see `drain`)
+        sides[src].parser.close()
+        await self.drain(src, sides[src])
+
+    async def drain(self, src, side):
+        # Handle the side's events. While one is waiting (say, on HTTPLayer
+        # decoding a body on a thread), data that comes in from the same side
+        # is parsed, and its events queue up behind, to be handled by this
+        # same loop once it's through -- so messages can't overtake each
+        # other.
+        if side.busy:
+            return
+        side.busy = True
+        events = side.parser.events
+        try:
+            while events:
+                kind, value = events.popleft()
+                if kind is BODY:
+                    await self.on_body(src, side, value, False)
+                elif kind is END:
+                    await self.on_body(src, side, value, True)
+                elif kind is HEAD:
+                    await self.on_head(src, side, value)
+                elif kind is ERROR:
+                    self.log("{} Error: {}", self.PROTOCOL, value)
+                else:
+                    await self.close_bubble(src, side.conn)
+        finally:
+            side.busy = False
+
+    async def on_head(self, src, side, message):
+        # Override me  -- a message's head came in from `src`
+        pass
+
+    async def on_body(self, src, side, data, last):
+        # Override me  -- a piece of the message's body; `last` if the
+        # message is done
+        pass
+
+    def on_evict(self, conn):
+        self.connections.pop(conn.get(self.CONN_ID_KEY), None)
+        super(MessageLayer, self).on_evict(conn)
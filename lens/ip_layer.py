@@ -1,9 +1,10 @@
 import collections
 import dpkt
 import random
-import tornado.gen as gen
 
+import packet
 from base_layer import NetLayer
+from header import pretty_ip, wire, wire_ip
 
 #def make_list_commands(list_name):
 #    def do_add(self, ip=None):
@@ -29,13 +30,10 @@ from base_layer import NetLayer
 
 class IPv4Layer(NetLayer):
     NAME = "ip"
+    TRANSPARENT = True
 
-    @staticmethod
-    def pretty_ip(ip):
-        return ".".join([str(x) for x in ip])
-    @staticmethod
-    def wire_ip(ip):
-        return bytes([int(x) for x in ip.split(".")])
+    pretty_ip = staticmethod(pretty_ip)
+    wire_ip = staticmethod(wire_ip)
 
     def __init__(self):
         self.next_ids = {}
@@ -45,21 +43,24 @@ class IPv4Layer(NetLayer):
         super(IPv4Layer, self).__init__()
 
     def match(self, src, header):
-        return header["eth_type"] == dpkt.ethernet.ETH_TYPE_IP
+        return header.get("eth_type") == dpkt.ethernet.ETH_TYPE_IP
+
+    def match_keys(self):
+        return {"eth_type": {dpkt.ethernet.ETH_TYPE_IP}}
 
     # coroutine
     def on_read(self, src, header, payload):
-        # It already comes parsed by dpkt from EthernetLayer
-        #pkt = dpkt.ip.IP(payload) 
+        # It already comes parsed from EthernetLayer, as a packet.IPv4 view
         #print "IP>", payload
-        pkt = payload 
-        header["ip_id"] = pkt.id
-        header["ip_dst"] = dst_ip = self.pretty_ip(pkt.dst)
-        header["ip_src"] = src_ip = self.pretty_ip(pkt.src)
-        header["ip_p"] = pkt.p
+        pkt = payload
+        header.ip_id = pkt.id
+        header.ip_dst_raw = pkt.dst
+        header.ip_src_raw = pkt.src
+        header.ip_p = pkt.p
 
-        self.seen_ips[src_ip].add(header["eth_src"])
-        self.seen_ips[dst_ip].add(header["eth_dst"])
+        # Raw addresses, see header.py
+        self.seen_ips[pkt.src].add(wire(header, "eth_src"))
+        self.seen_ips[pkt.dst].add(wire(header, "eth_dst"))
 
         self.protocol_stats[pkt.p] += 1
 
@@ -68,23 +69,22 @@ class IPv4Layer(NetLayer):
 
     # coroutine
     def write(self, dst, header, payload):
-        src_mac = header["eth_src"]
+        src_mac = wire(header, "eth_src")
         if src_mac not in self.next_ids:
             # Keep track of per-MAC IP packet ID's
             # Generate one randomly if we need to
             self.next_ids[src_mac] = header.get("ip_id", random.randint(0, 0xFFFF))
 
-        pkt = dpkt.ip.IP(
-                id=self.next_ids[src_mac],
-                dst=self.wire_ip(header["ip_dst"]),
-                src=self.wire_ip(header["ip_src"]),
-                p=header["ip_p"])
+        pkt = packet.build_ipv4(
+                self.next_ids[src_mac],
+                wire(header, "ip_src"),
+                wire(header, "ip_dst"),
+                header["ip_p"],
+                payload)
 
         self.next_ids[src_mac] = (self.next_ids[src_mac] + 1) & 0xFFFF
-        pkt.data = payload
-        pkt.len += len(payload)
 
-        return self.write_back(dst, header, bytes(pkt))
+        return self.write_back(dst, header, pkt)
     
     def do_protos(self):
         """List statistics about protocols."""
@@ -98,6 +98,7 @@ class IPv4Layer(NetLayer):
 class IPv4FilterLayer(NetLayer):
     """ Pass all IPv4 packets with a given IP through """
     NAME = "ipv4_filter"
+    TRANSPARENT = True
 
     def __init__(self, ips=None):
         super(IPv4FilterLayer, self).__init__()
@@ -105,6 +106,11 @@ class IPv4FilterLayer(NetLayer):
         if ips is None:
             ips = []
         self.ips = ips
+        self.wire_ips = {wire_ip(ip) for ip in ips}
 
     def match(self, src, header):
-        return header["ip_src"] in self.ips  or header["ip_dst"] in self.ips
+        # Compare raw addresses, so nothing has to be formatted
+        return wire(header, "ip_src") in self.wire_ips or wire(header, "ip_dst") in self.wire_ips
+
+    def match_keys(self):
+        return {"ip_addr": set(self.ips)}
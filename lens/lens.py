@@ -1,10 +1,10 @@
 #!/usr/bin/python3
 
 import sys
-from tornado.ioloop import IOLoop
 
 import util
 import driver
+import shard
 import shell
 
 import link_layer
@@ -19,10 +19,34 @@ import video_layer
 
 if __name__ == "__main__":
 
+    # Ex: Run on uvloop instead of the default asyncio event loop
+    #        python3 lens.py --uvloop
+    # Ex: Spread flows across 4 worker processes (see shard.py)
+    #        python3 lens.py --workers 4
+    use_uvloop = False
+    workers = 0
+    commands = []
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg == "--uvloop":
+            use_uvloop = True
+        elif arg == "--workers":
+            workers = int(args.pop(0))
+        else:
+            commands.append(arg)
+
+    loop = base_layer.install_event_loop(use_uvloop)
+
     tap = driver.Tap()
     tap.passive()
-    root = link_layer.LinkLayer()
-    sh = shell.CommandShell(root,tap)
+    pool = None
+    if workers:
+        pool = shard.WorkerPool(workers, use_uvloop=use_uvloop)
+        sh = shard.ShardedShell(pool, tap)
+    else:
+        root = link_layer.LinkLayer()
+        sh = shell.CommandShell(root,tap)
 
     # If 2 or more arguments are provided then pass them
     # them to the shell as commands. To provide multiple
@@ -30,13 +54,12 @@ if __name__ == "__main__":
     # 
     # Ex: Load and start an attack
     #        python3 lens.py "load byte_replace.py" "driver active"
-    if len(sys.argv) >= 2:
-        commands = sys.argv[1:]
-        for command in commands:
-            sh.handle_command(command)
+    for command in commands:
+        sh.handle_command(command)
 
     try:
-        IOLoop.instance().start()
+        loop.run_forever()
     finally:
-        pass
+        if pool is not None:
+            pool.stop()
         tap.passive()
@@ -1,30 +1,225 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import mmap
 import socket
+import struct
 import subprocess
-from tornado.ioloop import IOLoop
-from tornado.iostream import IOStream
+import dpkt
 
+import bpf
 from base_layer import NetLayer
 
+class RxRing(object):
+    # TPACKET_V3 memory-mapped receive ring (see packet_mmap.txt in the kernel docs)
+    # The kernel fills whole blocks of frames; we walk every block handed to
+    # userspace and give it back by resetting its status word.
+    SOL_PACKET = 263
+    PACKET_RX_RING = 5
+    PACKET_VERSION = 10
+    TPACKET_V3 = 2
+    TP_STATUS_KERNEL = 0
+    TP_STATUS_USER = 1
+
+    BLOCK_SIZE = 1 << 18
+    BLOCK_NR = 64
+    FRAME_SIZE = 1 << 11
+    BLOCK_TIMEOUT_MS = 10
+
+    # struct tpacket_block_desc / tpacket_hdr_v1
+    BLOCK_HDR = struct.Struct("=IIIII")
+    # struct tpacket3_hdr, up to tp_mac
+    FRAME_HDR = struct.Struct("=IIIIIIH")
+
+    def __init__(self, sock):
+        sock.setsockopt(self.SOL_PACKET, self.PACKET_VERSION, self.TPACKET_V3)
+        req = struct.pack("=7I",
+                self.BLOCK_SIZE,
+                self.BLOCK_NR,
+                self.FRAME_SIZE,
+                (self.BLOCK_SIZE * self.BLOCK_NR) // self.FRAME_SIZE,
+                self.BLOCK_TIMEOUT_MS,
+                0, 0)
+        sock.setsockopt(self.SOL_PACKET, self.PACKET_RX_RING, req)
+        self.ring = mmap.mmap(sock.fileno(), self.BLOCK_SIZE * self.BLOCK_NR)
+        self.block = 0
+
+    def read(self, limit):
+        # Drain ready blocks, returning up to roughly `limit` frames
+        frames = []
+        while len(frames) < limit:
+            base = self.block * self.BLOCK_SIZE
+            _version, _priv, status, num_pkts, offset = self.BLOCK_HDR.unpack_from(self.ring, base)
+            if not status & self.TP_STATUS_USER:
+                break
+            for i in range(num_pkts):
+                next_offset, _sec, _nsec, snaplen, _len, _status, mac = self.FRAME_HDR.unpack_from(self.ring, base + offset)
+                start = base + offset + mac
+                frames.append(self.ring[start:start + snaplen])
+                offset += next_offset
+            struct.pack_into("=I", self.ring, base + 8, self.TP_STATUS_KERNEL)
+            self.block = (self.block + 1) % self.BLOCK_NR
+        return frames
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_sendmmsg = getattr(_libc, "sendmmsg", None)
+
+class TxQueue(object):
+    # Outgoing frames for one NIC.
+    # Frames are queued by `push` and sent together by `flush`, which the
+    # LinkLayer schedules once per loop iteration. A single sendmmsg()
+    # call sends the whole batch; if the kernel pushes back (EAGAIN) the
+    # remainder stays queued until the socket is writable again. A frame
+    # the kernel refuses outright (EMSGSIZE, ENETDOWN, ...) is dropped, so
+    # it can't hold up everything queued behind it.
+    MAX_QUEUE = 4096
+
+    def __init__(self, sock, log=None):
+        self.sock = sock
+        self.log = log
+        self.frames = []
+        self.waiting = False
+        self.stats = {
+            "queued": 0,
+            "sent": 0,
+            "syscalls": 0,
+            "max_batch": 0,
+            "eagain": 0,
+            "dropped": 0,
+            "errors": 0,
+        }
+
+    def push(self, frame):
+        if len(self.frames) >= self.MAX_QUEUE:
+            self.stats["dropped"] += 1
+            return
+        if not isinstance(frame, bytes):
+            frame = bytes(frame)
+        self.frames.append(frame)
+        self.stats["queued"] += 1
+
+    def flush(self):
+        # Returns True if frames are still queued due to backpressure
+        while self.frames:
+            batch = self.frames[:1024]
+            self.stats["syscalls"] += 1
+            try:
+                sent = self.send(batch)
+            except OSError as e:
+                # Only ever for the first frame of the batch: the ones
+                # before a bad frame are sent, & it's reported next time
+                self.stats["errors"] += 1
+                if self.log is not None:
+                    self.log("Dropped a frame of {} bytes: {}", len(batch[0]), e)
+                del self.frames[:1]
+                continue
+            self.stats["sent"] += sent
+            self.stats["max_batch"] = max(self.stats["max_batch"], sent)
+            del self.frames[:sent]
+            if sent == 0:
+                self.stats["eagain"] += 1
+                return True
+        return False
+
+    def send(self, batch):
+        if _sendmmsg is None:
+            sent = 0
+            for frame in batch:
+                try:
+                    self.sock.send(frame)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    # Like sendmmsg: an error only for the first frame
+                    if not sent:
+                        raise
+                    break
+                sent += 1
+            return sent
+
+        n = len(batch)
+        iovs = (iovec * n)()
+        msgs = (mmsghdr * n)()
+        for i, frame in enumerate(batch):
+            # c_char_p points straight at the bytes object's buffer, no copy
+            iovs[i].iov_base = ctypes.cast(ctypes.c_char_p(frame), ctypes.c_void_p)
+            iovs[i].iov_len = len(frame)
+            msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+            msgs[i].msg_hdr.msg_iovlen = 1
+        sent = _sendmmsg(self.sock.fileno(), msgs, n, 0)
+        if sent < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.ENOBUFS):
+                return 0
+            raise OSError(err, "sendmmsg: " + errno.errorcode.get(err, str(err)))
+        return sent
+
 class LinkLayer(NetLayer):
     NAME="link"
     SNAPLEN=1550
-    ETH_P_ALL = 3 
+    ETH_P_ALL = 3
+    # Max frames handed to the layer tree per wakeup in "batch" & "ring" modes
+    BATCH_SIZE = 64
 
     ALICE = 0
     BOB = 1
 
+    # PACKET_FANOUT spreads a NIC's frames across every socket in a group,
+    # hashing each frame's flow symmetrically (see shard.py)
+    PACKET_FANOUT = 18
+    PACKET_FANOUT_HASH = 0
+
+    # Ingest modes, selectable per NIC:
+    #   single - one recv() per READ event (original behaviour)
+    #   batch  - recv() until EAGAIN (or BATCH_SIZE frames) per READ event
+    #   ring   - TPACKET_V3 mmap'd RX ring, drained per READ event
+    INGEST_MODES = ("single", "batch", "ring")
+
     def __init__(self, alice_nic = "br0", bob_nic = "br1", *args, **kwargs):
+        alice_ingest = kwargs.pop("alice_ingest", "single")
+        bob_ingest = kwargs.pop("bob_ingest", "single")
+        # (alice, bob) sockets from `attach`, if they were opened beforehand,
+        # and any RxRings already set up on them
+        sockets = kwargs.pop("sockets", None)
+        self.rings = kwargs.pop("rings", {})
         super(LinkLayer, self).__init__(*args, **kwargs)
-        alice_sock = self.attach(alice_nic)
-        bob_sock = self.attach(bob_nic)
+        if sockets is None:
+            sockets = (self.attach(alice_nic), self.attach(bob_nic))
+        alice_sock, bob_sock = sockets
 
-        io_loop = IOLoop.instance()
+        self.loop = asyncio.get_event_loop()
 
-        self.alice_stream = IOStream(alice_sock)
-        self.bob_stream = IOStream(bob_sock)
+        self.alice_sock = alice_sock
+        self.bob_sock = bob_sock
 
-        io_loop.add_handler(alice_sock.fileno(), self.alice_read, IOLoop.READ)
-        io_loop.add_handler(bob_sock.fileno(), self.bob_read, IOLoop.READ)
+        # Frames are sent on the same sockets they are read from, so the
+        # kernel never loops our own writes back to us
+        self.tx_queues = {
+            self.ALICE: TxQueue(alice_sock, self.log),
+            self.BOB: TxQueue(bob_sock, self.log),
+        }
+        self.flush_scheduled = False
+
+        self.loop.add_reader(alice_sock.fileno(), self.make_reader(self.ALICE, alice_sock, alice_ingest))
+        self.loop.add_reader(bob_sock.fileno(), self.make_reader(self.BOB, bob_sock, bob_ingest))
 
     # This layer is a SOURCE
     # so it will never consume packets
@@ -41,23 +236,160 @@ class LinkLayer(NetLayer):
         sock.setblocking(0)
         return sock
 
-    def alice_read(self, fd, event):
-        data = self.alice_stream.socket.recv(self.SNAPLEN)
-        #print("Alice link data:" + str([hex(x) for x in bytes(data)]))
-        #self.add_future(self.on_read(self.ALICE, {}, data[:-2]))
-        self.add_future(self.on_read(self.ALICE, {}, data))
-
-    def bob_read(self, fd, event):
-        data = self.bob_stream.socket.recv(self.SNAPLEN)
-        #print("Bob link data:" + str([hex(x) for x in bytes(data)]))
-        #self.add_future(self.on_read(self.BOB, {}, data[:-2]))
-        self.add_future(self.on_read(self.BOB, {}, data))
-
-    # coroutine
-    def write(self, dst, header, data):
-        if dst == self.ALICE:
-            return self.alice_stream.write(data)
-        elif dst == self.BOB:
-            return self.bob_stream.write(data)
+    @classmethod
+    def join_fanout(cls, sock, group):
+        # Sockets are served in the order they joined `group`. Set up any
+        # RxRing first: that re-registers the socket, moving it to the end
+        sock.setsockopt(RxRing.SOL_PACKET, cls.PACKET_FANOUT, group | (cls.PACKET_FANOUT_HASH << 16))
+
+    def set_filter(self, program):
+        # Attach a classic BPF program (see bpf.py) to both NIC sockets
+        for sock in (self.alice_sock, self.bob_sock):
+            bpf.attach(sock, program)
+
+    def clear_filter(self):
+        for sock in (self.alice_sock, self.bob_sock):
+            bpf.detach(sock)
+
+    def make_reader(self, src, sock, mode):
+        # Build the reader callback for `sock` according to the ingest `mode`
+        if mode == "single":
+            def _read():
+                data = sock.recv(self.SNAPLEN)
+                self.dispatch(self.on_read(src, {}, data))
+        elif mode == "batch":
+            def _read():
+                frames = []
+                while len(frames) < self.BATCH_SIZE:
+                    try:
+                        frames.append(sock.recv(self.SNAPLEN))
+                    except BlockingIOError:
+                        break
+                if frames:
+                    self.dispatch(self.on_read_batch(src, frames))
+        elif mode == "ring":
+            ring = self.rings.get(src)
+            if ring is None:
+                ring = RxRing(sock)
+            def _read():
+                frames = ring.read(self.BATCH_SIZE)
+                if frames:
+                    self.dispatch(self.on_read_batch(src, frames))
         else:
+            raise Exception("Unknown ingest mode '{}', expected one of {}".format(mode, self.INGEST_MODES))
+        return _read
+
+    async def write(self, dst, header, data):
+        if dst not in self.tx_queues:
+            raise Exception("Bad destination")
+        self.tx_queues[dst].push(data)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        # Runs once per loop iteration in which frames were written
+        self.flush_scheduled = False
+        for queue in self.tx_queues.values():
+            if not queue.waiting and queue.flush():
+                # Backpressure: hold the rest until the socket is writable
+                queue.waiting = True
+                self.loop.add_writer(queue.sock.fileno(), self.drain, queue)
+
+    def drain(self, queue):
+        # Writer callback while `queue` is waiting on backpressure
+        if not queue.flush():
+            queue.waiting = False
+            self.loop.remove_writer(queue.sock.fileno())
+
+    def do_tx(self):
+        """Show transmit queue & backpressure statistics."""
+        output = ""
+        for dst, queue in sorted(self.tx_queues.items()):
+            output += "{} ({} queued now):\n".format("AB"[dst], len(queue.frames))
+            for key, value in sorted(queue.stats.items()):
+                output += " - {}: {}\n".format(key, value)
+        if _sendmmsg is None:
+            output += "(sendmmsg unavailable, sending one frame per syscall)\n"
+        return output
+
+class PcapLinkLayer(NetLayer):
+    # Drop-in replacement for LinkLayer which replays frames from pcap files
+    # (or a list of (src, frame) tuples) instead of reading live NICs, and
+    # optionally records whatever the tree writes out to pcap files.
+    # Needs neither root nor real interfaces; see bench.py
+    NAME = "link"
+    BATCH_SIZE = 64
+
+    ALICE = 0
+    BOB = 1
+
+    def __init__(self, alice_pcap=None, bob_pcap=None, *args, **kwargs):
+        frames = kwargs.pop("frames", None)
+        alice_out = kwargs.pop("alice_out", None)
+        bob_out = kwargs.pop("bob_out", None)
+        super(PcapLinkLayer, self).__init__(*args, **kwargs)
+
+        # Load everything up front so replay speed isn't bound by disk reads
+        timed = []
+        for src, path in ((self.ALICE, alice_pcap), (self.BOB, bob_pcap)):
+            if path is None:
+                continue
+            with open(path, "rb") as f:
+                for ts, buf in dpkt.pcap.Reader(f):
+                    timed.append((ts, src, buf))
+        timed.sort(key=lambda x: x[0])
+        self.frames = [(src, buf) for (ts, src, buf) in timed]
+        if frames is not None:
+            self.frames += list(frames)
+
+        self.writers = {}
+        for dst, path in ((self.ALICE, alice_out), (self.BOB, bob_out)):
+            if path is not None:
+                self.writers[dst] = dpkt.pcap.Writer(open(path, "wb"))
+
+        self.stats = {
+            "read_frames": 0,
+            "read_bytes": 0,
+            "written_frames": 0,
+            "written_bytes": 0,
+        }
+
+    # This layer is a SOURCE
+    # so it will never consume packets
+    def match(self, src, header):
+        return False
+
+    async def replay(self):
+        # Feed every frame into the tree as fast as the tree will take them,
+        # letting the event loop run once per batch
+        for i in range(0, len(self.frames), self.BATCH_SIZE):
+            tasks = []
+            for src, frame in self.frames[i:i + self.BATCH_SIZE]:
+                self.stats["read_frames"] += 1
+                self.stats["read_bytes"] += len(frame)
+                task = self.dispatch(self.on_read(src, {}, frame))
+                if task is not None:
+                    tasks.append(task)
+            if tasks:
+                await asyncio.wait(tasks)
+            await asyncio.sleep(0)
+
+    async def write(self, dst, header, data):
+        if dst not in (self.ALICE, self.BOB):
             raise Exception("Bad destination")
+        self.stats["written_frames"] += 1
+        self.stats["written_bytes"] += len(data)
+        if dst in self.writers:
+            self.writers[dst].writepkt(bytes(data))
+
+    def cleanup(self):
+        super(PcapLinkLayer, self).cleanup()
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+    def do_replay(self):
+        """Replay the loaded frames through the tree."""
+        self.dispatch(self.replay())
+        return "Replaying {} frames".format(len(self.frames))
@@ -0,0 +1,242 @@
+import struct
+
+import dpkt
+
+import checksum
+
+# Lightweight Ethernet / IPv4 / TCP / UDP parsing & building
+#
+# Parsing a frame with dpkt builds a full object for every protocol in it,
+# whether or not any layer ever looks. Here each protocol is a view of the
+# original frame: it only remembers where its bytes are, and reads a header
+# field (`struct.unpack_from`, no copies) the first time someone asks for it.
+# A frame that's only passed back out is written as the bytes it came in as.
+#
+# The views have the same field names as the dpkt classes (`pkt.sport`,
+# `pkt.flags`, `pkt.data`...). Going out, layers build each header straight
+# into one buffer, and the IP layer patches the checksums in place. A segment
+# forwarded with only header changes gets its checksum updated incrementally
+# (see `rewrite` & checksum.py), without summing the payload again.
+
+ETH_HEADER = struct.Struct("!6s6sH")
+IP_HEADER = struct.Struct("!BBHHHBBH4s4s")
+TCP_HEADER = struct.Struct("!HHIIHHHH")
+UDP_HEADER = struct.Struct("!HHHH")
+
+ETH_TYPE_IP = dpkt.ethernet.ETH_TYPE_IP
+IP_PROTO_TCP = dpkt.ip.IP_PROTO_TCP
+IP_PROTO_UDP = dpkt.ip.IP_PROTO_UDP
+
+# Where the checksum is in each transport header
+CHECKSUM_OFFSET = {
+    IP_PROTO_TCP: 16,
+    IP_PROTO_UDP: 6,
+}
+
+IP_OFFMASK = dpkt.ip.IP_OFFMASK
+IP_DEFAULT_TTL = 64
+
+class NeedData(Exception):
+    pass
+
+class View(object):
+    # The bytes buf[start:end] of a frame, seen as a protocol header + payload
+    # Header fields in HEADER_FIELDS are unpacked together, on first use
+    __slots__ = ("buf", "start", "end")
+
+    HEADER = None
+    HEADER_FIELDS = ()
+
+    def __init__(self, buf, start, end):
+        self.buf = buf
+        self.start = start
+        self.end = end
+
+    def __getattr__(self, name):
+        # Only called for fields that haven't been read yet
+        if name in self.HEADER_FIELDS:
+            for field, value in zip(self.HEADER_FIELDS, self.HEADER.unpack_from(self.buf, self.start)):
+                object.__setattr__(self, field, value)
+            return object.__getattribute__(self, name)
+        if name == "data":
+            # Kept, so a layer can tell its payload came back unchanged (`is`)
+            value = self.payload()
+            object.__setattr__(self, "data", value)
+            return value
+        raise AttributeError(name)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __bytes__(self):
+        return bytes(self.buf[self.start:self.end])
+
+class IPv4(View):
+    __slots__ = ("data", "hl", "v_hl", "tos", "len", "id", "_flags_offset", "ttl", "p", "sum", "src", "dst")
+
+    HEADER = IP_HEADER
+    HEADER_FIELDS = ("v_hl", "tos", "len", "id", "_flags_offset", "ttl", "p", "sum", "src", "dst")
+
+    def __init__(self, buf, off=0):
+        if len(buf) - off < IP_HEADER.size:
+            raise NeedData("short IPv4 header")
+        hl = (buf[off] & 0xf) << 2
+        if hl < IP_HEADER.size:
+            raise NeedData("invalid IPv4 header length")
+        length, = struct.unpack_from("!H", buf, off + 2)
+        # A length of 0 is very likely TCP segmentation offload
+        end = min(off + length, len(buf)) if length else len(buf)
+        if end < off + hl:
+            raise NeedData("short IPv4 packet")
+        super(IPv4, self).__init__(buf, off, end)
+        self.hl = hl
+
+    @property
+    def offset(self):
+        return (self._flags_offset & IP_OFFMASK) << 3
+
+    @property
+    def opts(self):
+        return bytes(self.buf[self.start + IP_HEADER.size:self.start + self.hl])
+
+    def payload(self):
+        # Transport view, or plain bytes if it can't be parsed (like dpkt)
+        off = self.start + self.hl
+        if self._flags_offset & IP_OFFMASK == 0:
+            try:
+                if self.p == IP_PROTO_TCP:
+                    return TCP(self.buf, off, self.end, self)
+                if self.p == IP_PROTO_UDP:
+                    return UDP(self.buf, off, self.end, self)
+            except NeedData:
+                pass
+        return bytes(self.buf[off:self.end])
+
+class Transport(View):
+    # TCP or UDP segment, inside the IPv4 view `ip`
+    __slots__ = ("ip",)
+
+    # Protocol number, & which of the HEADER_FIELDS is the checksum
+    PROTO = None
+    SUM_INDEX = None
+
+    def rewrite(self, src=None, dst=None, **fields):
+        # Copy of this segment with some header `fields` changed, and/or sent
+        # between other addresses `src` & `dst` (which are in the pseudo
+        # header). The checksum is updated for just the bytes that changed.
+        # A zero (unset) checksum is left for build_ipv4 to fill in.
+        old = self.HEADER.unpack_from(self.buf, self.start)
+        new = list(old)
+        for name, value in fields.items():
+            new[self.HEADER_FIELDS.index(name)] = value
+        cksum = old[self.SUM_INDEX]
+        if cksum:
+            # Both sides with the checksum field zeroed, as when it was computed
+            new[self.SUM_INDEX] = 0
+            before = self.HEADER.pack(*old[:self.SUM_INDEX], 0, *old[self.SUM_INDEX + 1:])
+            cksum = checksum.update(cksum,
+                    before + self.ip.src + self.ip.dst,
+                    self.HEADER.pack(*new) + (src or self.ip.src) + (dst or self.ip.dst))
+            if self.PROTO == IP_PROTO_UDP and cksum == 0:
+                cksum = 0xffff
+            new[self.SUM_INDEX] = cksum
+
+        out = bytearray(self.buf[self.start:self.end])
+        self.HEADER.pack_into(out, 0, *new)
+        return out
+
+class TCP(Transport):
+    __slots__ = ("data", "hl", "sport", "dport", "seq", "ack", "_off_flags", "win", "sum", "urp")
+
+    HEADER = TCP_HEADER
+    HEADER_FIELDS = ("sport", "dport", "seq", "ack", "_off_flags", "win", "sum", "urp")
+    SUM_INDEX = 6
+    PROTO = IP_PROTO_TCP
+
+    def __init__(self, buf, off, end, ip=None):
+        if end - off < TCP_HEADER.size:
+            raise NeedData("short TCP header")
+        hl = (buf[off + 12] >> 4) << 2
+        if hl < TCP_HEADER.size or off + hl > end:
+            raise NeedData("invalid TCP header length")
+        super(TCP, self).__init__(buf, off, end)
+        self.hl = hl
+        self.ip = ip
+
+    @property
+    def off(self):
+        # Header length in 32-bit words, like dpkt
+        return self.hl >> 2
+
+    @property
+    def flags(self):
+        return self._off_flags & 0x1ff
+
+    @property
+    def opts(self):
+        return bytes(self.buf[self.start + TCP_HEADER.size:self.start + self.hl])
+
+    def payload(self):
+        return bytes(self.buf[self.start + self.hl:self.end])
+
+class UDP(Transport):
+    __slots__ = ("data", "sport", "dport", "ulen", "sum")
+
+    HEADER = UDP_HEADER
+    HEADER_FIELDS = ("sport", "dport", "ulen", "sum")
+    SUM_INDEX = 3
+    PROTO = IP_PROTO_UDP
+
+    def __init__(self, buf, off, end, ip=None):
+        if end - off < UDP_HEADER.size:
+            raise NeedData("short UDP header")
+        super(UDP, self).__init__(buf, off, end)
+        self.ip = ip
+
+    def payload(self):
+        return bytes(self.buf[self.start + UDP_HEADER.size:self.end])
+
+def parse_ethernet(frame):
+    # (dst, src, type, payload) of an Ethernet II frame; the payload is an
+    # IPv4 view for IP frames, otherwise the raw bytes
+    if len(frame) < ETH_HEADER.size:
+        raise NeedData("short Ethernet header")
+    dst, src, eth_type = ETH_HEADER.unpack_from(frame)
+    if eth_type == ETH_TYPE_IP:
+        return dst, src, eth_type, IPv4(frame, ETH_HEADER.size)
+    return dst, src, eth_type, frame[ETH_HEADER.size:]
+
+def build_ethernet(dst, src, eth_type, payload):
+    if not isinstance(payload, (bytes, bytearray)):
+        payload = bytes(payload)
+    return ETH_HEADER.pack(dst, src, eth_type) + payload
+
+def build_ipv4(id, src, dst, p, payload, ttl=IP_DEFAULT_TTL):
+    # A new IPv4 packet (no options) around `payload`, a transport view or
+    # bytes. A zero TCP/UDP checksum is filled in, as dpkt does.
+    if isinstance(payload, Transport) and payload.ip is not None and (payload.ip.src, payload.ip.dst) != (src, dst):
+        # Forwarded to other addresses: patch the checksum for them
+        payload = payload.rewrite(src, dst)
+    if not isinstance(payload, (bytes, bytearray)):
+        payload = bytes(payload)
+    out = bytearray(IP_HEADER.pack(0x45, 0, IP_HEADER.size + len(payload), id, 0, ttl, p, 0, src, dst))
+    struct.pack_into("!H", out, 10, checksum.checksum(out))
+    out += payload
+
+    offset = CHECKSUM_OFFSET.get(p)
+    if offset is not None and len(payload) >= offset + 2 and payload[offset:offset + 2] == b"\0\0":
+        value = checksum.checksum(payload, checksum.pseudo_header_sum(src, dst, p, len(payload)))
+        if p == IP_PROTO_UDP and value == 0:
+            # RFC 768: zero means "no checksum"
+            value = 0xffff
+        struct.pack_into("!H", out, IP_HEADER.size + offset, value)
+    return out
+
+def build_tcp(sport, dport, seq, ack, flags, win, opts=b"", data=b""):
+    # TCP segment with a zero checksum, for build_ipv4 to fill in
+    hl = TCP_HEADER.size + len(opts)
+    return TCP_HEADER.pack(sport, dport, seq, ack, ((hl >> 2) << 12) | flags, win, 0, 0) + opts + bytes(data)
+
+def build_udp(sport, dport, data):
+    # UDP datagram with a zero checksum, for build_ipv4 to fill in
+    return UDP_HEADER.pack(sport, dport, UDP_HEADER.size + len(data), 0) + bytes(data)
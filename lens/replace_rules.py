@@ -0,0 +1,188 @@
+import re
+
+# Many byte replacements at once, for ByteReplaceLayer
+#
+# A RuleSet is a table of (old, new, count) rules: `old` is bytes (a literal)
+# or a compiled bytes regex, `new` is bytes (for a regex it can refer to
+# groups, as in re.sub), & `count` is how many matches to replace in each
+# message (-1 for all of them).
+#
+# All the rules are compiled into a single regex, so a payload is scanned
+# once, in C, however many rules there are. The literals go in as a trie
+# (ab|ac|b -> (?:a[bc]|b)): at each position the regex engine follows one
+# path down the trie, rather than trying every literal in turn -- the idea
+# behind an Aho-Corasick automaton, built out of what `re` has. Where matches
+# overlap the leftmost one wins, and of the literals starting there, the
+# longest. A rule whose count has run out stands aside: the match is tried
+# again at the same place with the rules still live (see `live_match`).
+#
+# A body can be fed to `replace` in pieces: only matches which are wholly
+# there are replaced, and what could still be the start of one is handed
+# back, to go in front of the next piece. Regex rules are taken to match at
+# most MAX_SPAN bytes, and shouldn't look behind the match (\b, ^, lookbehind)
+# -- there may be a piece boundary there -- or refer back to their own groups.
+
+MAX_SPAN = 1024
+
+def to_bytes(value):
+    # Rules typed into the shell come in as strings
+    return value.encode("utf-8") if isinstance(value, str) else value
+
+def trie_regex(literals):
+    # Regex source matching any of `literals` (longest first)
+    trie = {}
+    for literal in literals:
+        node = trie
+        for byte in literal:
+            node = node.setdefault(byte, {})
+        node[None] = None
+    return node_regex(trie)
+
+def node_regex(node):
+    branches = []
+    leaves = []
+    for byte in sorted(key for key in node if key is not None):
+        child = node[byte]
+        escaped = re.escape(bytes([byte]))
+        if list(child) == [None]:
+            leaves.append(escaped)
+        else:
+            branches.append(escaped + node_regex(child))
+    if leaves:
+        branches.append(leaves[0] if len(leaves) == 1 else b"[" + b"".join(leaves) + b"]")
+
+    source = branches[0] if len(branches) == 1 else b"(?:" + b"|".join(branches) + b")"
+    if None in node:
+        # A literal can end here too; the `?` is greedy, so longer ones win
+        source = b"(?:" + source + b")?"
+    return source
+
+# Flags a regex rule can bring with it, as inline flags
+INLINE_FLAGS = ((re.IGNORECASE, b"i"), (re.MULTILINE, b"m"), (re.DOTALL, b"s"), (re.VERBOSE, b"x"))
+
+class RuleSet(object):
+    def __init__(self, rules):
+        self.rules = []
+        # literal -> indexes of its rules, in order
+        self.literals = {}
+        # (rule index, regex) for the regex rules, in order
+        self.regexes = []
+        parts = []
+        self.span = 1
+        for index, (old, new, count) in enumerate(rules):
+            old, new, count = to_bytes(old), to_bytes(new), int(count)
+            self.rules.append((old, new, count))
+            if isinstance(old, bytes):
+                if not old:
+                    raise Exception("Empty pattern in rule {}".format(index))
+                # The first (live) rule for a literal wins
+                self.literals.setdefault(old, []).append(index)
+                self.span = max(self.span, len(old))
+            else:
+                flags = b"".join(letter for flag, letter in INLINE_FLAGS if old.flags & flag)
+                parts.append(b"(?" + flags + b":" + old.pattern + b")" if flags else b"(?:" + old.pattern + b")")
+                self.regexes.append((index, old))
+                self.span = max(self.span, MAX_SPAN)
+        if self.literals:
+            parts.insert(0, trie_regex(self.literals))
+        # Literal lengths, longest first, for `live_match`
+        self.lengths = sorted(set(len(literal) for literal in self.literals), reverse=True)
+        # No groups of its own to tell the rules apart: saving them costs the
+        # regex engine as much as the scan. See `rule`.
+        self.regex = re.compile(b"|".join(parts)) if parts else None
+        # Just the one literal: bytes.find beats any regex
+        self.single = next(iter(self.literals)) if len(self.literals) == 1 and not self.regexes else None
+
+    def counts(self):
+        # How many of each rule's matches are still to be replaced, for
+        # `replace`; one of these per message
+        return [count for old, new, count in self.rules]
+
+    def rule(self, data, match):
+        # Index of the rule which `match` (from self.regex) is for
+        # If any literal matches, the literals' alternative (which comes
+        # first) did: the longest of them. Otherwise it's the first regex
+        # rule that matches there.
+        indexes = self.literals.get(match.group())
+        if indexes is not None:
+            return indexes[0]
+        for index, regex in self.regexes:
+            if regex.match(data, match.start()):
+                return index
+        raise Exception("No rule for match {!r}".format(match.group()))
+
+    def search(self, data, pos):
+        # (start, end, rule index) of the first match in `data` from `pos`,
+        # or None
+        if self.single is not None:
+            start = data.find(self.single, pos)
+            if start < 0:
+                return None
+            return start, start + len(self.single), self.literals[self.single][0]
+        match = self.regex.search(data, pos)
+        if match is None:
+            return None
+        return match.start(), match.end(), self.rule(data, match)
+
+    def live_match(self, data, start, remaining):
+        # (end, rule index) of the match at `start` by the rules with some
+        # count left, or None: as for self.regex, the longest literal, else
+        # the first regex rule
+        for size in self.lengths:
+            for index in self.literals.get(data[start:start + size], ()):
+                if remaining[index]:
+                    return start + size, index
+        for index, regex in self.regexes:
+            if remaining[index]:
+                match = regex.match(data, start)
+                if match is not None:
+                    return match.end(), index
+        return None
+
+    def replace(self, data, remaining, final=True):
+        # Replace the matches in `data`, using up `remaining` (see `counts`)
+        # Returns (output, rest). Unless `final`, `rest` is the end of `data`
+        # which could yet be the start of a match: it's not in `output`, and
+        # goes in front of the next piece. If nothing was replaced in the
+        # whole of `data`, `output` is `data` itself.
+        if self.regex is None or not any(remaining):
+            return data, b""
+        # Matches starting before `limit` are all there
+        limit = len(data) if final else len(data) - self.span + 1
+        output = []
+        pos = 0
+        consumed = 0
+        found = self.search(data, 0)
+        while found is not None:
+            start, end, index = found
+            if start >= limit:
+                break
+            if remaining[index] == 0:
+                live = self.live_match(data, start, remaining)
+                if live is None:
+                    found = self.search(data, start + 1)
+                    continue
+                end, index = live
+            consumed = end
+            left = remaining[index]
+            if left > 0:
+                remaining[index] = left - 1
+            old, new, count = self.rules[index]
+            if not isinstance(old, bytes) and b"\\" in new:
+                # (re.sub caches the parsed template, Match.expand doesn't)
+                new = old.sub(new, data[start:end], 1)
+            output.append(data[pos:start])
+            output.append(new)
+            pos = end
+            if left == 1 and not any(remaining):
+                # Nothing more to replace
+                break
+            found = self.search(data, end if end > start else end + 1)
+
+        cut = len(data) if final else max(consumed, limit, 0)
+        if not output:
+            if cut == len(data):
+                return data, b""
+            return data[:cut], data[cut:]
+        output.append(data[pos:cut])
+        return b"".join(output), data[cut:]
@@ -0,0 +1,242 @@
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import os
+import signal
+
+import base_layer
+import link_layer
+import shell
+import stats
+
+# Flow-sharded mode: N worker processes behind the NICs
+#
+# The parent opens N sockets on each NIC and joins them to a PACKET_FANOUT
+# group, so the kernel spreads frames across them by (symmetric) flow hash.
+# It then forks one worker per pair of sockets; every worker has its own
+# event loop & its own copy of the layer graph, so per-connection state
+# (TCPLayer.connections, HTTPLayer.connections, ...) stays process-local.
+#
+# Both NICs' sockets are joined in worker order, and a flow hashes the same
+# way on either NIC, so both directions of a flow reach the same worker.
+#
+# The parent keeps the interactive shell, and forwards commands to every
+# worker (see ShardedShell).
+
+def worker_main(index, sockets, rings, conn, others, use_uvloop, link_kwargs):
+    # ^C goes to the whole process group; leave it to the parent's shell
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Only keep this worker's sockets & pipe, so nothing lingers in the
+    # fanout groups (or keeps a pipe open) when another process exits
+    for other in others:
+        other.close()
+    for i, pair in enumerate(sockets):
+        if i != index:
+            for sock in pair:
+                sock.close()
+            for ring in rings[i].values():
+                ring.ring.close()
+
+    loop = base_layer.install_event_loop(use_uvloop)
+    root = link_layer.LinkLayer(sockets=sockets[index], rings=rings[index], **link_kwargs)
+    Worker(index, root, conn)
+    try:
+        loop.run_forever()
+    finally:
+        root.cleanup()
+
+class Worker(object):
+    # Runs the shell commands the parent sends over `conn`
+    # Messages are tuples:
+    #   ("command", line) -> (output, filter program)
+    #   ("stats",)        -> {layer name: LayerStats}
+    #   ("quit",)
+    def __init__(self, index, root, conn):
+        self.index = index
+        self.conn = conn
+        self.shell = shell.CommandShell(root, None, interactive=False)
+        self.loop = asyncio.get_event_loop()
+        self.loop.add_reader(conn.fileno(), self.handle_message)
+
+    def handle_message(self):
+        try:
+            message = self.conn.recv()
+        except EOFError:
+            # The parent is gone
+            self.loop.stop()
+            return
+
+        if message[0] == "command":
+            self.conn.send((self.run_command(message[1]), self.shell.filter_program))
+        elif message[0] == "stats":
+            layers = self.shell.layers
+            self.conn.send({name: l.layer_stats for name, l in layers.items() if l.layer_stats is not None})
+        elif message[0] == "quit":
+            self.loop.stop()
+
+    def run_command(self, line):
+        # Commands print as well as return their output; capture both
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            try:
+                result = self.shell.run_command(line.split())
+            except shell.ShellQuit:
+                result = None
+        if result is not None:
+            output.write(str(result) + "\n")
+        return output.getvalue()
+
+class WorkerPool(object):
+    def __init__(self, count, alice_nic="br0", bob_nic="br1", use_uvloop=False, **link_kwargs):
+        # Fanout group ids are shared by the whole network namespace
+        alice_group = os.getpid() & 0xFFFF
+        bob_group = (alice_group + 1) & 0xFFFF
+
+        # Join every socket from here, in order, before any worker starts --
+        # a socket's place in its group decides which flows it gets
+        LinkLayer = link_layer.LinkLayer
+        nics = (
+            (LinkLayer.ALICE, alice_nic, alice_group, link_kwargs.get("alice_ingest")),
+            (LinkLayer.BOB, bob_nic, bob_group, link_kwargs.get("bob_ingest")),
+        )
+        sockets = []
+        rings = []
+        for i in range(count):
+            pair = []
+            rings.append({})
+            for src, nic, group, ingest in nics:
+                sock = LinkLayer.attach(nic)
+                if ingest == "ring":
+                    rings[i][src] = link_layer.RxRing(sock)
+                LinkLayer.join_fanout(sock, group)
+                pair.append(sock)
+            sockets.append(tuple(pair))
+
+        context = multiprocessing.get_context("fork")
+        self.workers = []
+        for i in range(count):
+            conn, child_conn = context.Pipe()
+            others = [c for p, c in self.workers] + [conn]
+            process = context.Process(target=worker_main, daemon=True,
+                    args=(i, sockets, rings, child_conn, others, use_uvloop, link_kwargs))
+            process.start()
+            child_conn.close()
+            self.workers.append((process, conn))
+
+        for pair in sockets:
+            for sock in pair:
+                sock.close()
+
+    def request(self, message):
+        # Send `message` to every worker, then wait for all their replies
+        # The reply is None for a worker which has exited
+        for process, conn in self.workers:
+            try:
+                conn.send(message)
+            except OSError:
+                pass
+        replies = []
+        for process, conn in self.workers:
+            try:
+                replies.append(conn.recv())
+            except (EOFError, OSError):
+                replies.append(None)
+        return replies
+
+    def stop(self):
+        for process, conn in self.workers:
+            try:
+                conn.send(("quit",))
+            except OSError:
+                pass
+        for process, conn in self.workers:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+
+class ShardedShell(shell.CommandShell):
+    # The interactive shell, in front of a WorkerPool
+    # Commands run in every worker; their output is merged
+
+    # Commands the parent runs itself
+    LOCAL_COMMANDS = ("quit", "driver", "workers")
+
+    def __init__(self, pool, driver):
+        self.pool = pool
+        self.bypass_program = None
+        super(ShardedShell, self).__init__(None, driver)
+
+    @property
+    def layers(self):
+        # The graph only exists in the workers
+        return {}
+
+    def run_command(self, arguments):
+        command = arguments[0].lower()
+        if command in self.LOCAL_COMMANDS:
+            return super(ShardedShell, self).run_command(arguments)
+        if command == "stats" and arguments[1:2] in ([], ["show"], ["dump"]):
+            return self.merge_stats(*arguments[1:])
+
+        replies = self.pool.request(("command", " ".join(arguments)))
+        self.update_bypass([r[1] for r in replies if r is not None])
+        outputs = [None if r is None else r[0] for r in replies]
+
+        if len(arguments) >= 2 and arguments[1].lower() == "list":
+            # Every worker only knows about its own share of the traffic
+            lines = []
+            for output in outputs:
+                for line in (output or "").splitlines():
+                    if line not in lines:
+                        lines.append(line)
+            return "\n".join(lines)
+        return self.merge_outputs(outputs)
+
+    def merge_outputs(self, outputs):
+        # Same output from every worker (e.g. "Loaded ...") is only shown once
+        if None not in outputs and len(set(outputs)) == 1:
+            return outputs[0].rstrip("\n") or None
+        result = ""
+        for i, output in enumerate(outputs):
+            if output is None:
+                output = "(exited)\n"
+            result += "[worker {}]\n{}".format(i, output)
+        return result.rstrip("\n")
+
+    def update_bypass(self, programs):
+        # Workers filter their own sockets; the in-kernel bypass is shared
+        # Every worker runs the same graph, so compiles the same program
+        program = programs[0] if programs else None
+        if program == self.bypass_program or self.driver is None:
+            return
+        if program is None:
+            self.driver.clear_bypass()
+        else:
+            self.driver.bypass(program)
+        self.bypass_program = program
+
+    def merge_stats(self, mode="show", filename=None):
+        merged = {}
+        for reply in self.pool.request(("stats",)):
+            for name, layer_stats in (reply or {}).items():
+                if name in merged:
+                    merged[name].merge(layer_stats)
+                else:
+                    merged[name] = layer_stats
+        if mode == "show":
+            if not merged:
+                return "Stats are off, use 'stats on'"
+            return stats.format_table(merged)
+        if filename is None:
+            return "Usage: stats dump <file>"
+        stats.dump(merged, filename)
+        return "Wrote stats to '{}' ({} workers)".format(filename, len(self.pool.workers))
+
+    def do_workers(self):
+        """workers - List worker processes."""
+        output = ""
+        for i, (process, conn) in enumerate(self.pool.workers):
+            output += " {}: pid {} ({})\n".format(i, process.pid, "running" if process.is_alive() else "exited")
+        return output
@@ -1,11 +1,13 @@
+import asyncio
 import fcntl
 import os
-from tornado.ioloop import IOLoop
 import traceback
 import sys
 import signal
 
 import base_layer
+import bpf
+import stats
 
 class ShellQuit(Exception):
     pass
@@ -14,27 +16,29 @@ class CommandShell(object):
     CMD_PREFIX = "do_"
     prompt = "> "
 
-    def __init__(self, root, driver):
+    def __init__(self, root, driver, interactive=True):
+        # `interactive` - read commands from stdin. Otherwise commands only
+        # come through `run_command` (see shard.py)
         self.input = sys.stdin
         self.output = sys.stdout
         self.driver = driver
 
-        fcntl.fcntl(self.output.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
-
         self.root = root
         self.layer_classes = base_layer.LayerMeta.layer_classes
         self.input_buffer = ""
+        self.filter_program = None
+        self.stats_enabled = False
 
-        self.ioloop = IOLoop.current()
-        self.ioloop.add_handler(self.input.fileno(), self.handle_input, IOLoop.READ)
+        self.loop = asyncio.get_event_loop()
+        if not interactive:
+            return
+
+        fcntl.fcntl(self.output.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
 
+        self.loop.add_reader(self.input.fileno(), self.handle_input)
 
-        def enable_sig_handler():
-            def _sig_handler(signum, frame):
-                self.ioloop.current().add_callback(self.sig_handler, signum, frame)
-            signal.signal(signal.SIGTERM, _sig_handler)
-            signal.signal(signal.SIGINT, _sig_handler)
-        self.ioloop.add_callback(enable_sig_handler)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, self.sig_handler, signum, None)
 
         self.write_prompt()
         base_layer.LayerMeta.instance_callback = self.instance_callback
@@ -82,12 +86,12 @@ class CommandShell(object):
         self.output.write(self.input_buffer)
         self.output.flush()
 
-    def handle_input(self, fd, events):
+    def handle_input(self):
         new_data = self.input.read()
 
         if new_data == "": # Ctrl-D
             self.output.write("\n")
-            self.ioloop.stop()
+            self.loop.stop()
             return
 
         self.input_buffer += new_data
@@ -106,6 +110,20 @@ class CommandShell(object):
             self.write_prompt()
             return
 
+        try:
+            result = self.run_command(arguments)
+        except ShellQuit:
+            self.loop.stop()
+            return
+
+        if result is not None:
+            self.output.write(str(result) + "\n")
+        self.write_prompt()
+
+    def run_command(self, arguments):
+        # Run a command, given as a list of words; returns its output
+        # Raises ShellQuit on 'quit'
+        arguments = list(arguments)
         layer, command = None, None
         command = arguments.pop(0).lower()
 
@@ -117,8 +135,7 @@ class CommandShell(object):
             try:
                 result = shell_fn(*arguments)
             except ShellQuit:
-                self.ioloop.stop()
-                return
+                raise
             except Exception as e:
                 result = traceback.format_exc()
         else:
@@ -143,9 +160,13 @@ class CommandShell(object):
             else:
                 result = "Invalid layer '{}'".format(layer)
 
-        if result is not None:
-            self.output.write(str(result) + "\n")
-        self.write_prompt()
+        if self.filter_program is not None:
+            self.update_filter()
+        if self.stats_enabled:
+            # Pick up any layers added since
+            for layer in self.layers.values():
+                layer.enable_stats()
+        return result
 
     def layer_name(self, layer):
         return {v: k for k, v in self.layers.items()}.get(layer, None)
@@ -271,3 +292,76 @@ class CommandShell(object):
             self.driver.passive()
         else:
             return "Invalid mode"
+
+    def update_filter(self):
+        # Recompile the kernel filter, reinstalling it if the tree changed
+        # If it can't be compiled or put in (too long, setsockopt or tc
+        # failing), it's turned off -- everything goes through lens again --
+        # rather than failing whatever command changed the tree
+        # Returns False if so
+        try:
+            program = bpf.compile_tree(self.root)
+            if program != self.filter_program:
+                # Start bypassing before dropping, so nothing falls in between
+                if self.driver is not None:
+                    self.driver.bypass(program)
+                self.root.set_filter(program)
+                self.filter_program = program
+        except Exception:
+            print("Filter: unable to update, turning it off\n" + traceback.format_exc())
+            self.remove_filter()
+            return False
+        return True
+
+    def remove_filter(self):
+        self.filter_program = None
+        self.root.clear_filter()
+        if self.driver is not None:
+            self.driver.clear_bypass()
+
+    def do_filter(self, mode="show"):
+        """filter on|off|show - Drop traffic no layer cares about in-kernel (BPF)."""
+        if mode == "on":
+            self.filter_program = []
+            if not self.update_filter():
+                return "Filter: off"
+            return "Filter: on ({} instructions)".format(len(self.filter_program))
+        elif mode == "off":
+            self.remove_filter()
+            return "Filter: off"
+        elif mode == "show":
+            return bpf.dump(bpf.compile_tree(self.root))
+        else:
+            return "Invalid mode"
+
+    def do_stats(self, mode="show", filename=None):
+        """stats on|off|reset|show|dump <file> - Per-layer calls, bytes & latency."""
+        layers = self.layers
+        if mode == "on":
+            self.stats_enabled = True
+            for layer in layers.values():
+                layer.enable_stats()
+            return "Stats: on"
+        elif mode == "off":
+            self.stats_enabled = False
+            for layer in layers.values():
+                layer.disable_stats()
+            return "Stats: off"
+        elif mode == "reset":
+            for layer in layers.values():
+                if layer.layer_stats is not None:
+                    layer.layer_stats.reset()
+            return "Stats: reset"
+
+        recorded = {name: l.layer_stats for name, l in layers.items() if l.layer_stats is not None}
+        if mode == "show":
+            if not recorded:
+                return "Stats are off, use 'stats on'"
+            return stats.format_table(recorded)
+        elif mode == "dump":
+            if filename is None:
+                return "Usage: stats dump <file>"
+            stats.dump(recorded, filename)
+            return "Wrote stats to '{}'".format(filename)
+        else:
+            return "Invalid mode"
@@ -0,0 +1,201 @@
+import asyncio
+import inspect
+import json
+import time
+import weakref
+
+# Per-layer instrumentation
+#
+# NetLayer.enable_stats() wraps a layer's on_read / write / bubble / write_back
+# with `Recorder`s, which count calls & bytes and keep a latency histogram for
+# each (method, direction). Nothing is wrapped while stats are disabled, so the
+# hot path is untouched.
+
+class Histogram(object):
+    # HDR-style log-linear histogram of integer values (nanoseconds here)
+    # Every power of two is split into 2**(SUB_BITS-1) linear buckets, so any
+    # recorded value is off by at most 1/2**(SUB_BITS-1) of itself.
+    SUB_BITS = 5
+    HALF = 1 << (SUB_BITS - 1)
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.max = 0
+
+    @classmethod
+    def index(cls, value):
+        bits = value.bit_length()
+        if bits <= cls.SUB_BITS:
+            return value
+        shift = bits - cls.SUB_BITS
+        return shift * cls.HALF + (value >> shift)
+
+    @classmethod
+    def value(cls, index):
+        # Lowest value that lands in bucket `index`
+        if index < 2 * cls.HALF:
+            return index
+        shift = index // cls.HALF - 1
+        return (index - shift * cls.HALF) << shift
+
+    def record(self, value):
+        i = self.index(value)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.total += 1
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, c in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + c
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        if not self.total:
+            return 0
+        target = self.total * p / 100.0
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= target:
+                return self.value(i)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "total": self.total,
+            "max": self.max,
+            "buckets": {str(self.value(i)): c for i, c in sorted(self.counts.items())},
+        }
+
+# Time spent in nested instrumented calls, so each call can also report the
+# time spent in itself ("self" time), excluding its children.
+# A stack per task: within a task the calls are strictly nested, but calls in
+# different tasks interleave whenever one has to wait. (A context variable
+# won't do: frames started from the same context share it, and so do tasks
+# started from inside a call.)
+_task_stacks = weakref.WeakKeyDictionary()
+# For calls made outside any task
+_no_task_stack = []
+
+def _call_stack():
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is None:
+        return _no_task_stack
+    stack = _task_stacks.get(task)
+    if stack is None:
+        stack = _task_stacks[task] = []
+    return stack
+
+class Recorder(object):
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+        self.self_ns = 0
+        self.latency = Histogram()
+
+    def reset(self):
+        self.__init__()
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.bytes += other.bytes
+        self.self_ns += other.self_ns
+        self.latency.merge(other.latency)
+
+    def wrap(self, fn):
+        async def _instrumented(direction, header, payload):
+            stack = _call_stack()
+            children = [0]
+            stack.append(children)
+            start = time.perf_counter_ns()
+            try:
+                # Latency includes any time spent waiting. Not every layer
+                # method returns a coroutine.
+                result = fn(direction, header, payload)
+                if inspect.isawaitable(result):
+                    result = await result
+                return result
+            finally:
+                elapsed = time.perf_counter_ns() - start
+                stack.pop()
+                self.self_ns += elapsed - children[0]
+                if stack:
+                    stack[-1][0] += elapsed
+                self.calls += 1
+                if payload is not None:
+                    try:
+                        self.bytes += len(payload)
+                    except TypeError:
+                        pass
+                self.latency.record(elapsed)
+        return _instrumented
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "bytes": self.bytes,
+            "self_ns": self.self_ns,
+            "latency_ns": self.latency.to_dict(),
+        }
+
+class LayerStats(object):
+    METHODS = ("on_read", "write", "bubble", "write_back")
+
+    def __init__(self, layer):
+        self.recorders = {}
+        for method in self.METHODS:
+            fn = getattr(layer, method)
+            recorders = {}
+            def _dispatch(direction, header, payload, _fn=fn, _recorders=recorders, _method=method):
+                # One recorder per direction, created on first use
+                if direction not in _recorders:
+                    recorder = self.recorders[(_method, direction)] = Recorder()
+                    _recorders[direction] = recorder.wrap(_fn)
+                return _recorders[direction](direction, header, payload)
+            setattr(layer, method, _dispatch)
+
+    @staticmethod
+    def remove(layer):
+        for method in LayerStats.METHODS:
+            layer.__dict__.pop(method, None)
+
+    def reset(self):
+        for recorder in self.recorders.values():
+            recorder.reset()
+
+    def merge(self, other):
+        # Add in another process' stats for the same layer (see shard.py)
+        for key, recorder in other.recorders.items():
+            if key not in self.recorders:
+                self.recorders[key] = Recorder()
+            self.recorders[key].merge(recorder)
+
+    def rows(self):
+        for (method, direction), r in sorted(self.recorders.items(), key=lambda x: (x[0][0], str(x[0][1]))):
+            if r.calls:
+                yield method, direction, r
+
+    def to_dict(self):
+        return {"{}:{}".format(method, direction): r.to_dict() for method, direction, r in self.rows()}
+
+def format_table(layers):
+    # `layers` - {name: LayerStats}
+    output = "{:20s} {:11s} {:>3s} {:>9s} {:>11s} {:>9s} {:>9s} {:>9s} {:>10s}\n".format(
+        "layer", "method", "dir", "calls", "bytes", "p50 us", "p99 us", "max us", "self ms")
+    for name, stats in sorted(layers.items()):
+        for method, direction, r in stats.rows():
+            output += "{:20s} {:11s} {:>3} {:9d} {:11d} {:9.1f} {:9.1f} {:9.1f} {:10.2f}\n".format(
+                name, method, direction, r.calls, r.bytes,
+                r.latency.percentile(50) / 1e3, r.latency.percentile(99) / 1e3, r.latency.max / 1e3,
+                r.self_ns / 1e6)
+    return output
+
+def dump(layers, filename):
+    with open(filename, "w") as f:
+        json.dump({name: stats.to_dict() for name, stats in layers.items()}, f, indent=2, sort_keys=True)
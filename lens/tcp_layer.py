@@ -1,11 +1,21 @@
+import bisect
 import collections
-import datetime
 import dpkt 
+import functools
 import struct
 import time
-from tornado import gen
 
+import checksum
+import packet
 from base_layer import NetLayer
+from flowtable import FlowTable
+from header import Header, pretty_ip, wire
+from tcp_stream import Reassembler, SendBuffer, seq_add, seq_diff, seq_le, seq_max
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 TCP_FLAGS = {
     "A": dpkt.tcp.TH_ACK,
@@ -44,20 +54,63 @@ def tcp_dump_opts(optlist):
 def tcp_has_payload(tcp_pkt):
     return bool(tcp_pkt.data)
 
+def tcp_splice_segment(pkt, seq_delta, ack_delta):
+    # Copy of the segment `pkt` (a packet.TCP view), with its seq moved on by
+    # `seq_delta` & its ack (and SACK blocks, which are acks too) moved back
+    # by `ack_delta`. The checksum is updated, not recalculated.
+    fields = {"seq": seq_add(pkt.seq, seq_delta)}
+    if pkt.flags & dpkt.tcp.TH_ACK:
+        fields["ack"] = seq_add(pkt.ack, -ack_delta)
+    seg = pkt.rewrite(**fields)
+    if not ack_delta or pkt.hl == packet.TCP_HEADER.size:
+        return seg
+
+    i = packet.TCP_HEADER.size
+    while i < pkt.hl and seg[i] != dpkt.tcp.TCP_OPT_EOL:
+        if seg[i] == dpkt.tcp.TCP_OPT_NOP:
+            i += 1
+            continue
+        if i + 1 >= pkt.hl or seg[i + 1] < 2:
+            break
+        if seg[i] == dpkt.tcp.TCP_OPT_SACK:
+            for j in range(i + 2, min(i + seg[i + 1], pkt.hl) - 3, 4):
+                edge, = struct.unpack_from("!I", seg, j)
+                struct.pack_into("!I", seg, j, seq_add(edge, -ack_delta))
+        i += seg[i + 1]
+    cksum, = struct.unpack_from("!H", seg, 16)
+    if cksum:
+        old = pkt.buf[pkt.start + packet.TCP_HEADER.size:pkt.start + pkt.hl]
+        struct.pack_into("!H", seg, 16, checksum.update(cksum, old, seg[packet.TCP_HEADER.size:pkt.hl]))
+    return seg
+
 # Connection
 def connection_id(pkt, header):
     # Generate a tuple representing the stream 
     # (source host addr, source port, dest addr, dest port)
-    return ((header["ip_src"], pkt.sport),
-            (header["ip_dst"], pkt.dport))
+    # Addresses are raw bytes (see header.py)
+    return ((wire(header, "ip_src"), pkt.sport),
+            (wire(header, "ip_dst"), pkt.dport))
 
 class TimestampEstimator(object):
+    # Estimates a host's TCP timestamp clock, from the TSvals it sends
+    #
+    # Only the last WINDOW samples are kept, and the rates between them are
+    # also kept sorted, so a new sample updates the median with a bisect
+    # (O(log n) compares, plus a memmove of at most WINDOW pointers) --
+    # a long connection costs the same per segment as a short one.
+    WINDOW = 64
+
     def __init__(self):
-        self.samples = []
+        # (local time, TSval), oldest first
+        self.samples = collections.deque(maxlen=self.WINDOW)
+        # Rate between each sample & the one before it, oldest first & sorted
+        self.deltas = collections.deque(maxlen=self.WINDOW - 1)
+        self.sorted_deltas = []
         self.offset = None
         self.rate = None
 
     def recalculate_lsq(self):
+        # Least squares fit over the window; NumPy does it in C, if installed
         if len(self.samples) < 1:
             return 
         if len(self.samples) == 1:
@@ -66,18 +119,26 @@ class TimestampEstimator(object):
             self.offset = l * -self.rate + s
             return
 
-        lta = sum(zip(*self.samples)[0]) / float(len(self.samples))
-        sta = sum(zip(*self.samples)[1]) / float(len(self.samples))
-
-        self.rate = sum([(l - lta) * (s - sta) for (l, s) in self.samples]) / sum([(l - lta) ** 2 for (l, s) in self.samples])
-        self.offset = sta - self.rate * lta
+        if numpy is not None:
+            ls, ss = numpy.array(self.samples, dtype=float).T
+            lta, sta = ls.mean(), ss.mean()
+            spread = ((ls - lta) ** 2).sum()
+            if spread:
+                self.rate = float(((ls - lta) * (ss - sta)).sum() / spread)
+        else:
+            ls, ss = zip(*self.samples)
+            lta = sum(ls) / float(len(ls))
+            sta = sum(ss) / float(len(ss))
+            spread = sum((l - lta) ** 2 for l in ls)
+            if spread:
+                self.rate = sum((l - lta) * (s - sta) for l, s in self.samples) / spread
+        if self.rate is not None:
+            self.offset = sta - self.rate * lta
 
     def recalculate_median(self):
-        if len(self.samples) < 2:
+        if len(self.sorted_deltas) < 1:
             return
-        deltas = [(s2 - s1) / (l2 - l1 + 0.1) for (l1, s1), (l2, s2) in zip(self.samples, self.samples[1:])]
-        deltas.sort()
-        self.rate = deltas[int(len(deltas) / 2)]
+        self.rate = self.sorted_deltas[len(self.sorted_deltas) // 2]
         # Skew down
         self.rate *= 0.50
 
@@ -89,7 +150,17 @@ class TimestampEstimator(object):
         if len(self.samples):
             l, s = self.samples[0]
             if s > sample:
-                self.samples = []
+                self.samples.clear()
+                self.deltas.clear()
+                self.sorted_deltas = []
+        if len(self.samples):
+            l, s = self.samples[-1]
+            delta = (sample - s) / (local_time - l + 0.1)
+            if len(self.deltas) == self.deltas.maxlen:
+                # The oldest rate drops out of the window
+                del self.sorted_deltas[bisect.bisect_left(self.sorted_deltas, self.deltas[0])]
+            self.deltas.append(delta)
+            bisect.insort(self.sorted_deltas, delta)
         self.samples.append((local_time, sample))
         self.recalculate_median()
 
@@ -111,20 +182,25 @@ class TimestampEstimator(object):
 class TCPFilterLayer(NetLayer):
     """ Simple TCP layer which will pass packets on certain TCP ports through """
     NAME = "tcp_filter"
+    TRANSPARENT = True
 
     def __init__(self, *args, **kwargs):
         super(TCPFilterLayer, self).__init__(**kwargs)
-        self.ports = [int(a) for a in args]
+        self.ports = {int(a) for a in args}
 
     def match(self, src, header):
-        x = header["tcp_conn"][1][1] in self.ports or header["tcp_conn"][0][1] in self.ports
-        return x
+        # `header` may be a plain dict (see header.py)
+        conn = header.get("tcp_conn")
+        return conn is not None and (conn[1][1] in self.ports or conn[0][1] in self.ports)
+
+    def match_keys(self):
+        return {"tcp_port": set(self.ports)}
 
 # Half Connection attributes
 # From the perspective of sending packets back through the link
 #
 # eth_src / eth_dst - Ethernet source/dest MAC addrs
-# ip_src / ip_dst - IP address of source / dest
+# ip_src / ip_dst - IP address of source / dest (raw bytes, see header.py)
 # ip_ttl - IP TTL value
 # sport / dport - TCP ports source / dest
 # state - closed, opening, open, closing
@@ -138,39 +214,72 @@ class TCPLayer(NetLayer):
     DEFAULT_MSS = 536
     MAX_MSS = 1400
 
+    # Bounds on self.connections & self.timers (see flowtable.py)
+    MAX_CONNECTIONS = 65536
+    MAX_HOSTS = 16384
+    # Seconds without a segment before a connection is dropped
+    IDLE_TIMEOUT = 600.0
+    # Once both halves are in one of these states, seconds until the
+    # connection is dropped. CLOSED lingers a while to soak up retransmitted
+    # FINs & ACKs, like TIME-WAIT.
+    CLOSE_TIMEOUTS = {
+        "RESET": 5.0,
+        "CLOSED": 30.0,
+    }
+    # Retransmission timeout, in seconds (RFC 6298): doubled every time it
+    # runs out, back to RTO_INITIAL once the peer ACKs something new. The
+    # connection is dropped after MAX_RETRANSMITS timeouts in a row.
+    RTO_INITIAL = 1.0
+    RTO_MAX = 60.0
+    MAX_RETRANSMITS = 8
+    # Duplicate ACKs which mean a segment was lost (RFC 5681 3.2)
+    DUP_ACKS = 3
+    # Most an ACK for received data is held back, waiting for a second
+    # segment or a reply to go with it (RFC 1122 4.2.3.2)
+    DELAYED_ACK = 0.1
+
     def __init__(self, *args, **kwargs):
-        self.connections = {}
-        self.timers = collections.defaultdict(TimestampEstimator)
+        self.connections = FlowTable(self.MAX_CONNECTIONS, self.IDLE_TIMEOUT, on_evict=self.evict_connection)
+        self.timers = FlowTable(self.MAX_HOSTS, self.IDLE_TIMEOUT, factory=TimestampEstimator)
+        self.connection_count = 0
         super(TCPLayer, self).__init__(*args, **kwargs)
+        # Hold back short segments while data is unACKed
+        self.make_toggle("nagle", True)
+        # Pass connections no child wants straight through
+        self.make_toggle("forward", True)
 
     def match(self, src, header):
-        return header["ip_p"] == dpkt.ip.IP_PROTO_TCP
+        return header.get("ip_p") == dpkt.ip.IP_PROTO_TCP
+
+    def match_keys(self):
+        return {"ip_p": {dpkt.ip.IP_PROTO_TCP}}
 
     def do_list(self):
         """List open TCP connections."""
-        print("Open TCP Connections ({}):".format(len(self.connections)))
+        forwarded = sum(1 for conn in self.connections.values() if conn.get("mode") == "forward")
+        print("Open TCP Connections ({}, {} forwarded):".format(len(self.connections) - forwarded, forwarded))
         for conn_id, conn in sorted(self.connections.items(), key=lambda x: x[1]["count"]):
+            if conn.get("mode") == "forward":
+                continue
             fdict = {}
             sender = conn[conn["sender"]]
             receiver = conn[conn["receiver"]]
             for hconn in (sender, receiver):
                 rel_seq = hconn.get('seq', -1) - hconn.get('seq_start', -1)
                 rel_ack = hconn.get('ack', -1) - hconn.get('ack_start', -1)
-                ip_src = hconn.get("ip_src", "(no ip)")
+                ip_src = pretty_ip(hconn["ip_src"]) if "ip_src" in hconn else "(no ip)"
                 port = hconn.get("sport", -1)
                 state = hconn.get("state", "no-state")
                 hconn["_debug"] = "{ip_src}:{port} [{state} S={seq} A={ack}]".format(ip_src=ip_src, port=port, state=state, seq=rel_seq, ack=rel_ack)
-            print(" - {0} --> {1}".format(sender["_debug"], receiver["_debug"]))
+            print(" - {0} --> {1}{2}".format(sender["_debug"], receiver["_debug"], " (spliced)" if conn.get("mode") == "splice" else ""))
 
-    @gen.coroutine
-    def on_read(self, src, header, payload):
+    async def on_read(self, src, header, payload):
+        if not isinstance(payload, packet.TCP):
+            # Couldn't be parsed (see packet.py)
+            return await self.passthru(src, header, payload)
         pkt = payload
         #print("TCP segment data:" + str([hex(x) for x in bytes(pkt.data)]))
 
-        #TODO: validate checksums / packet
-        tcp_opts = dpkt.tcp.parse_opts(pkt.opts)
-        tcp_opts_dict = dict(tcp_opts)
-
         dst = self.route(src, header)
         #conn_id = connection_id(pkt)
         conn_id = connection_id(pkt, header)
@@ -180,19 +289,33 @@ class TCPLayer(NetLayer):
             conn_id = conn_id[::-1]
             conn = self.connections[conn_id]
         elif conn_id not in self.connections:
-            # conn_id[0] corresponds to conn[conn["server"]]
-            # conn_id[1] corresponds to conn[conn["receiver"]]
-            conn = {src: {}, dst: {}, "count": len(self.connections), "sender": src, "receiver": dst}
+            if pkt.flags & (dpkt.tcp.TH_SYN | dpkt.tcp.TH_ACK) == dpkt.tcp.TH_SYN and self.intercepts(src, dst, conn_id):
+                # conn_id[0] corresponds to conn[conn["server"]]
+                # conn_id[1] corresponds to conn[conn["receiver"]]
+                conn = {src: {}, dst: {}, "count": self.connection_count, "sender": src, "receiver": dst,
+                        "splice": functools.partial(self.request_splice, conn_id)}
+            else:
+                # Nobody wants it, or it started before we were around to see
+                # the SYN: just keep track of when it closes
+                conn = {"mode": "forward", "count": self.connection_count, "fins": 0}
+            self.connection_count += 1
             self.connections[conn_id] = conn
         else:
             conn = self.connections[conn_id]
 
+        if "mode" in conn:
+            return await self.forward_segment(src, dst, header, pkt, conn_id, conn)
+
+        #TODO: validate checksums / packet
+        tcp_opts = dpkt.tcp.parse_opts(pkt.opts)
+        tcp_opts_dict = dict(tcp_opts)
+
 
         src_conn = conn[src]
         dst_conn = conn[dst]
 
-        host_ip = header["ip_src"]
-        dest_ip = header["ip_dst"]
+        host_ip = wire(header, "ip_src")
+        dest_ip = wire(header, "ip_dst")
 
         # Update timestamps
         if dpkt.tcp.TCP_OPT_TIMESTAMP in tcp_opts_dict:
@@ -200,11 +323,31 @@ class TCPLayer(NetLayer):
             dst_conn['last_ts_val'] = dst_conn.get('ts_val', 0)
             #dst_conn['ts_val'] = ts_val
             src_conn['ts_ecr'] = ts_val
-            t = self.timers[host_ip].get_time()
             self.timers[host_ip].put_sample(ts_val)
         else:
             ts_val, ts_ecr = None, None
 
+        if pkt.flags & dpkt.tcp.TH_ACK and "unacked" in src_conn:
+            # A duplicate ACK (RFC 5681 2) carries nothing new: no data, no
+            # SYN/FIN, the same ACK number & the same window as the last one
+            # -- so a window update doesn't count
+            duplicate = (not tcp_has_payload(pkt) and not pkt.flags & (dpkt.tcp.TH_SYN | dpkt.tcp.TH_FIN)
+                         and pkt.ack == src_conn.get("last_ack")
+                         and pkt.win << src_conn.get("window_scale", 0) == src_conn.get("snd_wnd"))
+            src_conn["last_ack"] = pkt.ack
+            if not pkt.flags & dpkt.tcp.TH_SYN:
+                # How much `src` will take (the window in a SYN is never scaled)
+                src_conn["snd_wnd"] = pkt.win << src_conn.get("window_scale", 0)
+            if dpkt.tcp.TCP_OPT_SACK in tcp_opts_dict:
+                self.sacked(src_conn, tcp_opts_dict[dpkt.tcp.TCP_OPT_SACK])
+            self.acked(src, conn_id, pkt.ack, duplicate=duplicate)
+            if src_conn["out_buffer"]:
+                # The window may have moved on
+                await self.flush(src, conn_id)
+        if "win" in dst_conn and not pkt.flags & dpkt.tcp.TH_SYN:
+            # Advertise the window of `src` to the other side
+            dst_conn["win"] = pkt.win
+
         if self.debug:
             self.log("TCP {}{} {} {:.3f} {}:{:<5}->{}:{:<5} {:<4} seq={:<3} ({:<10}) ack={:<3} ({:<10}) data=[{:<4}]{:8} tsval={} tsecr={}",
                     "AB"[src], "->",
@@ -226,22 +369,34 @@ class TCPLayer(NetLayer):
                 )
 
         if tcp_has_payload(pkt):
-            if src_conn.get("state") == "ESTABLISHED":
+            # Data can still come in after we sent `src` a FIN (half close)
+            if src_conn.get("state") in ("ESTABLISHED", "FIN-WAIT-1"):
                 data = pkt.data
                 src_conn["payload_sizes"][len(data)] += 1
-                src_conn["in_buffer"] += data
-                src_conn["ack"] += len(data)
+                ready = src_conn["in_buffer"].add(pkt.seq, data)
+                src_conn["ack"] = src_conn["in_buffer"].next
+                src_conn["ack_pending"] += 1
 
-                # ACK the data
-                yield self.write_packet(src, conn_id, flags="A")
+                # Bubble up whatever is now in order to next layer
+                for data in ready:
+                    await self.bubble(src, Header(tcp_conn=conn_id, tcp_splice=conn["splice"]), data)
 
-                # Bubble up data to next layer
-                yield self.bubble(src, {"tcp_conn": conn_id}, data)
+                # ACK the data, unless a reply on its way back already did.
+                # Out of order data (a duplicate ACK), or data filling a gap,
+                # is ACKed right away (RFC 5681 4.2)
+                await self.ack_data(src, conn_id, immediate=len(ready) != 1 or len(src_conn["in_buffer"]) > 0)
 
 
         if pkt.flags & dpkt.tcp.TH_SYN:
             # Assume we aren't redirecting the traffic to a different IP, just modifying the contents
 
+            # A SYN again (retransmitted, or the tuple reused): the timers of
+            # what was set up before mustn't go off on the state set up now,
+            # nor its close timeout evict it
+            self.stop_timers(dst_conn)
+            self.stop_timers(src_conn)
+            self.connections.unexpire(conn_id)
+
             dst_conn["ip_header"] = header
             dst_conn["ip_src"] = host_ip
             dst_conn["ip_dst"] = dest_ip
@@ -250,14 +405,25 @@ class TCPLayer(NetLayer):
             dst_conn["win"] = pkt.win
             dst_conn["syn_options"] = {}
 
-            dst_conn["out_buffer"] = bytes()
-            dst_conn["in_buffer"] = bytes()
-            dst_conn["unacked"] = []
+            dst_conn["out_buffer"] = SendBuffer()
+            # (seq, payload) of every segment sent but not ACKed yet
+            dst_conn["unacked"] = collections.deque()
+            # Seqs of unacked segments the peer has SACKed
+            dst_conn["sacked"] = set()
+            dst_conn["dupacks"] = 0
+            dst_conn["rto"] = self.RTO_INITIAL
+            dst_conn["retransmits"] = 0
+            dst_conn["rtx_timer"] = None
 
             dst_conn["seq"] = pkt.seq
-            src_conn["ack"] = pkt.seq + 1
-
-            dst_conn["window_scale"] = 0
+            src_conn["ack"] = seq_add(pkt.seq, 1)
+            src_conn["in_buffer"] = Reassembler(src_conn["ack"])
+            # Sequence number of a FIN from `src` not taken in yet
+            src_conn["fin_seq"] = None
+            # Segments received since `src` was last sent an ACK
+            src_conn["ack_pending"] = 0
+            src_conn["ack_timer"] = None
+            src_conn["snd_wnd"] = pkt.win
 
             # For relative sequence nums
             dst_conn["seq_start"] = pkt.seq 
@@ -273,10 +439,20 @@ class TCPLayer(NetLayer):
                 src_conn["max_segment_size"] = max(1, min(min(mss_request), self.MAX_MSS))
                 dst_conn["syn_options"][dpkt.tcp.TCP_OPT_MSS] = struct.pack("!H", src_conn["max_segment_size"])
 
+            # Window scale (RFC 7323 2): only in use if both SYNs have it
+            src_conn["window_scale"] = 0
             if dpkt.tcp.TCP_OPT_WSCALE in tcp_opts_dict:
-                wscale = struct.unpack('!B', tcp_opts_dict[dpkt.tcp.TCP_OPT_WSCALE])
-                src_conn["window_scale"] = wscale
+                wscale, = struct.unpack('!B', tcp_opts_dict[dpkt.tcp.TCP_OPT_WSCALE])
+                src_conn["window_scale"] = min(wscale, 14)
                 dst_conn["syn_options"][dpkt.tcp.TCP_OPT_WSCALE] = tcp_opts_dict[dpkt.tcp.TCP_OPT_WSCALE]
+            elif pkt.flags & dpkt.tcp.TH_ACK:
+                dst_conn["window_scale"] = 0
+
+            # `src` takes SACK options (RFC 2018); pass that on, so the other
+            # side can send us some as well
+            src_conn["sack_ok"] = dpkt.tcp.TCP_OPT_SACKOK in tcp_opts_dict
+            if src_conn["sack_ok"]:
+                dst_conn["syn_options"][dpkt.tcp.TCP_OPT_SACKOK] = b""
 
 
 # A           | D_sender    | D_receiver  | B
@@ -308,37 +484,20 @@ class TCPLayer(NetLayer):
                 
                 # Forward SYNACK
                 dst_conn["state"] = "SYN-RECIEVED"
-                yield self.write_packet(dst, conn_id, flags="SA")
+                await self.write_packet(dst, conn_id, flags="SA")
             else:
                 dst_conn["state"] = "SYN-SENT"
                 # Forward SYN
-                yield self.write_packet(dst, conn_id, flags="S")
+                await self.write_packet(dst, conn_id, flags="S")
 
         if pkt.flags & dpkt.tcp.TH_FIN:
-            if src_conn.get("state") == "ESTABLISHED":
-                src_conn["ack"] += 1
-                src_conn["state"] = "LAST-ACK"
-                if dst_conn.get("state") == "ESTABLISHED":
-                    dst_conn["state"] = "FIN-WAIT-1"
-                    # Forward FIN - nope! send a close msg
-                    yield self.close_bubble(src, {"tcp_conn": conn_id, "reset": False})
-                    yield self.write_packet(dst, conn_id, flags="FA")
-                    dst_conn["seq"] += 1
-
-                # Reply with FINACK 
-                yield self.write_packet(src, conn_id, flags="FA")
-                src_conn["seq"] += 1 
-
-            elif src_conn.get("state") == "FIN-WAIT-1":
-                src_conn["ack"] += 1
-                src_conn["state"] = "CLOSED"
-
-                # Reply with ACK 
-                yield self.write_packet(src, conn_id, flags="A")
-
-                # Bubble up close event
-                yield self.close_bubble(src, {"tcp_conn": conn_id, "reset": False})
-                #TODO: prune connection obj
+            if src_conn.get("state") in ("ESTABLISHED", "FIN-WAIT-1"):
+                # The FIN comes after the segment's data, and only counts once
+                # everything before it is in (see `fin_in_order`)
+                src_conn["fin_seq"] = seq_add(pkt.seq, len(pkt.data))
+                if not tcp_has_payload(pkt) and not self.fin_in_order(src_conn):
+                    # From past a gap: show the sender where it is
+                    await self.write_packet(src, conn_id, flags="A")
 
         elif pkt.flags & dpkt.tcp.TH_ACK:
             if src_conn.get("state") == "SYN-RECIEVED":
@@ -346,18 +505,20 @@ class TCPLayer(NetLayer):
                 self.log("TCP established complete @{}", src)
 
             if src_conn.get("state") == "ESTABLISHED":
-                src_conn["seq"] = max(src_conn.get('seq'), pkt.ack)
+                src_conn["seq"] = seq_max(src_conn.get('seq'), pkt.ack)
                 # We don't need to ACK the ACK unless it's a SYNACK
                 if pkt.flags & dpkt.tcp.TH_SYN:
-                    yield self.write_packet(src, conn_id, flags="A")
+                    await self.write_packet(src, conn_id, flags="A")
 
             if src_conn.get("state") == "LAST-ACK":
                 src_conn["state"] = "CLOSED"
 
                 # Bubble up close event - already closed!
-                #yield self.close_bubble(src, {"tcp_conn": conn_id, "reset": False})
+                #await self.close_bubble(src, Header(tcp_conn=conn_id, reset=False))
                 #TODO: prune connection obj
 
+        if self.fin_in_order(src_conn):
+            await self.receive_fin(src, dst, conn_id)
 
         if pkt.flags & dpkt.tcp.TH_RST:
             if "state" in src_conn and dst_conn.get("state"): # If it's already been reset, just passthru
@@ -365,43 +526,317 @@ class TCPLayer(NetLayer):
                 self.log("RST on MiTM connection {} {}", src_conn["state"], dst_conn.get("state"))
                 dst_conn["state"] = "RESET"
                 src_conn["state"] = "CLOSED"
+                self.stop_timers(dst_conn)
+                self.stop_timers(src_conn)
                 if "seq" not in dst_conn:
                     self.log('invalid RST {}', dst_conn)
                 if 'seq' in dst_conn:
                     # Forward RST
-                    yield self.write_packet(dst, conn_id, flags="R")
+                    await self.write_packet(dst, conn_id, flags="R")
                 else:
-                    yield self.passthru(src, header, payload)
+                    await self.passthru(src, header, payload)
 
                 # Bubble up close event
-                yield self.close_bubble(src, {"tcp_conn": conn_id, "reset": True})
+                await self.close_bubble(src, Header(tcp_conn=conn_id, reset=True))
                 #TODO: prune connection obj
             else:
                 # This isn't on a actively modified connection, passthru
                 self.log("RST passthru")
-                yield self.passthru(src, header, payload)
+                await self.passthru(src, header, payload)
+
+        states = (src_conn.get("state"), dst_conn.get("state"))
+        if all(state in self.CLOSE_TIMEOUTS for state in states):
+            self.connections.expire(conn_id, max(self.CLOSE_TIMEOUTS[state] for state in states))
+        elif conn.get("splice_requested"):
+            await self.splice(conn_id, conn)
 
         if "state" not in dst_conn: # Not handled
-            yield self.passthru(src, header, payload)
+            await self.passthru(src, header, payload)
 
+    @staticmethod
+    def fin_in_order(conn):
+        # Has `conn` sent a FIN, with nothing missing or held before it?
+        in_buffer = conn.get("in_buffer")
+        return conn.get("fin_seq") is not None and in_buffer.next == conn["fin_seq"] and not len(in_buffer)
 
-    @gen.coroutine
-    def write_packet(self, dst, conn_id, flags="A"):
+    async def receive_fin(self, src, dst, conn_id):
+        # `src` is done sending, and we have everything it sent
+        conn = self.connections[conn_id]
+        src_conn = conn[src]
+        dst_conn = conn[dst]
+        src_conn["fin_seq"] = None
+        if src_conn.get("state") == "ESTABLISHED":
+            src_conn["ack"] = seq_add(src_conn["ack"], 1)
+            src_conn["in_buffer"].advance(1)
+            src_conn["state"] = "LAST-ACK"
+            if dst_conn.get("state") == "ESTABLISHED":
+                dst_conn["state"] = "FIN-WAIT-1"
+                # Forward FIN - nope! send a close msg
+                await self.close_bubble(src, Header(tcp_conn=conn_id, reset=False))
+                await self.send_fin(dst, conn_id)
+
+            # Reply with FINACK 
+            await self.send_fin(src, conn_id)
+
+        elif src_conn.get("state") == "FIN-WAIT-1":
+            src_conn["ack"] = seq_add(src_conn["ack"], 1)
+            src_conn["in_buffer"].advance(1)
+            src_conn["state"] = "CLOSED"
+
+            # Reply with ACK 
+            await self.write_packet(src, conn_id, flags="A")
+
+            # Bubble up close event
+            await self.close_bubble(src, Header(tcp_conn=conn_id, reset=False))
+            #TODO: prune connection obj
+
+    def evict_connection(self, conn_id, conn):
+        # Dropped from self.connections; whatever the layers above kept for
+        # it has to go too
+        if conn.get("mode") == "forward":
+            return
+        self.stop_timers(conn[conn["sender"]])
+        self.stop_timers(conn[conn["receiver"]])
+        self.on_evict(Header(tcp_conn=conn_id))
+
+    def intercepts(self, src, dst, conn_id):
+        # Does any child want the data of a connection just being opened,
+        # either way? If not, it's forwarded as it is, never terminated
+        if not self.forward:
+            return True
+        header = Header(tcp_conn=conn_id)
+        return self.resolve_child(src, header) is not None or self.resolve_child(dst, header) is not None
+
+    async def forward_segment(self, src, dst, header, pkt, conn_id, conn):
+        # Segment of a connection that isn't (or is no longer) terminated
+        # here. Forwarded ones go out as they came in; spliced ones are moved
+        # into the sequence numbers the other side was shown (see `splice`)
+        if pkt.flags & dpkt.tcp.TH_RST:
+            self.connections.expire(conn_id, self.CLOSE_TIMEOUTS["RESET"])
+        elif pkt.flags & dpkt.tcp.TH_SYN:
+            # Opened again, after it closed
+            self.connections.unexpire(conn_id)
+            conn["fins"] = 0
+        elif pkt.flags & dpkt.tcp.TH_FIN:
+            conn["fins"] |= 1 << src
+            if conn["fins"] == 3:
+                self.connections.expire(conn_id, self.CLOSE_TIMEOUTS["CLOSED"])
+
+        if conn["mode"] == "splice":
+            pkt = tcp_splice_segment(pkt, conn[dst]["splice_delta"], conn[src]["splice_delta"])
+        await self.passthru(src, header, pkt)
+
+    def request_splice(self, conn_id):
+        # header["tcp_splice"]() -- for a child which is done changing this
+        # connection's data: have it spliced, as soon as it can be
+        conn = self.connections.peek(conn_id)
+        if conn is not None:
+            conn["splice_requested"] = True
+
+    async def splice(self, conn_id, conn):
+        # Stop terminating an intercepted connection, once nothing's left
+        # buffered or unACKed either way. From then on each segment is only
+        # shifted by how much the stream was lengthened (or shortened) so
+        # far, see `forward_segment`
+        halves = (conn[conn["sender"]], conn[conn["receiver"]])
+        for half in halves:
+            if half.get("state") != "ESTABLISHED" or half["out_buffer"] or half["unacked"] or len(half["in_buffer"]) or half.get("fin_pending") or half.get("fin_seq") is not None:
+                return
+        for side in (conn["sender"], conn["receiver"]):
+            if conn[side]["ack_pending"]:
+                await self.write_packet(side, conn_id, flags="A")
+        for to, other in (halves, halves[::-1]):
+            # Segments to `to` come from `other`
+            to["splice_delta"] = seq_diff(to["seq"], other["ack"])
+            self.stop_timers(to)
+        conn["mode"] = "splice"
+        conn["fins"] = 0
+        self.log("TCP {} spliced", conn["count"])
+
+    @staticmethod
+    def in_flight(conn):
+        # Bytes sent but not ACKed yet
+        unacked = conn["unacked"]
+        return seq_diff(conn["seq"], unacked[0][0]) if unacked else 0
+
+    def acked(self, dst, conn_id, ack, duplicate=False):
+        # `dst` ACKed up to `ack`: forget the segments that covers, and
+        # restart the retransmission timer for the rest
         conn = self.connections[conn_id][dst]
-        header = conn["ip_header"]
-        payload = None
+        unacked = conn["unacked"]
+        if not unacked:
+            return
+        if not seq_le(seq_add(unacked[0][0], len(unacked[0][1])), ack):
+            if duplicate and ack == unacked[0][0]:
+                conn["dupacks"] += 1
+                if conn["dupacks"] == self.DUP_ACKS:
+                    self.dispatch(self.resend_holes(dst, conn_id))
+            return
+        while unacked and seq_le(seq_add(unacked[0][0], len(unacked[0][1])), ack):
+            conn["sacked"].discard(unacked.popleft()[0])
+        conn["dupacks"] = 0
+        conn["rto"] = self.RTO_INITIAL
+        conn["retransmits"] = 0
+        self.stop_retransmit(conn)
+        if unacked:
+            self.start_retransmit(dst, conn_id, conn)
+
+    def sacked(self, conn, option):
+        # SACK blocks from the peer (RFC 2018): unACKed segments it has
+        # anyway, past a gap
+        blocks = [struct.unpack_from("!II", option, i) for i in range(0, len(option) - 7, 8)]
+        for seq, payload in conn["unacked"]:
+            end = seq_add(seq, len(payload))
+            if any(seq_le(left, seq) and seq_le(end, right) for left, right in blocks):
+                conn["sacked"].add(seq)
+
+    async def resend_holes(self, dst, conn_id):
+        # Fast retransmit: resend every segment the peer hasn't SACKed, up to
+        # the last one it has -- or just the first, without SACK
+        conn = self.connections.peek(conn_id)
+        if conn is None:
+            return
+        conn = conn[dst]
+        segments = list(conn["unacked"])
+        sacked = conn["sacked"]
+        if sacked:
+            last = max(i for i, (seq, payload) in enumerate(segments) if seq in sacked)
+            holes = [(seq, payload) for seq, payload in segments[:last] if seq not in sacked]
+        else:
+            holes = segments[:1]
+        for seq, payload in holes:
+            await self.send_segment(dst, conn_id, seq, "AP", payload)
+
+    def start_retransmit(self, dst, conn_id, conn):
+        if conn["rtx_timer"] is None:
+            conn["rtx_timer"] = self.call_later(conn["rto"], self.retransmit, dst, conn_id)
+
+    def stop_retransmit(self, conn):
+        if conn.get("rtx_timer") is not None:
+            conn["rtx_timer"].cancel()
+            conn["rtx_timer"] = None
+
+    def stop_timers(self, conn):
+        self.stop_retransmit(conn)
+        if conn.get("ack_timer") is not None:
+            conn["ack_timer"].cancel()
+            conn["ack_timer"] = None
+
+    def retransmit(self, dst, conn_id):
+        # Retransmission timer ran out: resend the oldest unACKed segment
+        # (peek, so this doesn't count as activity on the connection)
+        conn = self.connections.peek(conn_id)
+        if conn is None:
+            # Dropped meanwhile
+            return
+        conn = conn[dst]
+        conn["rtx_timer"] = None
+        if not conn["unacked"]:
+            return
+        conn["retransmits"] += 1
+        if conn["retransmits"] > self.MAX_RETRANSMITS:
+            self.log("TCP {} gave up after {} retransmits", conn_id, self.MAX_RETRANSMITS)
+            self.connections.evict(conn_id)
+            return
+        conn["rto"] = min(conn["rto"] * 2, self.RTO_MAX)
+        # The peer may have dropped what it SACKed (RFC 2018 8)
+        conn["sacked"].clear()
+        self.start_retransmit(dst, conn_id, conn)
+        seq, payload = conn["unacked"][0]
+        self.dispatch(self.send_segment(dst, conn_id, seq, "AP", payload))
+
+    async def ack_data(self, dst, conn_id, immediate=False):
+        # Delayed ACK: ACK every second segment, or once DELAYED_ACK is up
+        conn = self.connections.peek(conn_id)
+        if conn is None or not conn[dst]["ack_pending"]:
+            # Already went out, with something else
+            return
+        conn = conn[dst]
+        if immediate or conn["ack_pending"] >= 2:
+            await self.write_packet(dst, conn_id, flags="A")
+        elif conn["ack_timer"] is None:
+            conn["ack_timer"] = self.call_later(self.DELAYED_ACK, self.delayed_ack, dst, conn_id)
+
+    def delayed_ack(self, dst, conn_id):
+        conn = self.connections.peek(conn_id)
+        if conn is None:
+            return
+        conn = conn[dst]
+        conn["ack_timer"] = None
+        if conn["ack_pending"]:
+            self.dispatch(self.write_packet(dst, conn_id, flags="A"))
+
+    async def flush(self, dst, conn_id, push=False):
+        # Send as much of the out_buffer as `dst`'s window takes, in segments
+        # of up to the MSS. Short of a full segment, data waits while
+        # anything sent is unACKed (Nagle, RFC 896) -- unless `push`
+        conn = self.connections.peek(conn_id)
+        if conn is None:
+            return
+        conn = conn[dst]
+        out = conn["out_buffer"]
+        mss = conn.get("max_segment_size", self.DEFAULT_MSS)
+        while out:
+            in_flight = self.in_flight(conn)
+            usable = conn.get("snd_wnd", dpkt.tcp.TCP_WIN_MAX) - in_flight
+            if usable <= 0:
+                if in_flight:
+                    # Wait for an ACK to open the window
+                    break
+                # Zero window: probe it with a byte, which the retransmission
+                # timer repeats until the window opens (RFC 1122 4.2.2.17)
+                usable = 1
+            size = min(mss, usable, len(out))
+            if size < mss and in_flight and self.nagle and not push:
+                break
+            await self.write_packet(dst, conn_id, flags="A", size=size)
+
+        if conn.get("fin_pending") and not out:
+            conn["fin_pending"] = False
+            await self.write_packet(dst, conn_id, flags="FA")
+            conn["seq"] = seq_add(conn["seq"], 1)
+
+    async def send_fin(self, dst, conn_id):
+        # The FIN goes out after whatever is still waiting to be sent
+        conn = self.connections.peek(conn_id)
+        if conn is None:
+            return
+        conn[dst]["fin_pending"] = True
+        await self.flush(dst, conn_id, push=True)
+
+    async def write_packet(self, dst, conn_id, flags="A", size=0):
+        # A segment with `size` bytes from the out_buffer, or just `flags`
+        conn = self.connections.get(conn_id)
+        if conn is None:
+            return
+        conn = conn[dst]
+        payload = b""
         seq = conn["seq"]
-        ack = conn.get("ack", 0)
-        payload_size = conn.get("max_segment_size", self.DEFAULT_MSS)
 
-        if conn["out_buffer"]:
-            payload = conn["out_buffer"][:payload_size]
-            conn["out_buffer"] = conn["out_buffer"][payload_size:]
+        if size:
+            payload = conn["out_buffer"].take(size)
             flags += "P"
             conn["unacked"].append((seq, payload))
-            conn["seq"] += len(payload)
+            conn["seq"] = seq_add(seq, len(payload))
+            self.start_retransmit(dst, conn_id, conn)
+
+        await self.send_segment(dst, conn_id, seq, flags, payload)
 
+    async def send_segment(self, dst, conn_id, seq, flags, payload):
+        conn = self.connections.peek(conn_id)
+        if conn is None:
+            # Dropped since this was scheduled (see `dispatch`)
+            return
+        conn = conn[dst]
+        header = conn["ip_header"]
+        ack = conn.get("ack", 0)
         bflags = tcp_dump_flags(flags)
+        if "A" in flags and conn.get("ack_pending"):
+            # Carries the ACK for everything received so far
+            conn["ack_pending"] = 0
+            if conn["ack_timer"] is not None:
+                conn["ack_timer"].cancel()
+                conn["ack_timer"] = None
         estimated_ts_val = self.timers[conn["ip_src"]].get_time()
         if estimated_ts_val is None or estimated_ts_val == 0:
             estimated_ts_val = conn.get("last_ts_val", 0)
@@ -412,58 +847,52 @@ class TCPLayer(NetLayer):
         ]
         if "S" in flags:
             tcp_opts_list += conn["syn_options"].items()
+        elif conn.get("sack_ok") and "in_buffer" in conn and len(conn["in_buffer"]):
+            # Tell the peer what we have beyond the gap
+            blocks = conn["in_buffer"].sack_blocks()
+            tcp_opts_list.append((dpkt.tcp.TCP_OPT_SACK, b"".join(struct.pack("!II", left, right) for left, right in blocks)))
         tcp_opts = tcp_dump_opts(tcp_opts_list)
-        pkt = dpkt.tcp.TCP(
-            sport=conn["sport"],
-            dport=conn["dport"],
-            seq=seq,
-            ack=ack,
-            flags=bflags,
-            win=conn.get("win", dpkt.tcp.TCP_WIN_MAX),
-        )
-        pkt.opts = tcp_opts
-        #print("TCP options: " + str([hex(x) for x in tcp_opts]))
-        #print("TCP option length: " + str(len(tcp_opts)))
-        pkt.off += int(len(tcp_opts) / 4)
-        if payload is not None:
-            pkt.data = payload
+        win = conn.get("win", dpkt.tcp.TCP_WIN_MAX)
 
         if self.debug:
             self.log("TCP {}{}   {:.3f} {}:{:<5}->{}:{:<5} {:<4} seq={:<3} ({:<10}) ack={:<3} ({:<10}) data=[{:<4}]{:8} tsval={} tsecr={}",
                     "->", "AB"[dst],
                     time.perf_counter(), 
                     "-", #hosts.get(header["ip_src"], "?"),
-                    pkt.sport,
+                    conn["sport"],
                     "-", #hosts.get(header["ip_dst"], "?"),
-                    pkt.dport,
-                    tcp_read_flags(pkt.flags),
-                    pkt.seq - conn['seq_start'] if 'seq_start' in conn else '-',
-                    pkt.seq,
-                    pkt.ack - conn['ack_start'] if pkt.flags & dpkt.tcp.TH_ACK and 'ack_start' in conn else '-',
-                    pkt.ack if pkt.flags & dpkt.tcp.TH_ACK else '-',
-                    len(pkt.data),
-                    (pkt.data.decode("utf-8") if pkt.data else "").replace('\n','\\n')[:8],
+                    conn["dport"],
+                    tcp_read_flags(bflags),
+                    seq - conn['seq_start'] if 'seq_start' in conn else '-',
+                    seq,
+                    ack - conn['ack_start'] if bflags & dpkt.tcp.TH_ACK and 'ack_start' in conn else '-',
+                    ack if bflags & dpkt.tcp.TH_ACK else '-',
+                    len(payload),
+                    (payload.decode("utf-8") if payload else "").replace('\n','\\n')[:8],
                     conn.get('ts_val', 0),
                     conn.get('ts_ecr', 0)
                 )
+        pkt = packet.build_tcp(conn["sport"], conn["dport"], seq, ack, bflags, win, tcp_opts, payload)
         #self.connections[conn_id][dst] = conn
-        # Don't stringify packet so the IP layer can calculate the checksum for us
-        yield self.write_back(dst, header, pkt)
+        # Zero checksum, so the IP layer calculates it for us
+        await self.write_back(dst, header, pkt)
 
-    @gen.coroutine
-    def write(self, dst, header, data):
+    async def write(self, dst, header, data):
+        if header["tcp_conn"] not in self.connections:
+            self.log("write on dropped connection {}", header["tcp_conn"])
+            return
         dst_conn = self.connections[header["tcp_conn"]][dst]
         if data is not None:
-            dst_conn["out_buffer"] += data
-            while len(dst_conn["out_buffer"]) >= dst_conn.get("min_payload", 1):
-                yield self.write_packet(dst, header["tcp_conn"], flags="A")
+            dst_conn["out_buffer"].append(data)
+            if len(dst_conn["out_buffer"]) >= dst_conn.get("min_payload", 1):
+                await self.flush(dst, header["tcp_conn"])
         else:
-            while len(dst_conn["out_buffer"]) > 0:
-                yield self.write_packet(dst, header["tcp_conn"], flags="A")
+            await self.flush(dst, header["tcp_conn"], push=True)
         
-    @gen.coroutine
-    def on_close(self, dst, header):
+    async def on_close(self, dst, header):
         # TODO - if the client initiates closing instead of the server
+        if header["tcp_conn"] not in self.connections:
+            return await self.close_bubble(dst, header)
         conn = self.connections[header["tcp_conn"]] 
         dst_conn = conn[dst]
         if header["reset"]:
@@ -472,6 +901,6 @@ class TCPLayer(NetLayer):
             pass
             #if dst_conn["state"] == "FIN-WAIT-1":
             #    # Forward FIN - nope! send a close msg
-            #    yield self.write_packet(dst, conn_id, flags="FA")
+            #    await self.write_packet(dst, conn_id, flags="FA")
             #    dst_conn["seq"] += 1
-        self.close_bubble(dst, conn)
+        await self.close_bubble(dst, header)
@@ -0,0 +1,144 @@
+import bisect
+
+# Byte stream bookkeeping for TCPLayer: sequence number arithmetic, in-order
+# reassembly of received segments, and the buffer of data waiting to be sent
+#
+# Sequence numbers live modulo 2**32 (RFC 793 3.3); compare them with the
+# seq_* functions below, never with < or -. Two sequence numbers are taken to
+# be less than 2**31 apart, which a TCP window always is.
+
+SEQ_MOD = 1 << 32
+
+def seq_add(seq, n):
+    return (seq + n) & (SEQ_MOD - 1)
+
+def seq_diff(a, b):
+    # a - b, as a signed distance
+    d = (a - b) & (SEQ_MOD - 1)
+    return d - SEQ_MOD if d >= SEQ_MOD >> 1 else d
+
+def seq_lt(a, b):
+    return seq_diff(a, b) < 0
+
+def seq_le(a, b):
+    return seq_diff(a, b) <= 0
+
+def seq_max(a, b):
+    return b if seq_lt(a, b) else a
+
+class Reassembler(object):
+    # Received half of a connection: turns segments, in whatever order they
+    # arrive, into the stream of bytes they make up
+    #
+    # `add` returns the data that just became contiguous, in order: usually
+    # just the segment that came in, as-is (no copy). Retransmitted bytes are
+    # dropped; segments from beyond a gap are held until it's filled. Held
+    # data is kept by stream offset (bytes since the initial sequence number),
+    # which, unlike a sequence number, doesn't wrap and so can be bisected.
+
+    # Most that's held waiting for a gap to be filled; more is dropped, to be
+    # retransmitted by the sender later
+    MAX_HELD = 1 << 20
+
+    def __init__(self, seq):
+        # Sequence number of the next byte expected
+        self.next = seq
+        # Stream offset of self.next
+        self.offset = 0
+        # Sorted stream offsets of the held segments, & offset -> data
+        self.held_offsets = []
+        self.held = {}
+        self.held_bytes = 0
+        # Stream offset of the last segment held
+        self.latest = None
+
+    def add(self, seq, data):
+        start = self.offset + seq_diff(seq, self.next)
+        end = start + len(data)
+        if end <= self.offset:
+            # All of it was seen already
+            return []
+        if start > self.offset:
+            self.hold(start, data)
+            return []
+
+        if start < self.offset:
+            # Partly retransmitted
+            data = data[self.offset - start:]
+        ready = [data]
+        self.advance(len(data))
+
+        # Anything held which now follows on
+        while self.held_offsets and self.held_offsets[0] <= self.offset:
+            start = self.held_offsets.pop(0)
+            held = self.held.pop(start)
+            self.held_bytes -= len(held)
+            if start + len(held) > self.offset:
+                held = held[self.offset - start:]
+                ready.append(held)
+                self.advance(len(held))
+        return ready
+
+    def hold(self, start, data):
+        self.latest = start
+        previous = self.held.get(start)
+        if previous is not None:
+            if len(previous) >= len(data):
+                return
+            self.held_bytes -= len(previous)
+        elif self.held_bytes + len(data) > self.MAX_HELD:
+            return
+        else:
+            bisect.insort(self.held_offsets, start)
+        self.held[start] = data
+        self.held_bytes += len(data)
+
+    def sack_blocks(self, limit=3):
+        # Held data as (left, right) sequence number ranges, for a SACK option
+        # (RFC 2018): the block with the latest segment in it goes first
+        blocks = []
+        for start in self.held_offsets:
+            end = start + len(self.held[start])
+            if blocks and start <= blocks[-1][1]:
+                blocks[-1][1] = max(blocks[-1][1], end)
+            else:
+                blocks.append([start, end])
+        if self.latest is not None:
+            blocks.sort(key=lambda block: not block[0] <= self.latest < block[1])
+        return [(seq_add(self.next, start - self.offset), seq_add(self.next, end - self.offset))
+                for start, end in blocks[:limit]]
+
+    def advance(self, n):
+        self.next = seq_add(self.next, n)
+        self.offset += n
+
+    def __len__(self):
+        # Bytes held out of order
+        return self.held_bytes
+
+class SendBuffer(object):
+    # Data written to a half connection, waiting to be cut into segments
+    #
+    # A bytearray which is read from the front: taking a segment only moves
+    # `start` along, and the bytes before it are dropped once they're half the
+    # buffer -- so queueing & sending n bytes costs O(n), instead of the
+    # O(n**2) of re-slicing a bytes object for every segment.
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.start = 0
+
+    def append(self, data):
+        self.buf += data
+
+    def take(self, n):
+        # Up to `n` bytes from the front
+        data = bytes(self.buf[self.start:self.start + n])
+        self.start += len(data)
+        if self.start * 2 >= len(self.buf):
+            del self.buf[:self.start]
+            self.start = 0
+        return data
+
+    def __len__(self):
+        return len(self.buf) - self.start
@@ -0,0 +1,52 @@
+import asyncio
+
+import base_layer
+from base_layer import NetLayer
+
+class Waiter(NetLayer):
+    # Sees which task it runs in, then waits until cancelled
+    NAME = "waiter"
+
+    def __init__(self):
+        super(Waiter, self).__init__()
+        self.task = None
+        self.cancelled = False
+
+    async def on_read(self, src, header, payload):
+        self.task = asyncio.current_task()
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+class Quick(NetLayer):
+    NAME = "quick"
+
+    def __init__(self):
+        super(Quick, self).__init__()
+        self.seen = []
+
+    async def on_read(self, src, header, payload):
+        self.seen.append((asyncio.current_task(), payload))
+
+async def dispatched():
+    quick = Quick()
+    task = quick.dispatch(quick.on_read(0, {}, b"x"))
+    if base_layer.EAGER_TASKS:
+        # Ran to the end right away, in a task of its own
+        assert task is None and len(quick.seen) == 1
+    else:
+        await task
+    assert quick.seen[0][0] is not None and quick.seen[0][1] == b"x"
+
+    waiter = Waiter()
+    task = waiter.dispatch(waiter.on_read(0, {}, b"x"))
+    await asyncio.sleep(0)
+    assert waiter.task is task
+    task.cancel()
+    await asyncio.wait([task])
+    assert waiter.cancelled and task.cancelled()
+
+def test_dispatch_runs_in_a_task():
+    asyncio.run(dispatched())
@@ -0,0 +1,80 @@
+import socket
+import struct
+
+import dpkt
+
+import bpf
+import packet
+from base_layer import NetLayer
+
+class Root(NetLayer):
+    NAME = "root"
+
+class KeyLayer(NetLayer):
+    # Wants the frames its keys describe
+    NAME = "keys"
+
+    def __init__(self, keys):
+        super(KeyLayer, self).__init__()
+        self.keys = keys
+
+    def match(self, src, header):
+        return False
+
+    def match_keys(self):
+        return self.keys
+
+def run(program, frame):
+    # Classic BPF, as far as bpf.py uses it: returns what the program returns
+    a = x = 0
+    pc = 0
+    while True:
+        code, jt, jf, k = program[pc]
+        pc += 1
+        if code == bpf.LD_W_ABS:
+            a, = struct.unpack_from("!I", frame, k)
+        elif code == bpf.LD_H_ABS:
+            a, = struct.unpack_from("!H", frame, k)
+        elif code == bpf.LD_B_ABS:
+            a = frame[k]
+        elif code == bpf.LD_H_IND:
+            a, = struct.unpack_from("!H", frame, x + k)
+        elif code == bpf.LDX_B_MSH:
+            x = (frame[k] & 0xF) * 4
+        elif code == bpf.JA:
+            pc += k
+        elif code == bpf.JEQ_K:
+            pc += jt if a == k else jf
+        elif code == bpf.JSET_K:
+            pc += jt if a & k else jf
+        elif code == bpf.RET_K:
+            return k
+        else:
+            raise Exception("Unknown opcode {:#x}".format(code))
+
+def tcp_frame(ip_src, ip_dst, sport, dport):
+    tcp = packet.build_tcp(sport, dport, 1, 0, dpkt.tcp.TH_SYN, 1000)
+    ip = packet.build_ipv4(1, socket.inet_aton(ip_src), socket.inet_aton(ip_dst), dpkt.ip.IP_PROTO_TCP, tcp)
+    return packet.build_ethernet(b"\x02" * 6, b"\x04" * 6, dpkt.ethernet.ETH_TYPE_IP, ip)
+
+def test_largest_terms():
+    # Two terms with every set as big as it's allowed to be: most of their
+    # jumps are too far for 8 bits
+    root = Root()
+    for n in (1, 2):
+        addrs = {"10.{}.0.{}".format(n, i) for i in range(bpf.MAX_SET)}
+        ports = set(range(n * 1000, n * 1000 + bpf.MAX_SET))
+        root.register_child(KeyLayer({"ip_addr": addrs, "tcp_port": ports}))
+    program = bpf.compile_tree(root)
+    assert any(code == bpf.JA for code, jt, jf, k in program)
+    assert len(program) <= bpf.MAX_INSNS
+
+    for n in (1, 2):
+        port = n * 1000 + bpf.MAX_SET - 1
+        last = "10.{}.0.{}".format(n, bpf.MAX_SET - 1)
+        assert run(program, tcp_frame("10.{}.0.0".format(n), "8.8.8.8", 5555, port)) == bpf.ACCEPT
+        assert run(program, tcp_frame("8.8.8.8", last, port, 5555)) == bpf.ACCEPT
+        assert run(program, tcp_frame("8.8.8.8", last, 5555, 5555)) == bpf.REJECT
+        assert run(program, tcp_frame("8.8.8.8", "8.8.4.4", port, 5555)) == bpf.REJECT
+    # The address of one term with the port of the other
+    assert run(program, tcp_frame("10.1.0.0", "8.8.8.8", 2000, 5555)) == bpf.REJECT
@@ -0,0 +1,65 @@
+import random
+import struct
+
+import checksum
+import packet
+
+def reference(data):
+    # RFC 1071, a word at a time
+    if len(data) & 1:
+        data += b"\0"
+    s = 0
+    for (word,) in struct.iter_unpack("!H", data):
+        s += word
+        s = (s & 0xFFFF) + (s >> 16)
+    return ~s & 0xFFFF
+
+def test_checksum():
+    rand = random.Random(1)
+    # Not all zeros, which the modulo sum can't tell from 0xFFFF (see checksum.py)
+    for length in list(range(1, 9)) + [1499, 1500]:
+        data = bytes(rand.getrandbits(8) for i in range(length))
+        assert checksum.checksum(data) == reference(data)
+    assert checksum.checksum(b"\xff\xff\x00\x00") == reference(b"\xff\xff\x00\x00")
+
+def test_update():
+    rand = random.Random(2)
+    for i in range(500):
+        data = bytearray(rand.getrandbits(8) for j in range(rand.choice((20, 21, 60))))
+        cksum = checksum.checksum(data)
+        start = rand.randrange(0, 16, 2)
+        size = rand.choice((2, 4, 8))
+        old = bytes(data[start:start + size])
+        data[start:start + size] = bytes(rand.getrandbits(8) for j in range(size))
+        assert checksum.update(cksum, old, data[start:start + size]) == checksum.checksum(data)
+
+def valid(src, dst, p, segment):
+    return checksum.checksum(segment, checksum.pseudo_header_sum(src, dst, p, len(segment))) == 0
+
+def test_rewrite():
+    a, b, c = b"\x0a\x00\x00\x01", b"\x0a\x00\x00\x02", b"\xc0\xa8\x01\x07"
+    tcp = packet.build_tcp(1234, 80, 1000, 2000, 0x18, 512, data=b"payload")
+    udp = packet.build_udp(5353, 53, b"query")
+    for p, segment, fields in ((packet.IP_PROTO_TCP, tcp, {"seq": 0xfffffff0, "dport": 8080}),
+                               (packet.IP_PROTO_UDP, udp, {"sport": 1})):
+        frame = packet.build_ethernet(b"\x02" * 6, b"\x04" * 6, packet.ETH_TYPE_IP,
+                packet.build_ipv4(1, a, b, p, segment))
+        view = packet.parse_ethernet(frame)[3].payload()
+        # Other header fields, and other addresses in the pseudo header
+        out = view.rewrite(dst=c, **fields)
+        assert valid(a, c, p, out)
+        assert out[view.hl if p == packet.IP_PROTO_TCP else 8:] == view.data
+        # Re-addressed by build_ipv4
+        ip = packet.parse_ethernet(packet.build_ethernet(b"\x02" * 6, b"\x04" * 6, packet.ETH_TYPE_IP,
+                packet.build_ipv4(2, c, b, p, view)))[3]
+        assert valid(c, b, p, ip.payload().buf[ip.payload().start:ip.end])
+
+def test_rewrite_keeps_zero_udp_checksum():
+    # No checksum stays no checksum
+    segment = bytearray(packet.build_udp(5353, 53, b"query"))
+    frame = packet.build_ethernet(b"\x02" * 6, b"\x04" * 6, packet.ETH_TYPE_IP,
+            packet.build_ipv4(1, b"\x0a\x00\x00\x01", b"\x0a\x00\x00\x02", packet.IP_PROTO_UDP, segment))
+    frame = bytearray(frame)
+    struct.pack_into("!H", frame, packet.ETH_HEADER.size + packet.IP_HEADER.size + 6, 0)
+    view = packet.parse_ethernet(bytes(frame))[3].payload()
+    assert struct.unpack_from("!H", view.rewrite(sport=1), 6) == (0,)
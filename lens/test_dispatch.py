@@ -0,0 +1,63 @@
+from base_layer import NetLayer
+from header import Header
+from tcp_layer import TCPFilterLayer
+from udp_layer import UDPFilterLayer
+
+class Root(NetLayer):
+    NAME = "root"
+
+class Port(NetLayer):
+    NAME = "port"
+
+    def __init__(self, port):
+        super(Port, self).__init__()
+        self.port = port
+
+    def match(self, src, header):
+        return self.port in (header["tcp_conn"][0][1], header["tcp_conn"][1][1])
+
+    def match_keys(self):
+        return {"tcp_port": {self.port}}
+
+class EvenSeconds(TCPFilterLayer):
+    # Inherits TCPFilterLayer's keys, but adds a condition of its own
+    def match(self, src, header):
+        return super(EvenSeconds, self).match(src, header) and header.get("second", 0) % 2 == 0
+
+class Everything(NetLayer):
+    NAME = "everything"
+
+def conn(sport, dport, **extra):
+    return Header(tcp_conn=((b"\x0a\x00\x00\x01", sport), (b"\x0a\x00\x00\x02", dport)), **extra)
+
+def test_first_match_wins():
+    root = Root()
+    a, b, c = Port(80), Port(80), Everything()
+    for child in (a, Port(443), b, c):
+        root.register_child(child)
+    assert root.resolve_child(0, conn(1234, 80)) is a
+    assert root.resolve_child(0, conn(443, 1234)) is root.children[1]
+    assert root.resolve_child(0, conn(1234, 8080)) is c
+
+def test_inherited_keys_not_trusted():
+    root = Root()
+    even, rest = EvenSeconds(80), Everything()
+    root.register_child(even)
+    root.register_child(rest)
+    assert root.resolve_child(0, conn(1234, 80, second=2)) is even
+    assert root.resolve_child(0, conn(1234, 80, second=3)) is rest
+    assert root.resolve_child(0, conn(1234, 81, second=2)) is rest
+
+def test_plain_dict_header():
+    # Attack scripts may still pass a dict rather than a Header
+    root = Root()
+    web, dns, rest = TCPFilterLayer(80), UDPFilterLayer(53), Everything()
+    for child in (web, dns, rest):
+        root.register_child(child)
+    tcp = {"tcp_conn": ((b"\x0a\x00\x00\x01", 1234), (b"\x0a\x00\x00\x02", 80))}
+    udp = {"udp_sport": 53, "udp_dport": 1234}
+    assert web.match(0, tcp) and not web.match(0, udp)
+    assert dns.match(0, udp) and not dns.match(0, tcp)
+    assert root.resolve_child(0, tcp) is web
+    assert root.resolve_child(0, udp) is dns
+    assert root.resolve_child(0, {}) is rest
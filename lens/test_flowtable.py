@@ -0,0 +1,68 @@
+import asyncio
+
+import timer_wheel
+from flowtable import FlowTable
+
+def fine_wheel():
+    # A wheel with finer ticks than the default, so timeouts can be short
+    loop = asyncio.get_running_loop()
+    timer_wheel._wheels[loop] = timer_wheel.TimerWheel(loop, tick=0.01)
+
+def test_lru_eviction():
+    evicted = []
+    table = FlowTable(capacity=2, on_evict=lambda key, value: evicted.append((key, value)))
+    table["a"] = 1
+    table["b"] = 2
+    # A lookup makes "a" the most recent, so "b" goes first
+    assert table["a"] == 1
+    table["c"] = 3
+    assert evicted == [("b", 2)]
+    # peek doesn't count as a use
+    assert table.peek("a") == 1
+    table["d"] = 4
+    assert evicted == [("b", 2), ("a", 1)]
+    assert list(table) == ["c", "d"]
+    assert table.evictions == 2
+
+def test_factory():
+    table = FlowTable(factory=list)
+    table["a"].append(1)
+    assert table["a"] == [1]
+    assert table.get("b") is None
+
+async def expiry():
+    fine_wheel()
+    evicted = []
+    table = FlowTable(on_evict=lambda key, value: evicted.append(key))
+    for key in "abc":
+        table[key] = key
+    table.expire("a", 0.1)
+    table.expire("b", 0.1)
+    table.expire("c", 0.1)
+    table.unexpire("b")
+    # A new value is a new flow, which the old one's timeout doesn't cover
+    table["c"] = "C"
+    await asyncio.sleep(0.2)
+    assert evicted == ["a"]
+    assert list(table) == ["b", "c"]
+    assert not table.deadlines
+
+async def idle():
+    fine_wheel()
+    evicted = []
+    table = FlowTable(idle_timeout=0.2, on_evict=lambda key, value: evicted.append(key))
+    table["a"] = 1
+    table["b"] = 2
+    await asyncio.sleep(0.1)
+    table["a"]
+    await asyncio.sleep(0.15)
+    assert evicted == ["b"]
+    await asyncio.sleep(0.15)
+    assert evicted == ["b", "a"]
+    assert table.idle_timer is None
+
+def test_expire():
+    asyncio.run(expiry())
+
+def test_idle_timeout():
+    asyncio.run(idle())
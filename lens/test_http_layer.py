@@ -0,0 +1,112 @@
+import asyncio
+import gzip
+import zlib
+
+import http_layer
+from base_layer import NetLayer
+from header import Header
+from util import ByteReplaceLayer
+
+class Wire(NetLayer):
+    # Parent of the HTTP layer: keeps what's written out, each way
+    NAME = "wire"
+
+    def __init__(self):
+        super(Wire, self).__init__()
+        self.out = {0: b"", 1: b""}
+
+    async def write(self, dst, header, payload):
+        self.out[dst] += bytes(payload)
+
+REQUEST = b"GET / HTTP/1.1\r\nHost: x\r\n\r\n"
+
+def response(body, encoding="gzip"):
+    return (b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Encoding: " + encoding.encode() +
+            b"\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+
+def exchange(reply, pieces, child=None, hold_size=None):
+    # The request, then `reply` from the server in `pieces` pieces
+    async def run():
+        wire = Wire()
+        http = http_layer.HTTPLayer()
+        if hold_size is not None:
+            http.HOLD_SIZE = hold_size
+        wire.register_child(http)
+        if child is not None:
+            http.register_child(child)
+        await http.on_read(0, Header(tcp_conn=1), REQUEST)
+        size = -(-len(reply) // pieces)
+        for i in range(0, len(reply), size):
+            await http.on_read(1, Header(tcp_conn=1), reply[i:i + size])
+        return wire.out[0], http
+    return asyncio.run(run())
+
+def dechunk(body):
+    out = b""
+    while True:
+        size, body = body.split(b"\r\n", 1)
+        size = int(size, 16)
+        if not size:
+            return out
+        out += body[:size]
+        body = body[size + 2:]
+
+def split(message):
+    head, body = message.split(b"\r\n\r\n", 1)
+    return head, body
+
+def test_gzip_round_trip():
+    text = b"<html>" + b"Man in the middle. " * 2000 + b"</html>"
+    out, http = exchange(response(gzip.compress(text)), 7, ByteReplaceLayer(b"Man", b"Woman", -1))
+    head, body = split(out)
+    assert b"Transfer-Encoding: chunked" in head and b"Content-Length" not in head
+    assert gzip.decompress(dechunk(body)) == text.replace(b"Man", b"Woman")
+    assert http.streamed_count == 1
+
+def test_undecodable_passed_on():
+    # Says it's gzip, but isn't: goes out as it came in
+    reply = response(b"Man, this isn't gzip at all")
+    out, http = exchange(reply, 3, ByteReplaceLayer(b"Man", b"Woman", -1))
+    assert out == reply
+
+def test_undecodable_partway():
+    # Goes bad after some of it went out: what decoded is finished off,
+    # then the rest follows as it came in, from the piece which failed
+    text = b"Man " * 20000
+    compressed = zlib.compress(text, 0)[2:-4]
+    good, bad = compressed[:len(compressed) // 2], b"\xff" * 100
+    out, http = exchange(response(good + bad, "deflate"), 4, ByteReplaceLayer(b"Man", b"Woman", -1))
+    head, body = split(out)
+    body = dechunk(body)
+    assert body.endswith(bad)
+    decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+    decoded = decoder.decompress(body)
+    assert decoder.eof and (good + bad).endswith(decoder.unused_data)
+    assert decoded.startswith(b"Woman Woman ") and b"Man " not in decoded.replace(b"Woman ", b"")
+
+def test_unchanged_passed_on():
+    # Nothing to replace: goes out as it came in, not re-encoded
+    reply = response(gzip.compress(b"<html>" + b"Nothing to see. " * 2000 + b"</html>"))
+    out, http = exchange(reply, 5, ByteReplaceLayer(b"Man", b"Woman", -1))
+    assert out == reply
+    # The request too
+    assert (http.unchanged_count, http.streamed_count) == (2, 0)
+
+def test_unchanged_chunked():
+    text = b"Nothing to see. " * 100
+    reply = (b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nTransfer-Encoding: chunked\r\n\r\n" +
+             b"".join(b"%x\r\n%s\r\n" % (len(text[i:i + 300]), text[i:i + 300]) for i in range(0, len(text), 300)) +
+             b"0\r\n\r\n")
+    out, http = exchange(reply, 4, ByteReplaceLayer(b"Man", b"Woman", -1))
+    head, body = split(out)
+    assert head == split(reply)[0]
+    assert dechunk(body) == text
+    assert http.unchanged_count == 2
+
+def test_unchanged_too_big_to_hold():
+    # Past HOLD_SIZE it's streamed, even though nothing changes
+    text = b"<html>" + b"Nothing to see. " * 2000 + b"</html>"
+    out, http = exchange(response(gzip.compress(text)), 5, ByteReplaceLayer(b"Man", b"Woman", -1), hold_size=1000)
+    head, body = split(out)
+    assert gzip.decompress(dechunk(body)) == text
+    assert (http.unchanged_count, http.streamed_count) == (1, 1)
@@ -0,0 +1,42 @@
+import http_parser
+from http_parser import BODY, END, ERROR, HEAD, MAX_HEAD
+
+def kinds(parser):
+    return [kind for kind, value in parser.events]
+
+def test_pieces():
+    data = (b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nabc"
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nde\r\n1\r\nf\r\n0\r\n\r\n")
+    parser = http_parser.MessageParser("HTTP", False)
+    for i in range(len(data)):
+        parser.feed(data[i:i + 1])
+    assert kinds(parser).count(HEAD) == 2
+    assert b"".join(value for kind, value in parser.events if kind in (BODY, END)) == b"abcdef"
+    assert all(isinstance(value, bytes) for kind, value in parser.events if kind in (BODY, END))
+
+def test_endless_head_dropped():
+    parser = http_parser.MessageParser("HTTP", True)
+    parser.feed(b"GET / HTTP/1.1\r\n")
+    for i in range(MAX_HEAD // 1000 + 1):
+        parser.feed(b"X-Junk: " + b"x" * 990 + b"\r\n")
+    assert kinds(parser) == [ERROR]
+    assert len(parser.rest) <= MAX_HEAD
+
+def test_endless_chunk_line_passed_on():
+    parser = http_parser.MessageParser("HTTP", False)
+    parser.feed(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+    for i in range(MAX_HEAD // 1000 + 1):
+        parser.feed(b"1" * 1000)
+    parser.feed(b"tail")
+    assert kinds(parser) == [HEAD, ERROR, BODY, BODY]
+    assert parser.events[-1] == (BODY, b"tail")
+
+def test_duplicate_headers_removed():
+    data = (b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\ncontent-length: 3\r\n"
+            b"Server: x\r\nContent-Length: 3\r\n\r\nabc")
+    parser = http_parser.MessageParser("HTTP", False)
+    parser.feed(data)
+    headers = [value for kind, value in parser.events if kind == HEAD][0].headers
+    headers.remove("Content-Length")
+    assert list(headers) == [("Server", "x")]
+    assert headers.last("content-length") is None
@@ -0,0 +1,188 @@
+import asyncio
+import socket
+import struct
+import subprocess
+
+import dpkt
+import pytest
+
+import link_layer
+from base_layer import NetLayer
+from link_layer import LinkLayer, PcapLinkLayer, RxRing
+
+def make_queue():
+    # A datagram socket refuses a frame bigger than its send buffer outright
+    # (EMSGSIZE), as a NIC does one over its MTU
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8192)
+    a.setblocking(False)
+    b.setblocking(False)
+    return link_layer.TxQueue(a), b
+
+def received(sock):
+    frames = []
+    while True:
+        try:
+            frames.append(sock.recv(65536))
+        except BlockingIOError:
+            return frames
+
+def check_bad_frame_dropped(queue, peer):
+    for frame in (b"first", b"x" * 1000000, b"second"):
+        queue.push(frame)
+    assert queue.flush() is False
+    assert received(peer) == [b"first", b"second"]
+    assert queue.frames == []
+    assert queue.stats["sent"] == 2
+    assert queue.stats["errors"] == 1
+
+def test_bad_frame_dropped():
+    check_bad_frame_dropped(*make_queue())
+
+def test_bad_frame_dropped_without_sendmmsg(monkeypatch):
+    monkeypatch.setattr(link_layer, "_sendmmsg", None)
+    check_bad_frame_dropped(*make_queue())
+
+class SmallRing(RxRing):
+    BLOCK_SIZE = 4096
+    BLOCK_NR = 3
+
+def fake_ring():
+    # An RxRing over plain memory, filled in by `fill_block` as the kernel would
+    ring = SmallRing.__new__(SmallRing)
+    ring.ring = bytearray(SmallRing.BLOCK_SIZE * SmallRing.BLOCK_NR)
+    ring.block = 0
+    return ring
+
+def fill_block(ring, index, frames):
+    base = index * ring.BLOCK_SIZE
+    offset = first = 48
+    mac = 32
+    for i, frame in enumerate(frames):
+        size = (mac + len(frame) + 15) & ~15
+        next_offset = size if i < len(frames) - 1 else 0
+        ring.FRAME_HDR.pack_into(ring.ring, base + offset, next_offset, 0, 0, len(frame), len(frame), 0, mac)
+        ring.ring[base + offset + mac:base + offset + mac + len(frame)] = frame
+        offset += size
+    ring.BLOCK_HDR.pack_into(ring.ring, base, 3, 0, ring.TP_STATUS_USER, len(frames), first)
+
+def block_status(ring, index):
+    return ring.BLOCK_HDR.unpack_from(ring.ring, index * ring.BLOCK_SIZE)[2]
+
+def test_ring_read():
+    ring = fake_ring()
+    fill_block(ring, 0, [b"a" * 60, b"b" * 1500])
+    fill_block(ring, 1, [b"c" * 64])
+    # Block 2 is still the kernel's
+    assert ring.read(64) == [b"a" * 60, b"b" * 1500, b"c" * 64]
+    assert [block_status(ring, i) for i in range(3)] == [ring.TP_STATUS_KERNEL] * 3
+    assert ring.block == 2
+    assert ring.read(64) == []
+
+    # Whole blocks are handed back, even past `limit`, then it wraps around
+    fill_block(ring, 2, [b"d", b"e"])
+    fill_block(ring, 0, [b"f"])
+    assert ring.read(1) == [b"d", b"e"]
+    assert ring.block == 0
+    assert ring.read(64) == [b"f"]
+    assert ring.block == 1
+
+class Recorder(NetLayer):
+    NAME = "recorder"
+
+    def __init__(self):
+        super(Recorder, self).__init__()
+        self.frames = []
+
+    async def on_read(self, src, header, payload):
+        self.frames.append((src, bytes(payload)))
+
+ETH_TYPE_TEST = 0x88b5
+
+def veth_pair(a, b):
+    try:
+        result = subprocess.call(["ip", "link", "add", a, "type", "veth", "peer", "name", b],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        result = -1
+    if result:
+        pytest.skip("can't create a veth pair (needs root & iproute2)")
+
+async def ring_ingest(count):
+    alice, bob = LinkLayer.attach("lens-rx0"), LinkLayer.attach("lens-rx1")
+    link = LinkLayer(sockets=(alice, bob), alice_ingest="ring", bob_ingest="batch")
+    recorder = Recorder()
+    link.register_child(recorder)
+    # Sent into the far end of the pair, so it arrives on Alice's NIC
+    inject = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+    inject.bind(("lens-rx1", 0))
+    frames = [b"\xff" * 6 + b"\x02" * 6 + struct.pack("!HI", ETH_TYPE_TEST, i) + b"x" * 100
+              for i in range(count)]
+    try:
+        for i, frame in enumerate(frames):
+            inject.send(frame)
+            if i % 100 == 99:
+                # Don't overrun the veth's backlog
+                await asyncio.sleep(0.001)
+        for _ in range(200):
+            got = [data for src, data in recorder.frames
+                   if src == LinkLayer.ALICE and data[12:14] == struct.pack("!H", ETH_TYPE_TEST)]
+            if len(got) >= count:
+                break
+            await asyncio.sleep(0.01)
+        return frames, got
+    finally:
+        loop = asyncio.get_running_loop()
+        for sock in (alice, bob, inject):
+            if sock is not inject:
+                loop.remove_reader(sock.fileno())
+            sock.close()
+
+def test_ring_ingest_veth():
+    veth_pair("lens-rx0", "lens-rx1")
+    try:
+        # More frames than one block holds, so the ring has to move on
+        frames, got = asyncio.run(ring_ingest(4000))
+    finally:
+        subprocess.call(["ip", "link", "del", "lens-rx0"])
+    assert got == frames
+
+def write_pcap(path, timed):
+    with open(path, "wb") as f:
+        writer = dpkt.pcap.Writer(f)
+        for ts, frame in timed:
+            writer.writepkt(frame, ts)
+
+def read_pcap(path):
+    with open(path, "rb") as f:
+        return [buf for ts, buf in dpkt.pcap.Reader(f)]
+
+class Picky(NetLayer):
+    # Fails on some frames, passes the rest across
+    NAME = "picky"
+
+    async def on_read(self, src, header, payload):
+        if payload.startswith(b"bad"):
+            raise Exception("bad frame")
+        await self.passthru(src, header, payload)
+
+def test_pcap_replay(tmp_path):
+    alice, bob = str(tmp_path / "alice.pcap"), str(tmp_path / "bob.pcap")
+    write_pcap(alice, [(1.0, b"a1"), (3.0, b"a2"), (4.0, b"bad a3")])
+    write_pcap(bob, [(2.0, b"b1"), (5.0, b"b2")])
+    link = PcapLinkLayer(alice, bob, frames=[(LinkLayer.BOB, b"b3")],
+            alice_out=str(tmp_path / "to_alice.pcap"), bob_out=str(tmp_path / "to_bob.pcap"))
+    # Both files, merged by timestamp, then the extra frames
+    assert link.frames == [(0, b"a1"), (1, b"b1"), (0, b"a2"), (0, b"bad a3"), (1, b"b2"), (1, b"b3")]
+    link.register_child(Picky())
+    asyncio.run(link.replay())
+    link.cleanup()
+    # A failing frame only takes itself down
+    assert read_pcap(str(tmp_path / "to_bob.pcap")) == [b"a1", b"a2"]
+    assert read_pcap(str(tmp_path / "to_alice.pcap")) == [b"b1", b"b2", b"b3"]
+    assert link.stats == {
+        "read_frames": 6,
+        "read_bytes": 16,
+        "written_frames": 5,
+        "written_bytes": 10,
+    }
@@ -0,0 +1,66 @@
+import random
+import re
+
+import replace_rules
+
+def reference(rules, data):
+    # Leftmost match, by the longest live literal, else the first live regex
+    remaining = [count for old, new, count in rules]
+    output = b""
+    pos = 0
+    while pos < len(data):
+        best = None
+        for index, (old, new, count) in enumerate(rules):
+            if not remaining[index] or not isinstance(old, bytes):
+                continue
+            if data.startswith(old, pos) and (best is None or len(old) > len(rules[best][0])):
+                best = index
+        end = None if best is None else pos + len(rules[best][0])
+        if best is None:
+            for index, (old, new, count) in enumerate(rules):
+                if remaining[index] and not isinstance(old, bytes):
+                    match = old.match(data, pos)
+                    if match is not None:
+                        best, end = index, match.end()
+                        break
+        if best is None:
+            output += data[pos:pos + 1]
+            pos += 1
+            continue
+        remaining[best] -= 1
+        output += rules[best][1]
+        pos = end
+    return output
+
+def replace_pieces(rule_set, data, size):
+    remaining = rule_set.counts()
+    output = b""
+    tail = b""
+    for start in range(0, len(data), size):
+        piece, tail = rule_set.replace(tail + data[start:start + size], remaining, False)
+        output += piece
+    return output + rule_set.replace(tail, remaining)[0]
+
+def test_exhausted_rule_stands_aside():
+    rule_set = replace_rules.RuleSet([(b"abc", b"X", 1), (b"ab", b"Y", -1)])
+    assert rule_set.replace(b"abcabc", rule_set.counts())[0] == b"XYc"
+    assert replace_pieces(rule_set, b"abcabc", 2) == b"XYc"
+
+def test_same_literal_twice():
+    rule_set = replace_rules.RuleSet([(b"a", b"X", 1), (b"a", b"Y", 2)])
+    assert rule_set.replace(b"aaaa", rule_set.counts())[0] == b"XYYa"
+
+def test_count_limited_rules_random():
+    rng = random.Random(7)
+    for trial in range(300):
+        rules = []
+        for i in range(rng.randint(1, 4)):
+            old = bytes(rng.choice(b"abc") for j in range(rng.randint(1, 3)))
+            rules.append((old, bytes([65 + i]), rng.choice([-1, 0, 1, 2])))
+        if rng.random() < 0.3:
+            rules.append((re.compile(b"c[ab]+"), b"R", rng.choice([-1, 1])))
+        data = bytes(rng.choice(b"abc") for i in range(rng.randint(0, 40)))
+        rule_set = replace_rules.RuleSet(rules)
+        want = reference(rules, data)
+        assert rule_set.replace(data, rule_set.counts())[0] == want, (rules, data)
+        assert replace_pieces(rule_set, data, rng.randint(1, 5)) == want, (rules, data)
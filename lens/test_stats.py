@@ -0,0 +1,70 @@
+import asyncio
+
+from base_layer import NetLayer
+
+class Sleeper(NetLayer):
+    NAME = "sleeper"
+
+    async def on_read(self, src, header, payload):
+        await asyncio.sleep(0.02)
+
+class Outer(NetLayer):
+    NAME = "outer"
+
+class Spawner(NetLayer):
+    # Starts its child off in a task of its own, then waits itself
+    NAME = "spawner"
+
+    async def on_read(self, src, header, payload):
+        self.dispatch(self.bubble(src, header, payload))
+        await asyncio.sleep(0.05)
+
+class Counter(NetLayer):
+    # on_read doesn't return a coroutine
+    NAME = "counter"
+
+    def __init__(self):
+        super(Counter, self).__init__()
+        self.count = 0
+
+    def on_read(self, src, header, payload):
+        self.count += 1
+
+async def frames():
+    outer = Outer()
+    sleeper = Sleeper()
+    outer.register_child(sleeper)
+    outer_stats = outer.enable_stats()
+    sleeper_stats = sleeper.enable_stats()
+    # Interleaved frames: each waits while the others run
+    await asyncio.gather(*[outer.on_read(0, {}, b"x") for i in range(10)])
+    on_read = outer_stats.recorders[("on_read", 0)]
+    bubble = outer_stats.recorders[("bubble", 0)]
+    slept = sleeper_stats.recorders[("on_read", 0)]
+    assert on_read.calls == bubble.calls == slept.calls == 10
+    # The waiting is the sleeper's own time, not the layers' above it
+    assert slept.self_ns >= 10 * 0.02e9
+    assert 0 <= bubble.self_ns < slept.self_ns / 10
+    assert 0 <= on_read.self_ns < slept.self_ns / 10
+
+async def spawned():
+    spawner = Spawner()
+    sleeper = Sleeper()
+    spawner.register_child(sleeper)
+    spawner_stats = spawner.enable_stats()
+    await spawner.on_read(0, {}, b"x")
+    # The task it started isn't part of its call
+    assert spawner_stats.recorders[("on_read", 0)].self_ns >= 0.05e9
+
+def test_self_time():
+    asyncio.run(frames())
+
+def test_self_time_other_task():
+    asyncio.run(spawned())
+
+def test_plain_return():
+    counter = Counter()
+    counter.enable_stats()
+    asyncio.run(counter.on_read(0, {}, b"abc"))
+    assert counter.count == 1
+    assert counter.layer_stats.recorders[("on_read", 0)].bytes == 3
@@ -0,0 +1,178 @@
+import asyncio
+
+import dpkt
+
+import packet
+import timer_wheel
+from base_layer import NetLayer
+from ethernet_layer import EthernetLayer
+from header import Header
+from ip_layer import IPv4Layer
+from tcp_layer import TCPLayer
+
+A_MAC, B_MAC = b"\x02\x00\x00\x00\x00\x01", b"\x02\x00\x00\x00\x00\x02"
+A_IP, B_IP = b"\x0a\x00\x00\x01", b"\x0a\x00\x00\x02"
+
+class Wire(NetLayer):
+    # Root of the graph: keeps the TCP segments written out
+    NAME = "wire"
+
+    def __init__(self):
+        super(Wire, self).__init__()
+        self.segments = []
+
+    async def write(self, dst, header, frame):
+        eth_dst, eth_src, eth_type, ip = packet.parse_ethernet(frame)
+        self.segments.append((dst, ip.data))
+
+class Sink(NetLayer):
+    # Child of the TCP layer: keeps the data & closes bubbled up to it
+    NAME = "sink"
+
+    def __init__(self):
+        super(Sink, self).__init__()
+        self.data = {0: b"", 1: b""}
+        self.closed = []
+
+    async def on_read(self, src, header, payload):
+        self.data[src] += bytes(payload)
+
+    async def on_close(self, src, header):
+        self.closed.append(src)
+
+def frame(src, seq, ack, flags, win=1000, data=b""):
+    # A segment from Alice (0) or Bob (1)
+    macs, ips, ports = (A_MAC, B_MAC), (A_IP, B_IP), (1234, 80)
+    tcp = packet.build_tcp(ports[src], ports[1 - src], seq, ack, flags, win, data=data)
+    ip = packet.build_ipv4(1, ips[src], ips[1 - src], dpkt.ip.IP_PROTO_TCP, tcp)
+    return packet.build_ethernet(macs[1 - src], macs[src], dpkt.ethernet.ETH_TYPE_IP, ip)
+
+S, A, F, R = dpkt.tcp.TH_SYN, dpkt.tcp.TH_ACK, dpkt.tcp.TH_FIN, dpkt.tcp.TH_RST
+
+def graph(child=None):
+    # wire -> eth -> ip -> tcp (-> child), with every connection intercepted
+    wire = Wire()
+    eth = EthernetLayer()
+    ip = IPv4Layer()
+    tcp = TCPLayer()
+    tcp.forward = False
+    wire.register_child(eth)
+    eth.register_child(ip)
+    ip.register_child(tcp)
+    if child is not None:
+        tcp.register_child(child)
+    return wire, eth, tcp
+
+async def handshake(eth, alice_seq, bob_seq):
+    await eth.on_read(0, Header(), frame(0, alice_seq, 0, S))
+    await eth.on_read(1, Header(), frame(1, bob_seq, alice_seq + 1, S | A))
+    await eth.on_read(0, Header(), frame(0, alice_seq + 1, bob_seq + 1, A))
+
+def stop_all(tcp):
+    for conn in tcp.connections.values():
+        tcp.stop_timers(conn[0])
+        tcp.stop_timers(conn[1])
+
+async def dupack_threshold():
+    wire, eth, tcp = graph()
+    await handshake(eth, 100, 500)
+    conn_id = next(iter(tcp.connections))
+    bob = tcp.connections[conn_id][1]
+
+    # Two segments to Bob, neither ACKed yet
+    await tcp.write(1, Header(tcp_conn=conn_id), b"x" * 100)
+    await tcp.write(1, Header(tcp_conn=conn_id), None)
+    await tcp.write(1, Header(tcp_conn=conn_id), b"y" * 100)
+    await tcp.write(1, Header(tcp_conn=conn_id), None)
+    assert len(bob["unacked"]) == 2
+    first = bob["unacked"][0][0]
+
+    # Bob opens his window, twice, then sends FIN: none of these are
+    # duplicate ACKs
+    await eth.on_read(1, Header(), frame(1, 501, first, A, win=2000))
+    await eth.on_read(1, Header(), frame(1, 501, first, A, win=3000))
+    await eth.on_read(1, Header(), frame(1, 501, first, A | F, win=3000))
+    assert bob["dupacks"] == 0
+
+    # Three real ones are a loss
+    for i in range(3):
+        await eth.on_read(1, Header(), frame(1, 502, first, A, win=3000))
+    assert bob["dupacks"] == 3
+    await asyncio.sleep(0)
+    resent = [seg for dst, seg in wire.segments if dst == 1 and seg.seq == first and seg.payload()]
+    assert len(resent) == 2
+
+    stop_all(tcp)
+
+async def reopen():
+    loop = asyncio.get_running_loop()
+    timer_wheel._wheels[loop] = timer_wheel.TimerWheel(loop, tick=0.01)
+    wire, eth, tcp = graph()
+    tcp.CLOSE_TIMEOUTS = {"RESET": 0.05, "CLOSED": 0.05}
+
+    await handshake(eth, 100, 500)
+    conn_id = next(iter(tcp.connections))
+    await eth.on_read(0, Header(), frame(0, 101, 501, R | A))
+    assert conn_id in tcp.connections.deadlines
+
+    # The same tuple, set up again before the old one timed out
+    await handshake(eth, 9000, 7000)
+    await asyncio.sleep(0.2)
+    assert conn_id in tcp.connections
+    conn = tcp.connections[conn_id]
+    assert conn[0]["state"] == conn[1]["state"] == "ESTABLISHED"
+    stop_all(tcp)
+
+async def fin_after_gap():
+    sink = Sink()
+    wire, eth, tcp = graph(sink)
+    await handshake(eth, 100, 500)
+    conn_id = next(iter(tcp.connections))
+    alice = tcp.connections[conn_id][0]
+
+    # The first segment is lost; the FIN comes with the second
+    await eth.on_read(0, Header(), frame(0, 201, 501, A | F, data=b"b" * 100))
+    assert sink.data[0] == b"" and not sink.closed
+    assert alice["state"] == "ESTABLISHED" and alice["ack"] == 101
+    assert not any(seg.flags & F for dst, seg in wire.segments)
+    # ... and the FIN alone, again
+    await eth.on_read(0, Header(), frame(0, 301, 501, A | F))
+    assert alice["ack"] == 101 and not sink.closed
+
+    # Once the gap is filled, the data goes up, then the close
+    await eth.on_read(0, Header(), frame(0, 101, 501, A, data=b"a" * 100))
+    assert sink.data[0] == b"a" * 100 + b"b" * 100
+    assert sink.closed == [0]
+    assert alice["state"] == "LAST-ACK" and alice["ack"] == 302
+    fins = [(dst, seg.ack) for dst, seg in wire.segments if seg.flags & F]
+    assert (0, 302) in fins and 1 in [dst for dst, ack in fins]
+
+    # A retransmitted FIN doesn't move anything on
+    await eth.on_read(0, Header(), frame(0, 301, 501, A | F))
+    assert alice["ack"] == 302 and sink.closed == [0]
+    stop_all(tcp)
+
+def test_fin_waits_for_gap():
+    asyncio.run(fin_after_gap())
+
+async def timers_after_evict():
+    wire, eth, tcp = graph()
+    await handshake(eth, 100, 500)
+    conn_id = next(iter(tcp.connections))
+    await tcp.write(1, Header(tcp_conn=conn_id), b"x" * 100)
+    tcp.connections.evict(conn_id)
+    # Timers & writes that were already on their way find it gone
+    tcp.retransmit(1, conn_id)
+    tcp.delayed_ack(0, conn_id)
+    await tcp.send_segment(1, conn_id, 101, "AP", b"x")
+    await tcp.write_packet(1, conn_id, flags="A")
+    await tcp.send_fin(1, conn_id)
+
+def test_timers_after_evict():
+    asyncio.run(timers_after_evict())
+
+def test_window_update_not_a_dupack():
+    asyncio.run(dupack_threshold())
+
+def test_reopened_connection_not_expired():
+    asyncio.run(reopen())
@@ -0,0 +1,48 @@
+from tcp_stream import Reassembler, SendBuffer, seq_add, seq_diff, seq_lt
+
+def test_seq_wraps():
+    top = (1 << 32) - 10
+    assert seq_add(top, 20) == 10
+    assert seq_diff(10, top) == 20
+    assert seq_lt(top, 10) and not seq_lt(10, top)
+
+def test_holes():
+    r = Reassembler(100)
+    assert r.add(110, b"bbbbbbbbbb") == []
+    assert r.add(130, b"dddddddddd") == []
+    assert len(r) == 20
+    # Fills the first gap: what was held after it follows on
+    assert r.add(100, b"aaaaaaaaaa") == [b"aaaaaaaaaa", b"bbbbbbbbbb"]
+    assert r.next == 120
+    # Retransmitted, partly new
+    assert r.add(115, b"bbbbbccccccccccdd") == [b"ccccccccccdd", b"dddddddd"]
+    assert r.next == 140 and len(r) == 0
+    # All old
+    assert r.add(100, b"a" * 40) == []
+
+def test_across_wrap():
+    start = (1 << 32) - 5
+    r = Reassembler(start)
+    assert r.add(5, b"yyyyy") == []
+    assert r.add(start, b"xxxxxxxxxx") == [b"xxxxxxxxxx", b"yyyyy"]
+    assert r.next == 10
+
+def test_sack_blocks():
+    r = Reassembler(1000)
+    r.add(1100, b"x" * 100)
+    r.add(1200, b"x" * 50)
+    r.add(1500, b"x" * 100)
+    # Adjacent segments make one block; the latest one's block goes first
+    assert r.sack_blocks() == [(1500, 1600), (1100, 1250)]
+    r.add(1300, b"x" * 10)
+    assert r.sack_blocks() == [(1300, 1310), (1100, 1250), (1500, 1600)]
+    assert r.sack_blocks(limit=1) == [(1300, 1310)]
+
+def test_send_buffer():
+    out = SendBuffer()
+    out.append(b"abcdef")
+    assert out.take(4) == b"abcd"
+    out.append(b"gh")
+    assert len(out) == 4
+    assert out.take(10) == b"efgh"
+    assert not out
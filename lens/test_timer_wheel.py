@@ -0,0 +1,33 @@
+import asyncio
+import time
+
+from timer_wheel import TimerWheel
+
+async def order():
+    loop = asyncio.get_running_loop()
+    wheel = TimerWheel(loop, tick=0.01)
+    fired = []
+    for delay in (0.05, 0.01, 0.03, 3.0):
+        wheel.call_later(delay, fired.append, delay)
+    wheel.call_later(0.02, fired.append, "cancelled").cancel()
+    await asyncio.sleep(0.1)
+    assert fired == [0.01, 0.03, 0.05]
+    assert len(wheel) == 1
+
+async def after_gap():
+    loop = asyncio.get_running_loop()
+    wheel = TimerWheel(loop, tick=0.01)
+    fired = []
+    wheel.call_later(5.0, fired.append, "later")
+    # The loop is held up, so the wheel hasn't ticked since
+    time.sleep(0.2)
+    start = loop.time()
+    wheel.call_later(0.1, lambda: fired.append(loop.time() - start))
+    await asyncio.sleep(0.2)
+    assert len(fired) == 1 and fired[0] >= 0.1
+
+def test_order():
+    asyncio.run(order())
+
+def test_deadline_from_now():
+    asyncio.run(after_gap())
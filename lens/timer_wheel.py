@@ -0,0 +1,144 @@
+import asyncio
+import traceback
+
+# Hierarchical timer wheel (Varghese & Lauck), ticking on the event loop
+#
+# Thousands of flows each wanting a timeout would mean thousands of
+# `loop.call_later` handles in the loop's heap, each pushed & popped in
+# O(log n). Here a timer is an entry in a slot: scheduling & cancelling are
+# O(1), and the wheel as a whole costs one loop callback per tick -- and none
+# at all while it's empty.
+#
+# Time is counted in ticks of TICK seconds. Level 0 has a slot per tick for
+# the current block of 256 ticks; each level above has 64 slots, a slot per
+# block of the level below. When the current tick enters a new block, the
+# timers in that block's slot are moved down a level ("cascade"), so every
+# timer is moved at most 3 times before it fires.
+
+LEVEL0_BITS = 8
+LEVEL_BITS = 6
+LEVELS = 4
+
+class Timer(object):
+    __slots__ = ("wheel", "deadline", "callback", "args", "slot")
+
+    def __init__(self, wheel, deadline, callback, args):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+    def cancel(self):
+        # Safe to call more than once, or after the timer fired
+        if self.slot is not None:
+            del self.slot[self]
+            self.slot = None
+            self.wheel.count -= 1
+
+    @property
+    def pending(self):
+        return self.slot is not None
+
+class TimerWheel(object):
+    TICK = 0.1
+
+    def __init__(self, loop=None, tick=TICK):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.tick = tick
+        # Slots are dicts (timer -> None), for O(1) removal in insertion order
+        self.levels = [[{} for i in range(1 << LEVEL0_BITS)]]
+        self.levels += [[{} for i in range(1 << LEVEL_BITS)] for level in range(1, LEVELS)]
+        self.current = self.now()
+        self.count = 0
+        self.handle = None
+
+    def now(self):
+        # Current time, in ticks
+        return int(self.loop.time() / self.tick)
+
+    def call_later(self, delay, callback, *args):
+        # Run `callback(*args)` after `delay` seconds, rounded up to a tick
+        # Returns a Timer, which can be cancelled
+        now = self.now()
+        if self.count == 0:
+            # Nothing pending, so no tick to catch up on
+            self.current = now
+        # From now, not from `current`: that can lag behind until the next
+        # `advance`, and the timer would go off early by as much
+        ticks = max(1, -int(-delay // self.tick))
+        timer = Timer(self, now + ticks, callback, args)
+        self.insert(timer)
+        self.count += 1
+        if self.handle is None:
+            self.handle = self.loop.call_later(self.tick, self.advance)
+        return timer
+
+    def insert(self, timer):
+        deadline = timer.deadline
+        shift = LEVEL0_BITS
+        if deadline >> shift == self.current >> shift:
+            slot = self.levels[0][deadline & ((1 << LEVEL0_BITS) - 1)]
+        else:
+            for level in range(1, LEVELS):
+                if level == LEVELS - 1 or deadline >> (shift + LEVEL_BITS) == self.current >> (shift + LEVEL_BITS):
+                    # In the current block of this level, but not the one below
+                    slot = self.levels[level][(deadline >> shift) & ((1 << LEVEL_BITS) - 1)]
+                    break
+                shift += LEVEL_BITS
+        slot[timer] = None
+        timer.slot = slot
+
+    def cascade(self, level):
+        # Move the timers for the block the current tick just entered down
+        shift = LEVEL0_BITS + LEVEL_BITS * (level - 1)
+        index = (self.current >> shift) & ((1 << LEVEL_BITS) - 1)
+        timers = self.levels[level][index]
+        self.levels[level][index] = {}
+        for timer in timers:
+            # The top level also holds timers more than one full turn away,
+            # which land back in the same slot
+            self.insert(timer)
+
+    def advance(self):
+        # Loop callback: run everything due up to now
+        self.handle = None
+        now = self.now()
+        while self.current < now and self.count:
+            self.current += 1
+            if self.current & ((1 << LEVEL0_BITS) - 1) == 0:
+                # Higher levels first, so their timers can cascade further
+                shift = LEVEL0_BITS
+                top = 1
+                while top < LEVELS - 1 and self.current & ((1 << (shift + LEVEL_BITS)) - 1) == 0:
+                    shift += LEVEL_BITS
+                    top += 1
+                for level in range(top, 0, -1):
+                    self.cascade(level)
+
+            slot = self.levels[0][self.current & ((1 << LEVEL0_BITS) - 1)]
+            while slot:
+                timer = next(iter(slot))
+                timer.cancel()
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    traceback.print_exc()
+        if self.count:
+            self.handle = self.loop.call_later(self.tick, self.advance)
+        else:
+            self.current = now
+
+    def __len__(self):
+        return self.count
+
+# One wheel per event loop, shared by every layer
+_wheels = {}
+
+def get_wheel(loop=None):
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    wheel = _wheels.get(loop)
+    if wheel is None:
+        wheel = _wheels[loop] = TimerWheel(loop)
+    return wheel
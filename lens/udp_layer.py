@@ -1,50 +1,69 @@
 import dpkt 
-from tornado import gen
 
+import packet
 from base_layer import NetLayer
+from header import wire
 
 # A UDP connection is not as well-defined as in TCP
 # But it's still a useful construct
 def udp_connection_id(pkt, header):
     # Generate a tuple representing the stream
     # ((ip, port), (ip, port))
-    return tuple(sorted(((header["ip_src"], pkt.sport), (header["ip_dst"], pkt.dport))))
+    # (raw addresses, see header.py)
+    return tuple(sorted(((wire(header, "ip_src"), pkt.sport), (wire(header, "ip_dst"), pkt.dport))))
 
 class UDPLayer(NetLayer):
     NAME = "udp"
+    TRANSPARENT = True
     seen_ports = set()
 
     def match(self, src, header):
-        return header["ip_p"] == dpkt.ip.IP_PROTO_UDP
+        return header.get("ip_p") == dpkt.ip.IP_PROTO_UDP
+
+    def match_keys(self):
+        return {"ip_p": {dpkt.ip.IP_PROTO_UDP}}
 
     # coroutine
     def on_read(self, src, header, data):
+        if not isinstance(data, packet.UDP):
+            # Couldn't be parsed (see packet.py)
+            return self.passthru(src, header, data)
         pkt = data
 
-        header["udp_sport"] = pkt.sport
-        header["udp_dport"] = pkt.dport
+        header.udp_sport = pkt.sport
+        header.udp_dport = pkt.dport
 
-        header["udp_conn"] = udp_connection_id(pkt, header)
+        header.udp_conn = udp_connection_id(pkt, header)
+        header.transport = pkt
 
         return self.bubble(src, header, pkt.data)
 
     # coroutine
     def write(self, dst, header, data):
         header["ip_p"] = dpkt.ip.IP_PROTO_UDP
-        pkt = dpkt.udp.UDP(sport=header["udp_sport"], dport=header["udp_dport"])
-        pkt.data = data 
-        pkt.ulen = len(pkt)
-
-        # Return dpkt.udp.UDP instance so IP layer can calc checksum
+        original = getattr(header, "transport", None)
+        if isinstance(original, packet.UDP) and data is original.data:
+            # Same payload as came in: only update the checksum for whatever
+            # changed in the headers, instead of summing the payload again
+            pkt = original.rewrite(wire(header, "ip_src"), wire(header, "ip_dst"),
+                    sport=header["udp_sport"], dport=header["udp_dport"])
+        else:
+            # Zero checksum, so IP layer fills it in
+            pkt = packet.build_udp(header["udp_sport"], header["udp_dport"], data)
         return self.write_back(dst, header, pkt)
 
 class UDPFilterLayer(NetLayer):
     NAME = "udp_filter"
+    TRANSPARENT = True
     """ Pass all UDP packets with a given port through """
 
     def __init__(self, *args, **kwargs):
         super(UDPFilterLayer, self).__init__(**kwargs)
-        self.ports = [int(a) for a in args]
+        self.ports = {int(a) for a in args}
 
     def match(self, src, header):
-        return header["udp_dport"] in self.ports or header["udp_sport"] in self.ports
+        # `header` may be a plain dict (see header.py)
+        return header.get("udp_dport") in self.ports or header.get("udp_sport") in self.ports
+
+    def match_keys(self):
+        return {"udp_port": set(self.ports)}
@@ -1,65 +1,183 @@
-import tornado.gen as gen
 import subprocess
 
+import replace_rules
 from base_layer import NetLayer
+from flowtable import FlowTable
+
+class LineBuffer(object):
+    # What's waiting to be passed on from one side of a LineBufferLayer
+    # connection
+    #
+    # A bytearray which is read from the front: taking a line only moves
+    # `start` along, and the bytes before it are dropped once they're half
+    # the buffer. The search for the next newline carries on from where the
+    # last one gave up (`scanned`), so each byte is looked at once, however
+    # the data was cut up -- rather than partition() copying the whole rest
+    # of the buffer for every line.
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.start = 0
+        self.scanned = 0
+
+    def append(self, data):
+        self.buf += data
+
+    def line(self):
+        # The next line, with its b"\n", or None if there isn't a whole one
+        end = self.buf.find(b"\n", self.scanned)
+        if end < 0:
+            self.scanned = len(self.buf)
+            return None
+        with memoryview(self.buf) as view:
+            line = bytes(view[self.start:end + 1])
+        self.consume(end + 1)
+        return line
+
+    def take(self):
+        # All of it
+        with memoryview(self.buf) as view:
+            data = bytes(view[self.start:])
+        self.consume(len(self.buf))
+        return data
+
+    def unread(self, data):
+        # Put `data` back in front
+        if len(data) <= self.start:
+            # Where it most likely came from
+            self.start -= len(data)
+            self.buf[self.start:self.start + len(data)] = data
+        else:
+            self.buf[self.start:self.start] = data
+        self.scanned = self.start
+
+    def consume(self, end):
+        self.start = self.scanned = end
+        if self.start * 2 >= len(self.buf):
+            del self.buf[:self.start]
+            self.start = self.scanned = 0
+
+    def __len__(self):
+        return len(self.buf) - self.start
 
 class LineBufferLayer(NetLayer):
     # Buffers incoming data line-by-line
     NAME = "linebuffer"
     CONN_ID_KEY = "tcp_conn"
+    MAX_CONNECTIONS = 65536
 
     def __init__(self, *args, **kwargs):
         super(LineBufferLayer, self).__init__(*args, **kwargs)
-        self.buffers = {}
+        # self.enabled, self.closed, self.reading & self.hooks follow the
+        # entries in self.buffers
+        self.buffers = FlowTable(self.MAX_CONNECTIONS, on_evict=self.forget)
         self.enabled = {}
         self.closed = {}
+        # True while a read is being passed on (see `drain`)
+        self.reading = {}
+        # The lbl_* functions for a connection, put in every header
+        self.hooks = {}
         
-    @gen.coroutine
-    def on_read(self, src, header, data):
+    async def on_read(self, src, header, data):
         conn_id = header[self.CONN_ID_KEY]
         if conn_id not in self.buffers:
-            self.buffers[conn_id] = {0: bytes(), 1: bytes()}
+            self.buffers[conn_id] = {0: LineBuffer(), 1: LineBuffer()}
             self.enabled[conn_id] = {0: True, 1: True}
             self.closed[conn_id] = {0: False, 1: False}
+            self.reading[conn_id] = {0: False, 1: False}
+            self.hooks[conn_id] = self.make_hooks(conn_id)
+        header.update(self.hooks[conn_id])
+
+        if data is None:
+            await self.bubble(src, header, self.buffers[conn_id][src].take())
+        elif self.reading[conn_id][src]:
+            self.buffers[conn_id][src].append(data)
+        else:
+            await self.drain(src, header, conn_id, data)
+
+    def make_hooks(self, conn_id):
+        enabled = self.enabled[conn_id]
+        buffers = self.buffers.peek(conn_id)
 
         def lbl_enable(s):
-            self.enabled[conn_id][s] = True
+            enabled[s] = True
         def lbl_disable(s):
-            self.enabled[conn_id][s] = False
+            enabled[s] = False
+        def lbl_unread(s, data):
+            # Put back what was read past the end of a message; it's passed
+            # on again next (see `drain`)
+            buffers[s].unread(data)
+
+        return {"lbl_enable": lbl_enable, "lbl_disable": lbl_disable, "lbl_unread": lbl_unread}
+
+    async def drain(self, src, header, conn_id, data):
+        # Pass on `data`, & whatever's buffered from `src`: line by line while
+        # enabled, as it is otherwise. Whatever comes in while a bubble() is
+        # waiting (say, on HTTPLayer decoding a body on a thread) is added to
+        # the buffer and passed on by this same loop once it's through, so
+        # reads can't overtake each other, and the child's lbl_enable /
+        # lbl_disable always apply from the very next byte.
+        buffer = self.buffers[conn_id][src]
+        enabled = self.enabled[conn_id]
+        reading = self.reading[conn_id]
+        reading[src] = True
+        try:
+            if enabled[src] or buffer:
+                buffer.append(data)
+            else:
+                # Straight through, without going into the buffer
+                await self.bubble(src, header, data)
+            while conn_id in self.buffers:
+                if enabled[src]:
+                    line = buffer.line()
+                    if line is None:
+                        break
+                    await self.bubble(src, header, line)
+                else:
+                    if not buffer:
+                        break
+                    await self.bubble(src, header, buffer.take())
+        finally:
+            reading[src] = False
 
-        header["lbl_enable"] = lbl_enable
-        header["lbl_disable"] = lbl_disable
+        if conn_id in self.closed and self.closed[conn_id][src]:
+            # Closed meanwhile
+            await self.finish(src, header, conn_id)
 
-        if data is None:
-            buff = self.buffers[conn_id][src]
-            self.buffers[conn_id][src] = bytes()
-            yield self.bubble(src, header, buff)
-        else:
-            self.buffers[conn_id][src] += data
-            if self.enabled[conn_id][src]:
-                while b'\n' in self.buffers[conn_id][src]:
-                    line, _newline, self.buffers[conn_id][src] = self.buffers[conn_id][src].partition(b'\n')
-                    yield self.bubble(src, header, line + b'\n')
-
-            if not self.enabled[conn_id][src]:
-                buff = self.buffers[conn_id][src]
-                self.buffers[conn_id][src] = bytes()
-                yield self.bubble(src, header, buff)
-
-    @gen.coroutine
-    def on_close(self, src, header):
+    async def on_close(self, src, header):
         conn_id = header[self.CONN_ID_KEY]
         if conn_id in self.buffers:
-            buff = self.buffers[conn_id][src]
-            self.buffers[conn_id][src] = bytes()
-            yield self.bubble(src, header, buff)
-
             self.closed[conn_id][src] = True
-            if all(self.closed[conn_id]): 
-                del self.closed[conn_id]
-                del self.enabled[conn_id]
-                del self.buffers[conn_id]
-        yield self.close_bubble(src, header)
+            if self.reading[conn_id][src]:
+                # After what's still being read (see `drain`)
+                return
+            await self.finish(src, header, conn_id)
+        else:
+            await self.close_bubble(src, header)
+
+    async def finish(self, src, header, conn_id):
+        # Pass on any last partial line, then the close
+        buffer = self.buffers[conn_id][src]
+        if buffer:
+            await self.bubble(src, header, buffer.take())
+
+        if conn_id in self.closed and all(self.closed[conn_id].values()):
+            del self.buffers[conn_id]
+            self.forget(conn_id)
+        await self.close_bubble(src, header)
+
+    def forget(self, conn_id, buffers=None):
+        self.enabled.pop(conn_id, None)
+        self.closed.pop(conn_id, None)
+        self.reading.pop(conn_id, None)
+        self.hooks.pop(conn_id, None)
+
+    def on_evict(self, header):
+        conn_id = header.get(self.CONN_ID_KEY)
+        if conn_id in self.buffers:
+            del self.buffers[conn_id]
+            self.forget(conn_id)
+        super(LineBufferLayer, self).on_evict(header)
 
 class MultiOrderedDict(list):
     def __init__(self, from_list=None):
@@ -73,9 +191,9 @@ class MultiOrderedDict(list):
         if key in self.d:
             #print "Removing", key, ":", self.d[key]
             del self.d[key]
-            for (i, (k, v)) in enumerate(self):
-                if k.lower() == key:
-                    self.pop(i)
+            # Rebuilt in one pass: popping while enumerating skips the entry
+            # after each removed one, so a duplicate would survive
+            self[:] = [(k, v) for (k, v) in self if k.lower() != key]
 
     def first(self, key, default=None):
         key = key.lower()
@@ -199,8 +317,7 @@ class PipeLayer(NetLayer):
     def match(self, src, header):
         return self.CONN_ID_KEY in header
 
-    @gen.coroutine
-    def write(self, dst, header, payload):
+    async def write(self, dst, header, payload):
         self.log(">", len(payload))
         conn_id = header[self.CONN_ID_KEY]
         if conn_id not in self.sps:
@@ -211,10 +328,9 @@ class PipeLayer(NetLayer):
         self.log(": ", _stderr)
         self.log(">", len(output))
         del self.sps[conn_id]
-        return self.write_back(dst, header, output)
+        return await self.write_back(dst, header, output)
 
-    @gen.coroutine
-    def on_close(self, src, header):
+    async def on_close(self, src, header):
         conn_id = header[self.CONN_ID_KEY]
         if conn_id not in self.sps:
             return
@@ -224,7 +340,7 @@ class PipeLayer(NetLayer):
         self.sps[conn_id].kill()
         del self.sps[conn_id]
 
-        yield self.passthru(src, header, output)
+        await self.passthru(src, header, output)
 
 class VimLayer(PipeLayer):
     NAME = "vim"
@@ -238,14 +354,26 @@ class VimLayer(PipeLayer):
 
 # old,new,count
 # count=-1 for all occurrences
+# More rules with rules=[(old, new, count), ...]; `old` can also be a compiled
+# bytes regex (see replace_rules.py)
 class ByteReplaceLayer(NetLayer):
     NAME = "byte_replace"
+    STREAMING = True
+    CONN_ID_KEY = "tcp_conn"
+
     def __init__(self, *args, **kwargs):
         args = list(args)
-        self.old = args.pop(0)
-        self.new = args.pop(0)
-        self.count = args.pop(0)
+        rules = list(kwargs.pop("rules", []))
+        if args:
+            old = args.pop(0)
+            new = args.pop(0)
+            count = args.pop(0) if args else -1
+            rules.insert(0, (old, new, count))
         super(ByteReplaceLayer, self).__init__(*args, **kwargs)
+        self.rules = replace_rules.RuleSet(rules)
+        # (conn_id, dst) -> (end of the last piece of a streamed body, which
+        # might be the start of a match, & the counts left for the body)
+        self.tails = {}
 
     def match(self, src, header):
         if "http_headers" not in header:
@@ -254,7 +382,30 @@ class ByteReplaceLayer(NetLayer):
 
     # coroutine
     def write(self, dst, header, payload):
-        self.log("Performing replacement on {} bytes", len(payload))
-        new_data = payload
-        new_data = new_data.replace(self.old, self.new)
+        if header.get("http_stream"):
+            return self.write_back(dst, header, self.replace_piece(dst, header, payload))
+        # If nothing matches, the payload is passed on as the same object, so
+        # HTTPLayer can tell it's unchanged
+        new_data, _rest = self.rules.replace(payload, self.rules.counts())
+        if new_data is not payload:
+            self.log("Performed replacements on {} bytes", len(payload))
         return self.write_back(dst, header, new_data)
+
+    def replace_piece(self, dst, header, payload):
+        # Replace in a piece of a streamed body. A match can be split between
+        # pieces, so whatever could be the start of one is held back, until
+        # the next piece (or the end) shows whether it is
+        key = (header[self.CONN_ID_KEY], dst)
+        tail, remaining = self.tails.pop(key, (b"", None))
+        if remaining is None:
+            remaining = self.rules.counts()
+        output, tail = self.rules.replace(tail + payload, remaining, header["http_last"])
+        if not header["http_last"]:
+            self.tails[key] = (tail, remaining)
+        return output
+
+    def on_evict(self, header):
+        conn_id = header.get(self.CONN_ID_KEY)
+        for key in [key for key in self.tails if key[0] == conn_id]:
+            del self.tails[key]
+        super(ByteReplaceLayer, self).on_evict(header)
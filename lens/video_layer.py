@@ -1,5 +1,4 @@
-from tornado import gen
-from tornado.ioloop import IOLoop
+import asyncio
 import struct
 import subprocess
 import fcntl
@@ -8,6 +7,7 @@ import socket
 import random
 
 from base_layer import NetLayer
+from flowtable import FlowTable
 
 def get_script(path):
     return os.path.join(
@@ -27,7 +27,7 @@ class FfmpegLayer(NetLayer):
         ffmpeg_log = kwargs.pop("log", "/dev/null")
         ffmpeg_log = open(ffmpeg_log, "w")
 
-        self.ioloop = IOLoop.instance()
+        self.loop = asyncio.get_event_loop()
 
         args = ["pipe:{0}".format(self.make_loop(arg[5:])) if arg.startswith("loop:") else arg for arg in args]
         
@@ -38,7 +38,7 @@ class FfmpegLayer(NetLayer):
         fcntl.fcntl(self.ffmpeg.stdout.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
         fcntl.fcntl(self.ffmpeg.stdin.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
 
-        self.ioloop.add_handler(self.ffmpeg.stdout.fileno(), self.ffmpeg_read_handler, IOLoop.READ)
+        self.loop.add_reader(self.ffmpeg.stdout.fileno(), self.ffmpeg_read_handler)
 
         self.frames_skipped = 0
 
@@ -52,7 +52,7 @@ class FfmpegLayer(NetLayer):
 
     def cleanup(self):
         super(FfmpegLayer, self).cleanup()
-        self.ioloop.remove_handler(self.ffmpeg.stdout.fileno())
+        self.loop.remove_reader(self.ffmpeg.stdout.fileno())
         self.ffmpeg.terminate()
 
     def make_loop(self, filename):
@@ -61,29 +61,27 @@ class FfmpegLayer(NetLayer):
         fcntl.fcntl(fifo_write, fcntl.F_SETFL, os.O_NONBLOCK)
 
         pos = [0]
-        def on_writable(fd, event):
-            if event & IOLoop.WRITE:
-                n = 0
+        def on_writable(fd):
+            n = 0
+            try:
+                n = os.write(fd, loop[pos[0]:]) + pos[0]
+            except OSError as e:
+                if e.errno != 11:
+                    raise
+            while n == len(loop):
                 try:
-                    n = os.write(fd, loop[pos[0]:]) + pos[0]
+                    n = os.write(fd, loop)
                 except OSError as e:
                     if e.errno != 11:
                         raise
-                while n == len(loop):
-                    try:
-                        n = os.write(fd, loop)
-                    except OSError as e:
-                        if e.errno != 11:
-                            raise
-                        n = 0
-                pos[0] = n
+                    n = 0
+            pos[0] = n
 
-        self.ioloop.add_handler(fifo_write, on_writable, IOLoop.WRITE)
+        self.loop.add_writer(fifo_write, on_writable, fifo_write)
 
         return fifo_read
 
-    @gen.coroutine
-    def on_read(self, src, header, data):
+    async def on_read(self, src, header, data):
         self.last_src = src
         self.last_header = header
 
@@ -94,9 +92,9 @@ class FfmpegLayer(NetLayer):
             self.log("ERROR! FFMPEG is too slow")
 
         if not self.ffmpeg_ready:
-            yield self.passthru(src, header, data)
+            await self.passthru(src, header, data)
 
-    def ffmpeg_read_handler(self, fd, events):
+    def ffmpeg_read_handler(self):
         # TODO neaten up this code
         t = self.ffmpeg.stdout.read()
         self.incoming_ffmpeg += t
@@ -118,7 +116,7 @@ class FfmpegLayer(NetLayer):
                     continue
 
             dst = self.route(self.last_src, self.last_header)
-            self.add_future(self.write_back(dst, self.last_header, self.UNIT4 + frame))
+            self.dispatch(self.write_back(dst, self.last_header, self.UNIT4 + frame))
 
     def do_status(self):
         """Print current ffmpeg status"""
@@ -132,10 +130,13 @@ class H264NalLayer(NetLayer):
     PS = 1396
     TS_INCR = 3600
     DATAMOSH_RATE = 0.01
+    MAX_CONNECTIONS = 4096
+    # RTP over UDP never closes, so streams are dropped once they go quiet
+    IDLE_TIMEOUT = 60.0
 
     def __init__(self, *args, **kwargs):
         super(H264NalLayer, self).__init__(*args, **kwargs)
-        self.connections = {}
+        self.connections = FlowTable(self.MAX_CONNECTIONS, self.IDLE_TIMEOUT)
         self.make_toggle("datamosh")
 
     #def match(self, src, header):
@@ -155,19 +156,25 @@ class H264NalLayer(NetLayer):
             return None
 
         if incoming and (conn_id not in self.connections):
-            self.log("Created new connection: {}".format(conn_id))
+            self.log("Created new connection: {}", conn_id)
             self.connections[conn_id] = {}
 
         return self.connections.get(conn_id)
 
-    @gen.coroutine
-    def on_read(self, src, header, data):
+    def on_evict(self, header):
+        if "udp_conn" in header:
+            self.connections.pop(("UDP", header["udp_conn"]), None)
+        if "tcp_conn" in header:
+            self.connections.pop(("TCP", header["tcp_conn"]), None)
+        super(H264NalLayer, self).on_evict(header)
+
+    async def on_read(self, src, header, data):
         # Strip NAL encoding (supporting FU-A fragmentation) 
         # And pass on reconstructed H.264 fragments to the next layer
 
         conn = self.get_connection(header, incoming=True)
         if conn is None:
-            yield self.passthru(src, header, data)
+            await self.passthru(src, header, data)
             return
         elif len(conn) == 0:
             conn["seq_num"] = None
@@ -209,7 +216,7 @@ class H264NalLayer(NetLayer):
                 if fragment_type < 24:
                     header["nal_type"] = n0 & 0x1F
                     h264_fragment = self.UNIT4 + nal_unit
-                    yield self.bubble(src, header, h264_fragment)
+                    await self.bubble(src, header, h264_fragment)
 
                 # Fragmented with FU-A
                 elif fragment_type == 28:
@@ -223,7 +230,7 @@ class H264NalLayer(NetLayer):
                     elif n1 & 0x40 and conn["fragment_buffer"] is not None:
                         header["nal_type"] = conn["nal_type_buffer"]
                         conn["fragment_buffer"] += nal_unit[2:] 
-                        yield self.bubble(src, header, conn["fragment_buffer"])
+                        await self.bubble(src, header, conn["fragment_buffer"])
                         conn["fragment_buffer"] = None
                         conn["nal_type_buffer"] = None
 
@@ -234,8 +241,7 @@ class H264NalLayer(NetLayer):
                 if 'nal_type' in header:
                     conn["time_skew"] = timestamp - conn["nal_timestamp"]
 
-    @gen.coroutine
-    def write(self, dst, header, data):
+    async def write(self, dst, header, data):
         conn = self.get_connection(header, incoming=False)
         if not conn:
             self.log("H264: Invalid connection info in header, dropping packet!")
@@ -274,7 +280,7 @@ class H264NalLayer(NetLayer):
 
             # Can we fit it the whole frame in 1 packet, or do we need to fragment?
             if len(nal_data) <= self.PS:
-                yield self.write_nal_fragment(dst, header, nal_data, end=True)
+                await self.write_nal_fragment(dst, header, nal_data, end=True)
             else:
                 # FU-A fragmentation
                 fragment_type = 28
@@ -282,19 +288,18 @@ class H264NalLayer(NetLayer):
                 # Write first datagram which has 0x80 set on the second byte
                 n0 = h0 & 0xE0 | fragment_type
                 n1 = h0 & 0x1F
-                yield self.write_nal_fragment(dst, header, bytes(n0) + bytes(0x80 | n1) + nal_data[1:self.PS-1], end=False)
+                await self.write_nal_fragment(dst, header, bytes(n0) + bytes(0x80 | n1) + nal_data[1:self.PS-1], end=False)
                 nal_data = nal_data[self.PS-1:]
 
                 # Write intermediate datagrams
                 while len(nal_data) > self.PS-2:
-                    yield self.write_nal_fragment(dst, header, bytes(n0) + bytes(n1) + nal_data[:self.PS-2], end=False)
+                    await self.write_nal_fragment(dst, header, bytes(n0) + bytes(n1) + nal_data[:self.PS-2], end=False)
                     nal_data = nal_data[self.PS-2:]
 
                 # Write first datagram which has 0x40 set on the second byte
-                yield self.write_nal_fragment(dst, header, bytes(n0) + bytes(0x40 | n1) + nal_data, end=True)
+                await self.write_nal_fragment(dst, header, bytes(n0) + bytes(0x40 | n1) + nal_data, end=True)
 
-    @gen.coroutine
-    def write_nal_fragment(self, dst, header, data, end=True):
+    async def write_nal_fragment(self, dst, header, data, end=True):
         conn = self.get_connection(header, incoming=False)
         payload_type = 96 # H.264
         mark = 0x80 if end else 0 
@@ -303,7 +308,7 @@ class H264NalLayer(NetLayer):
         head = struct.pack("!BBHII", 0x80, payload_type | mark, conn["seq_num"], timestamp, 0)
         conn["seq_num"] = (conn["seq_num"] + 1) & 0xFFFF # 2 bytes
 
-        yield self.write_back(dst, header, head + data)
+        await self.write_back(dst, header, head + data)
 
     def do_skew(self):
         """Print the current time skew from the source video (dropped frames)."""